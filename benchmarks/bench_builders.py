@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+""" Benchmark of the VLCB command methods
+
+Prints the average time for each method to create a packet.
+Run before and after changes to the encoder to compare throughput.
+"""
+
+import timeit
+from pyvlcb import VLCB
+from pyvlcb.encoder import frame_bytes
+
+# Number of times each method is called
+number = 100000
+
+vlcb = VLCB()
+
+tests = {
+    "make_header": lambda: vlcb.make_header(opcode='23'),
+    "keep_alive": lambda: vlcb.keep_alive(5),
+    "loco_speeddir": lambda: vlcb.loco_speeddir(5, 130),
+    "accessory_short_command": lambda: vlcb.accessory_short_command(256, 2, True),
+    "accessory_command": lambda: vlcb.accessory_command(256, "0x10002", True),
+    "loco_set_dfun": lambda: vlcb.loco_set_dfun(5, 1, 0x11),
+    "frame_bytes (DSPD)": lambda: frame_bytes(60, '47', 5, 130),
+}
+
+
+def main ():
+    for name, test in tests.items():
+        duration = timeit.timeit(test, number=number)
+        print (f"{name:<28} {duration / number * 1e9:8.0f} ns  {number / duration:10.0f} per second")
+
+
+if __name__ == "__main__":
+    main()
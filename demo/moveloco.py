@@ -40,6 +40,10 @@ def main ():
         # At the moment stop - perhaps update in future
         return
 
+    # Session manager sends keep alives only when no other command has been sent
+    session_manager = SessionManager(vlcb, usb)
+    usb.add_listener(session_manager.record)
+
     state = "allocating"
 
     # Allocate loco
@@ -57,12 +61,9 @@ def main ():
     for i in range (0, 100):
         # If there is a session allocated then need to send a keep alive
         # otherwise the loco will expire. This should be every 4 seconds
-        # So ideally any commands should have processing limit below
-        # 3 seconds
-        if session != None:
-            #print ("Sending keep alive")
-            command = vlcb.keep_alive(session)
-            usb.send_data(command)
+        # The session manager only sends one if no other command has been
+        # sent to the session recently
+        session_manager.poll()
         
         
         # in_data is a list of data
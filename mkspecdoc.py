@@ -24,6 +24,9 @@ def main():
         f.write("## VLCB Opcodes\n\n")
         f.write("These are the opcodes listed in the VLCBOpcode.opcodes dictionary.\n\n")
         for code, details in VLCBOpcode.opcodes.items():
+            # Skip the null opcode placeholder (not a real opcode)
+            if code == '':
+                continue
             # Create Table Header
             opcode_int = int(code, 16)
             f.write(f"| OpCode | '{code}' ({opcode_int}) |\n")
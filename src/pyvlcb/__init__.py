@@ -1,13 +1,37 @@
 # Class for handling VLCB data formatting
 # Data is returned as string - needs to be encoded afterwards
 
-from .vlcbformat import VLCBFormat, VLCBOpcode
-from .canusb import CanUSB4
+from .vlcbformat import VLCBFormat, VLCBOpcode, FrozenVLCBFormat
+from .cache import DecodeCache
+from .encoder import header_string, command_prefix, command_prefix_bytes, compiled_encoder, opcode_minpri
+from .canusb import CanUSB4, DIRECTION_RX, DIRECTION_TX
+from .dispatcher import VLCBDispatcher
+from .filters import VLCBFilter, compile_filter
+from .recorder import FlightRecorder
+from .routes import Route, RouteCache, RouteEntry
+from .functions import LocoFunctions
+from .capture import CaptureReader, CaptureWriter, CaptureRecord
+from .store import TrafficStore
+from .monitor import BusMonitor
+from .latency import LatencyTracker
+from .trafficlog import TrafficLogger
+from .render import render_data, render_entry
+from .session import SessionManager
+from .coalesce import SpeedCoalescer
+from .discovery import DiscoveryEngine, NodeInfo
+from .accessory import AccessoryStateTable
+from .snapshot import load_snapshot, save_snapshot
+from .nodetracker import NodeChangeTracker
+from .programming import ProgrammingEngine
+from .cv import CVProgrammer, CVCache
+from .extended import ExtendedFrame, encode_extended, parse_extended
+from .firmware import FirmwareImage, FirmwareUploader, FirmwareUploadGroup, read_intel_hex
 from .utils import num_to_1hexstr, num_to_2hexstr, num_to_4hexstr, f_to_bytes, dict_to_string
 from .exceptions import (
     MyLibraryError, 
     DeviceConnectionError, 
-    ProtocolError
+    ProtocolError,
+    InvalidLocoError
 )
 # As some Raspberry Pis are still running pre Python 3.10 uses optional
 # in method types. In future when everyone is on Bookworm or later
@@ -25,6 +49,36 @@ __all__ = [
     "CanUSB4",
     "VLCBFormat",
     "VLCBOpcode", 
+    "FrozenVLCBFormat",
+    "DecodeCache",
+    "VLCBDispatcher",
+    "VLCBFilter",
+    "compile_filter",
+    "FlightRecorder",
+    "Route",
+    "RouteCache",
+    "LocoFunctions",
+    "CaptureReader",
+    "CaptureWriter",
+    "TrafficStore",
+    "BusMonitor",
+    "LatencyTracker",
+    "TrafficLogger",
+    "SessionManager",
+    "SpeedCoalescer",
+    "DiscoveryEngine",
+    "NodeInfo",
+    "AccessoryStateTable",
+    "NodeChangeTracker",
+    "ProgrammingEngine",
+    "CVProgrammer",
+    "CVCache",
+    "ExtendedFrame",
+    "FirmwareImage",
+    "FirmwareUploader",
+    "FirmwareUploadGroup",
+    "DIRECTION_RX",
+    "DIRECTION_TX",
     # Exceptions that may be raised
     "MyLibraryError", 
     "DeviceConnectionError", 
@@ -38,17 +92,22 @@ class VLCB:
 
     Attributes:
         can_id: The Can ID for your software (default = 60)
+        cache: DecodeCache used by parse_input (None if not enabled)
     
     """
     # 60 is default canid for canusb4 (127 is dcc controller)
-    def __init__ (self, can_id: Optional[int] = 60) -> None:
+    def __init__ (self, can_id: Optional[int] = 60, cache_size: Optional[int] = None) -> None:
         """Inits VLCB with a can_id
         
         Args:
             can_id: The can_id for the software (default = 60)
+            cache_size: If set then parse_input uses a DecodeCache of this size
         """
         self.can_id = can_id
         self.debug = False
+        self.cache = None
+        if cache_size:
+            self.cache = DecodeCache(self._parse_input, cache_size)
     
     # Takes input bytestring and parses header / data
     # Does not try and interpret op-code - that is left to VLCB_format
@@ -56,6 +115,8 @@ class VLCB:
         """Parse a raw CBUS packet as an input bytestring
 
         Take a bytestring (or string) from the CBUS and extract the details
+        If the cache is enabled then repeated packets return the same
+        read only FrozenVLCBFormat.
 
         Args: 
             input_types (bytestring): Input raw bytestring (or string)
@@ -67,6 +128,11 @@ class VLCB:
             ValueError: If invalid data string
 
         """
+        if self.cache is not None:
+            return self.cache.parse_input(input_bytes)
+        return self._parse_input(input_bytes)
+
+    def _parse_input(self, input_bytes: bytes) -> VLCBFormat:
         # Also allow string (no need to decode)
         if isinstance (input_bytes, str):
             input_string = input_bytes
@@ -77,7 +143,7 @@ class VLCB:
         if (input_string[0] != ":"):
             raise ValueError(f"No start frame in '{input_string}'")
         if (input_string[1] != "S"):
-            raise ValueError("Format not supported - only Standard frames allowed in {input_string}")
+            raise ValueError(f"Format not supported - only Standard frames allowed in {input_string} (use parse_extended for extended frames)")
         # Use try when converting to number in case of error
         try:
             header = input_string[2:6]
@@ -85,19 +151,50 @@ class VLCB:
         except:
             raise ValueError(f"Invalid format, number expected {header}")
             header_val = 0
-        logger.debug (f"Header {hex(header_val)}")
         priority = (header_val & 0xf000) >> 12
-        logger.debug (f"Priority {priority:b}")
         can_id = (header_val & 0xfe0) >> 5
-        logger.debug(f"Can ID {can_id}")
         # Next is N / RTR can be ignored
-        logger.debug(f"N / RTR {input_string[6]}")
         # Data is rest excluding ; 
         data = input_string[7:-1]
-        logger.debug(f"Data {data}")
+        # Only format debug strings if enabled as this is called for every packet
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug (f"Header {hex(header_val)}")
+            logger.debug (f"Priority {priority:b}")
+            logger.debug(f"Can ID {can_id}")
+            logger.debug(f"N / RTR {input_string[6]}")
+            logger.debug(f"Data {data}")
         # Creates a VLCB_format and returns that
         return VLCBFormat (priority, can_id, data)
     
+    def parse_extended (self, input_bytes: Union[str, bytes]) -> ExtendedFrame:
+        """Parse an extended (:X) frame eg. bootloader traffic
+
+        Args:
+            input_bytes: Input raw bytestring (or string)
+
+        Returns:
+            ExtendedFrame: identifier, data bytes and rtr
+
+        Raises:
+            ValueError: If not a valid extended frame
+        """
+        return parse_extended(input_bytes)
+
+    def encode_extended (self, identifier: int, data: Union[bytes, List[int]] = b"") -> str:
+        """Create an extended (:X) frame
+
+        Args:
+            identifier (int): 29 bit identifier
+            data: Up to 8 data bytes
+
+        Returns:
+            String: A string for the frame
+
+        Raises:
+            ValueError: If the identifier or data are out of range
+        """
+        return encode_extended(identifier, data)
+
     # Parse and format into standard log format (datastring, direction, fulldata, direction, can_id, op_code, data
     # For log all values are returned as strings - note that the number (log entry number) is not returned
     def log_entry(self, input_string: str) -> list[str]:
@@ -126,6 +223,21 @@ class VLCB:
         data_string = dict_to_string(VLCBOpcode.parse_data(vlcb_entry.data))
         description_string = vlcb_entry.get_description()
         return [date_string, direction, message, str(vlcb_entry.can_id), opcode_string, data_string, description_string]
+
+    def render_entry(self, input_string: str) -> List[str]:
+        """Render a log entry for display
+
+        Same columns as log_entry but uses the compiled renderers, so it is
+        faster. Fields are formatted using their hex / num / char format,
+        error codes include the error text and loco addresses are included
+        in the description.
+
+        Args:
+            input_string (string): String consisting of of num, date, direction, message as a single string
+
+        Returns (list[str]): List of strings
+        """
+        return render_entry(input_string)
     
         
     # Static Methods moved to utils
@@ -155,18 +267,56 @@ class VLCB:
             can_id = self.can_id
             
         if minpri == None and opcode != None:
-            minpri = VLCBOpcode.opcode_priority(opcode)
+            minpri = opcode_minpri.get(opcode)
+            # Not a simple opcode so use lookup which handles longer strings
+            if minpri == None:
+                minpri = VLCBOpcode.opcode_priority(opcode)
             
         # If opcode not updated then use default low priority
         # Lower number is higher priority
         if minpri == None:
             minpri = 0b11
             
-        header_val = (majpri << 14) + (minpri << 12) + (can_id << 5)
-        header_to_hex = ("000" + hex(header_val).upper()[2:])[-4:]
-        header_string = f':S{header_to_hex}N'
-        return header_string
-        #return header_string.encode('utf-8')
+        # Header strings are cached in the encoder
+        return header_string(majpri, minpri, can_id)
+    
+    # Header and opcode using cached value from the encoder
+    def _prefix(self, opcode: str) -> str:
+        return command_prefix(self.can_id, opcode)
+    
+    # Generic encoder for any opcode
+    def encode(self, opcode: Union[int, str], **fields: Union[int, str]) -> str:
+        """Create a request for any opcode
+
+        Fields are named as in the opcode format (see VLCBOpcode.opcodes
+        and VLCBOpcode.field_formats), which are the same names returned
+        by VLCBOpcode.parse_data.
+        eg. encode('NVSET', NN=256, NVIndex=1, NVVal=5)
+
+        Args:
+            opcode: Opcode as int, hex string (eg. '96') or mnemonic (eg. 'NVSET')
+            fields: Value for each field
+
+        Returns:
+            String: A string for the request
+
+        Raises:
+            ValueError: If opcode not found or a value is out of range
+            TypeError: If a field is missing or not part of the opcode
+        """
+        code, encode_fields = compiled_encoder(opcode)
+        return command_prefix(self.can_id, code) + encode_fields(**fields) + ";"
+    
+    def encode_bytes(self, opcode: Union[int, str], **fields: Union[int, str]) -> bytes:
+        """Create a request for any opcode as a bytestring
+
+        Same as encode, but returns bytes ready for CanUSB4.send_data
+
+        Returns:
+            Bytes: The request as a bytestring
+        """
+        code, encode_fields = compiled_encoder(opcode)
+        return command_prefix_bytes(self.can_id, code) + encode_fields(**fields).encode('ascii') + b";"
     
     
     # Discover nodes
@@ -179,7 +329,7 @@ class VLCB:
             String: A string for the request
         """
         # Return QNN 
-        return self.make_header(opcode='0D') + '0D;'
+        return self._prefix('0D') + ';'
     
     # Discover number of events configured
     def discover_evn (self, node_id: int) -> str:
@@ -193,7 +343,7 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='58')}58{num_to_2hexstr(node_id)};" 
+        return f"{self._prefix('58')}{num_to_2hexstr(node_id)};" 
         
     # Discover number of events available
     def discover_nevn (self, node_id: int) -> str:
@@ -207,7 +357,7 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='56')}56{num_to_2hexstr(node_id)};"
+        return f"{self._prefix('56')}{num_to_2hexstr(node_id)};"
     
     # Discover stored events NERD
     def discover_nerd (self, node_id: int) -> str:
@@ -221,8 +371,131 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='57')}57{num_to_2hexstr(node_id)};"
-    
+        return f"{self._prefix('57')}{num_to_2hexstr(node_id)};"
+
+    # Put node into learn mode NNLRN
+    def node_learn (self, node_id: int) -> str:
+        """Create a put node into learn mode
+
+        Uses op-code NNLRN (53)
+
+        Args:
+            node_id (int): Node ID
+
+        Returns:
+            String: A string for the request
+        """
+        return self.encode('53', NN=node_id)
+
+    # Put node into bootloader mode BOOTM
+    def bootloader_mode (self, node_id: int) -> str:
+        """Create a put node into bootloader mode
+
+        Uses op-code BOOTM (5C). The node then only responds to the
+        bootloader extended frames until it is reset.
+
+        Args:
+            node_id (int): Node ID (0 for a SLiM node with no node number)
+
+        Returns:
+            String: A string for the request
+        """
+        return self.encode('5C', NN=node_id)
+
+    # Take node out of learn mode NNULN
+    def node_unlearn (self, node_id: int) -> str:
+        """Create a release node from learn mode
+
+        Uses op-code NNULN (54)
+
+        Args:
+            node_id (int): Node ID
+
+        Returns:
+            String: A string for the request
+        """
+        return self.encode('54', NN=node_id)
+
+    # Set a node variable NVSET
+    def set_nv (self, node_id: int, nv_index: int, value: int) -> str:
+        """Create a set node variable
+
+        Uses op-code NVSET (96). The node replies with WRACK (and / or GRSP)
+
+        Args:
+            node_id: Node ID
+            nv_index: Node variable index (1 to 255)
+            value: New value (0 to 255)
+
+        Returns:
+            String: A string for the request
+
+        Raises:
+            ValueError: If a value is out of range
+        """
+        return self.encode('96', NN=node_id, NVIndex=nv_index, NVVal=value)
+
+    # Teach an event EVLRN - node must be in learn mode
+    def learn_event (self, event: int, ev_index: int, ev_value: int) -> str:
+        """Create a teach event variable
+
+        Uses op-code EVLRN (D2). Only nodes in learn mode (see node_learn)
+        store the event. The node replies with WRACK (and / or GRSP)
+
+        Args:
+            event: Event as a 32 bit number (node ID of the producer << 16 + event number)
+            ev_index: Event variable index
+            ev_value: Event variable value
+
+        Returns:
+            String: A string for the request
+
+        Raises:
+            ValueError: If a value is out of range
+        """
+        if event < 0 or event > 0xFFFFFFFF:
+            raise ValueError(f"Event needs to be a 32 bit number. Value provided {event}")
+        return self.encode('D2', NN=event >> 16, EnHigh_EnLow=event & 0xFFFF, EvIndex=ev_index, EvVal=ev_value)
+
+    # Read a CV in service mode QCVS
+    def read_cv (self, session_id: int, cv: int, mode: int = 0) -> str:
+        """Create a read CV (service mode)
+
+        Uses op-code QCVS (84). The command station replies with PCVS or SSTAT
+
+        Args:
+            session_id: Session ID
+            cv: CV number (1 to 65535)
+            mode: Service mode (0 = direct byte)
+
+        Returns:
+            String: A string for the request
+
+        Raises:
+            ValueError: If a value is out of range
+        """
+        return self.encode('84', Session=session_id, CVHigh_CVLow=cv, Mode=mode)
+
+    # Write a CV in service mode WCVS
+    def write_cv (self, session_id: int, cv: int, value: int, mode: int = 0) -> str:
+        """Create a write CV (service mode)
+
+        Uses op-code WCVS (A2). The command station replies with SSTAT
+
+        Args:
+            session_id: Session ID
+            cv: CV number (1 to 65535)
+            value: CV value (0 to 255)
+            mode: Service mode (0 = direct byte)
+
+        Returns:
+            String: A string for the request
+
+        Raises:
+            ValueError: If a value is out of range
+        """
+        return self.encode('A2', Session=session_id, CVHigh_CVLow=cv, Mode=mode, CVVal=value)
+
     # Emergency stop all locos
     # RESTP
     def loco_stop_all (self) -> str:
@@ -233,7 +506,7 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='0A')}0A;"
+        return f"{self._prefix('0A')};"
     
     # node and ev should be the IDs - state either "on" or "off" / True or False
     def accessory_command (self, node_id: int, ev_id: int, state: Union[str, bool]) -> str:
@@ -276,10 +549,10 @@ class VLCB:
         # Turn on
         if state == True or state == "on":
             # ASON
-            return f"{self.make_header(opcode='98')}98{num_to_2hexstr(node_id)}{num_to_2hexstr(ev_id)};"
+            return f"{self._prefix('98')}{num_to_2hexstr(node_id)}{num_to_2hexstr(ev_id)};"
         # Turn off = ASOFF
         else:
-            return f"{self.make_header(opcode='99')}99{num_to_2hexstr(node_id)}{num_to_2hexstr(ev_id)};"
+            return f"{self._prefix('99')}{num_to_2hexstr(node_id)}{num_to_2hexstr(ev_id)};"
         
     def accessory_long_command (self, node_id: int, ev_id: int, state: Union[str, bool]) -> str:
         """Create an accessory long command
@@ -297,10 +570,29 @@ class VLCB:
         # Turn on
         if state == True or state == "on":
             # ASON
-            return f"{self.make_header(opcode='90')}90{num_to_4hexstr(ev_id)};"
+            return f"{self._prefix('90')}{num_to_4hexstr(ev_id)};"
         # Turn off = ASOFF
         else:
-            return f"{self.make_header(opcode='91')}91{num_to_4hexstr(ev_id)};"
+            return f"{self._prefix('91')}{num_to_4hexstr(ev_id)};"
+        
+    def accessory_route (self, entries: List[RouteEntry], name: Optional[str] = None) -> Route:
+        """Create a route of accessory commands to be sent together
+
+        The entries are validated and encoded once. Use Route.send to send
+        all the commands as a single write, or keep the route to reuse.
+        Use RouteCache to keep routes by name.
+
+        Args:
+            entries: List of (node_id, ev_id, state) - same values as accessory_command
+            name: Name of the route
+
+        Returns:
+            Route: The encoded route
+
+        Raises:
+            InvalidConfigurationError: If an entry is not valid
+        """
+        return Route(entries, self.can_id, name)
         
     # RLOC (Allocate loco) :SB040N40D446;
     # Short address upper address all zeros, only 6 bits of the lower byte are used (1 to 127) 0 is decoderless
@@ -325,7 +617,7 @@ class VLCB:
             raise ValueError ("Invalid short code. Loco ID {loco_id} is larger than 127")
         if long == True:
             loco_id = loco_id | 0xC000
-        return f"{self.make_header(opcode='40')}40{num_to_2hexstr(loco_id)};"
+        return f"{self._prefix('40')}{num_to_2hexstr(loco_id)};"
     
     def release_loco (self, session_id: int) -> str:
         """Create a release loco request
@@ -338,7 +630,7 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='21')}21{num_to_1hexstr(session_id)};"
+        return f"{self._prefix('21')}{num_to_1hexstr(session_id)};"
     
     def steal_loco (self, loco_id: int, long: Optional[bool] = True) -> str:
         """Create an steal loco request
@@ -361,7 +653,7 @@ class VLCB:
             raise InvalidLocoError(f"Invalid short code {loco_id}")
         if long == True:
             loco_id = loco_id | 0xC000
-        return f"{self.make_header(opcode='61')}61{num_to_2hexstr(loco_id)}01;"   
+        return f"{self._prefix('61')}{num_to_2hexstr(loco_id)}01;"   
         
     def share_loco (self, loco_id: int, long: Optional[bool] = True) -> str:
         """Create an share loco request
@@ -384,7 +676,7 @@ class VLCB:
             raise InvalidLocoError(f"Invalid short code {loco_id}")
         if long == True:
             loco_id = loco_id | 0xC000
-        return f"{self.make_header(opcode='61')}61{num_to_2hexstr(loco_id)}02;" 
+        return f"{self._prefix('61')}{num_to_2hexstr(loco_id)}02;" 
         
     def keep_alive (self, session_id: int) -> str:
         """Create an keep alive request
@@ -398,13 +690,13 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='23')}23{num_to_1hexstr(session_id)};"
+        return f"{self._prefix('23')}{num_to_1hexstr(session_id)};"
     
     def loco_speed_dir (self, session_id: int, speed: int, direction: int) -> str:
         """Set loco speed and direction based on separate arguments
 
         Same as loco_speeddir but this takes 2 arguments, whereas loco_speeddir needs a combined value
-        Maximum call this once every 32 milliseconds
+        Maximum call this once every 32 milliseconds (use SpeedCoalescer to limit this)
 
         Uses DSPD (47)
 
@@ -433,7 +725,7 @@ class VLCB:
     def loco_speeddir (self, session_id: int, speeddir: int) -> str:
         """Set loco speed and direction
 
-        Maximum call this once every 32 milliseconds
+        Maximum call this once every 32 milliseconds (use SpeedCoalescer to limit this)
         Needs combined speed and direction value.
         If speed is set to 1 then that is considered an emergency stop
 
@@ -446,7 +738,7 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='47')}47{num_to_1hexstr(session_id)}{num_to_1hexstr(speeddir)};"
+        return f"{self._prefix('47')}{num_to_1hexstr(session_id)}{num_to_1hexstr(speeddir)};"
     
     # Set function using DFUN - needs to be provided with the two bytes
     # First byte is group (1 = F1 to F4, 2 = F5 to F8, 3 = F9 to F12)
@@ -466,7 +758,37 @@ class VLCB:
         Returns:
             String: A string for the request
         """
-        return f"{self.make_header(opcode='60')}60{num_to_1hexstr(session_id)}{num_to_1hexstr(byte1)}{num_to_1hexstr(byte2)};"
+        return f"{self._prefix('60')}{num_to_1hexstr(session_id)}{num_to_1hexstr(byte1)}{num_to_1hexstr(byte2)};"
+    
+    def loco_function_on (self, session_id: int, function_num: int) -> str:
+        """Create a request to turn a single function on
+
+        Can be used for any function number including above F28
+        Uses DFNON (49)
+
+        Args:
+            session_id: Session ID
+            function_num: Function number 0 to 255
+
+        Returns:
+            String: A string for the request
+        """
+        return f"{self._prefix('49')}{num_to_1hexstr(session_id)}{num_to_1hexstr(function_num)};"
+    
+    def loco_function_off (self, session_id: int, function_num: int) -> str:
+        """Create a request to turn a single function off
+
+        Can be used for any function number including above F28
+        Uses DFNOF (4A)
+
+        Args:
+            session_id: Session ID
+            function_num: Function number 0 to 255
+
+        Returns:
+            String: A string for the request
+        """
+        return f"{self._prefix('4A')}{num_to_1hexstr(session_id)}{num_to_1hexstr(function_num)};"
     
     def loco_set_function (self, session_id: int, function_num, function_list) -> str:
         """Create a set function request using the function list
@@ -488,7 +810,7 @@ class VLCB:
             ValueError: Typically raised from f_to_bytes
         """
         byte1_2 = f_to_bytes(function_num, function_list)
-        return f"{self.make_header(opcode='60')}60{num_to_1hexstr(session_id)}{byte1_2[0]}{byte1_2[1]};"
+        return f"{self._prefix('60')}{num_to_1hexstr(session_id)}{byte1_2[0]}{byte1_2[1]};"
         
 
     
\ No newline at end of file
@@ -0,0 +1,254 @@
+""" Accessory state table
+
+Holds the current on / off state of each accessory event, updated from
+ACON / ACOF / ASON / ASOF (and the 1 to 3 data byte variants).
+
+Long events are stored as bit arrays for each node (one bit for the
+state and one bit to show the state is known), grown as higher event
+numbers are seen. Short events are identified by device number only
+(the node number is the sender) so have a single pair of bit arrays.
+Each lookup or update is an index into a bytearray, and 10,000s of events
+only need a few kilobytes.
+"""
+
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from .vlcbformat import VLCBOpcode
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Opcode : (short event, on) for each accessory opcode (in the opcode table)
+accessory_opcodes = {
+    int(VLCBOpcode.mnemonics[mnemonic], 16): (mnemonic.startswith('AS'), state == 'on')
+    for state, mnemonics in VLCBOpcode.accessory_codes.items() for mnemonic in mnemonics
+    if mnemonic in VLCBOpcode.mnemonics
+}
+
+# Event and device numbers are 16 bit
+MAX_EVENT = 0xFFFF
+# Bit arrays are grown in blocks of this many bytes
+_BLOCK = 32
+
+
+class _BitArrays:
+    """State and known bits for up to 65536 events"""
+    __slots__ = ("state", "known")
+
+    def __init__ (self, size: int = 0) -> None:
+        self.state = bytearray(size)
+        self.known = bytearray(size)
+
+    def grow (self, size: int) -> None:
+        extra = size - len(self.state)
+        if extra > 0:
+            self.state.extend(bytes(extra))
+            self.known.extend(bytes(extra))
+
+    def get (self, number: int) -> Optional[bool]:
+        index = number >> 3
+        if index >= len(self.known):
+            return None
+        mask = 1 << (number & 7)
+        if not self.known[index] & mask:
+            return None
+        return bool(self.state[index] & mask)
+
+    def items (self):
+        """Yield (number, state) for each known event"""
+        for index, known in enumerate(self.known):
+            if not known:
+                continue
+            state = self.state[index]
+            for bit in range(8):
+                if known & (1 << bit):
+                    yield ((index << 3) + bit, bool(state & (1 << bit)))
+
+    def count (self) -> int:
+        return sum(bin(known).count("1") for known in self.known if known)
+
+
+class AccessoryStateTable:
+    """Current state of the accessory events on the layout
+
+    Can be used as a CanUSB4 listener: usb.add_listener(table.record)
+    Frames in both directions are used, so events sent by this
+    controller are also included.
+
+    Listeners are called with (node, event, state) when an event changes
+    state (including the first time it is seen). node is None for short
+    events, where event is the device number.
+
+    Attributes:
+        updates: Number of accessory events received
+    """
+    def __init__ (self) -> None:
+        """Inits AccessoryStateTable"""
+        self._long: Dict[int, _BitArrays] = {}
+        self._short = _BitArrays((MAX_EVENT >> 3) + 1)
+        self._listeners: List[Callable[[Optional[int], int, bool], None]] = []
+        self._lock = threading.Lock()
+        self.updates = 0
+
+    def add_listener (self, listener: Callable[[Optional[int], int, bool], None]) -> None:
+        """Add a function called with (node, event, state) when an event changes"""
+        self._listeners.append(listener)
+
+    def remove_listener (self, listener: Callable[[Optional[int], int, bool], None]) -> None:
+        """Remove a listener added with add_listener"""
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Update from a frame (signature matches CanUSB4.add_listener)"""
+        self.update(packet)
+
+    def update (self, packet: Union[str, bytes]) -> bool:
+        """Update from a frame if it is an accessory event
+
+        Returns:
+            Bool: True if the state of an event changed
+        """
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 18 or packet[1] != "S":
+            return False
+        try:
+            details = accessory_opcodes.get(int(packet[7:9], 16))
+            if details is None:
+                return False
+            node = int(packet[9:13], 16)
+            event = int(packet[13:17], 16)
+        except ValueError:
+            return False
+        short, state = details
+        if short:
+            return self.set_short(event, state)
+        return self.set(node, event, state)
+
+    def set (self, node: int, event: int, state: bool) -> bool:
+        """Set the state of a long event
+
+        Returns:
+            Bool: True if the state changed (or was not known)
+        """
+        with self._lock:
+            arrays = self._long.get(node)
+            if arrays is None:
+                arrays = _BitArrays()
+                self._long[node] = arrays
+            self.updates += 1
+            changed = self._set(arrays, event, state)
+        if changed:
+            self._changed(node, event, state)
+        return changed
+
+    def set_short (self, device: int, state: bool) -> bool:
+        """Set the state of a short event
+
+        Returns:
+            Bool: True if the state changed (or was not known)
+        """
+        with self._lock:
+            self.updates += 1
+            changed = self._set(self._short, device, state)
+        if changed:
+            self._changed(None, device, state)
+        return changed
+
+    # Must be called with the lock held
+    def _set (self, arrays: _BitArrays, number: int, state: bool) -> bool:
+        if number < 0 or number > MAX_EVENT:
+            raise ValueError(f"Event number needs to be between 0 and {MAX_EVENT}. Value provided {number}")
+        index = number >> 3
+        if index >= len(arrays.known):
+            arrays.grow(min((index // _BLOCK + 1) * _BLOCK, (MAX_EVENT >> 3) + 1))
+        mask = 1 << (number & 7)
+        known = arrays.known[index] & mask
+        current = arrays.state[index] & mask
+        if state:
+            if known and current:
+                return False
+            arrays.state[index] |= mask
+        else:
+            if known and not current:
+                return False
+            arrays.state[index] &= ~mask
+        arrays.known[index] |= mask
+        return True
+
+    def _changed (self, node: Optional[int], event: int, state: bool) -> None:
+        for listener in self._listeners:
+            try:
+                listener(node, event, state)
+            except Exception:
+                logger.exception("Error in accessory state listener")
+
+    def state (self, node: int, event: int) -> Optional[bool]:
+        """State of a long event
+
+        Returns:
+            True if on, False if off or None if not known
+        """
+        arrays = self._long.get(node)
+        if arrays is None:
+            return None
+        return arrays.get(event)
+
+    def short_state (self, device: int) -> Optional[bool]:
+        """State of a short event (device number)
+
+        Returns:
+            True if on, False if off or None if not known
+        """
+        return self._short.get(device)
+
+    def __len__ (self) -> int:
+        """Number of events where the state is known"""
+        with self._lock:
+            return sum(arrays.count() for arrays in self._long.values()) + self._short.count()
+
+    def nodes (self) -> List[int]:
+        """Nodes which have sent long events"""
+        return sorted(self._long)
+
+    def node_states (self, node: int) -> Dict[int, bool]:
+        """States of the long events for a node indexed by event number"""
+        with self._lock:
+            arrays = self._long.get(node)
+            return dict(arrays.items()) if arrays is not None else {}
+
+    def snapshot (self) -> Dict[str, Dict]:
+        """Copy of all known states
+
+        Returns:
+            Dict with 'long' - dict of state indexed by (node, event) and
+            'short' - dict of state indexed by device number
+        """
+        with self._lock:
+            long_states: Dict[Tuple[int, int], bool] = {}
+            for node, arrays in self._long.items():
+                for event, state in arrays.items():
+                    long_states[(node, event)] = state
+            short_states = dict(self._short.items())
+        return {'long': long_states, 'short': short_states}
+
+    def load (self, snapshot: Dict[str, Dict]) -> None:
+        """Set the states from a snapshot (listeners are not called and updates is not changed)"""
+        with self._lock:
+            for (node, event), state in snapshot.get('long', {}).items():
+                arrays = self._long.get(node)
+                if arrays is None:
+                    arrays = _BitArrays()
+                    self._long[node] = arrays
+                self._set(arrays, event, state)
+            for device, state in snapshot.get('short', {}).items():
+                self._set(self._short, device, state)
+
+    def clear (self) -> None:
+        """Forget all states"""
+        with self._lock:
+            self._long.clear()
+            self._short = _BitArrays((MAX_EVENT >> 3) + 1)
@@ -0,0 +1,86 @@
+""" Cache of decoded packets for repeated traffic """
+
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, Union
+from .vlcbformat import VLCBFormat, FrozenVLCBFormat, VLCBOpcode
+
+
+class DecodeCache:
+    """Bounded LRU cache of decoded packets
+
+    Much of the bus traffic repeats exactly (eg. DKEEP, DSPD at constant
+    speed, ACON / ACOF polling). The cache is keyed on the raw packet
+    (or data string) and returns read only results, so a repeated packet
+    is only decoded once. Least recently used entries are removed when
+    maxsize is reached.
+
+    Normally created by VLCB using the cache_size argument.
+
+    Attributes:
+        maxsize: Maximum number of entries (for each of parse_input and parse_data)
+    """
+    def __init__ (self, parse_input: Callable[[Union[str, bytes]], VLCBFormat], maxsize: int = 1024) -> None:
+        """Inits DecodeCache
+
+        Args:
+            parse_input: Function used to parse a packet not in the cache (eg. VLCB.parse_input)
+            maxsize: Maximum number of entries
+        """
+        if maxsize < 1:
+            raise ValueError(f"Cache size must be at least 1, not {maxsize}")
+        self.maxsize = maxsize
+        self._parse = parse_input
+        self._parse_input = lru_cache(maxsize=maxsize)(self._decode_input)
+        self._parse_data = lru_cache(maxsize=maxsize)(self._decode_data)
+
+    def _decode_input (self, input_bytes: Union[str, bytes]) -> FrozenVLCBFormat:
+        packet = self._parse(input_bytes)
+        return FrozenVLCBFormat(packet.priority, packet.can_id, packet.data)
+
+    @staticmethod
+    def _decode_data (data: str) -> Mapping[str, Any]:
+        return MappingProxyType(VLCBOpcode.parse_data(data))
+
+    def parse_input (self, input_bytes: Union[str, bytes]) -> FrozenVLCBFormat:
+        """Parse a raw packet, using the cached result if available
+
+        Args:
+            input_bytes: Input raw bytestring (or string)
+
+        Returns:
+            FrozenVLCBFormat: Read only packet (shared between calls)
+
+        Raises:
+            ValueError: If invalid data string (errors are not cached)
+        """
+        return self._parse_input(input_bytes)
+
+    def parse_data (self, data: str) -> Mapping[str, Any]:
+        """Cached version of VLCBOpcode.parse_data
+
+        Args:
+            data: Data string including the opcode
+
+        Returns:
+            Mapping: Read only dict in OpcodeData format
+        """
+        return self._parse_data(data)
+
+    @property
+    def hits (self) -> int:
+        """Number of requests returned from the cache"""
+        return self._parse_input.cache_info().hits + self._parse_data.cache_info().hits
+
+    @property
+    def misses (self) -> int:
+        """Number of requests which needed to be decoded"""
+        return self._parse_input.cache_info().misses + self._parse_data.cache_info().misses
+
+    def __len__ (self) -> int:
+        return self._parse_input.cache_info().currsize + self._parse_data.cache_info().currsize
+
+    def clear (self) -> None:
+        """Remove all entries and reset the hit and miss counters"""
+        self._parse_input.cache_clear()
+        self._parse_data.cache_clear()
@@ -1,5 +1,5 @@
 import serial
-from typing import List, Optional, Union
+from typing import Callable, List, Optional, Union
 from .exceptions import DeviceConnectionError, InvalidConfigurationError, ProtocolError, DeviceTimeoutError
 import logging
 
@@ -7,6 +7,10 @@ import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Direction passed to listeners
+DIRECTION_RX = "RX"
+DIRECTION_TX = "TX"
+
 # Based on CANUSB4 - sends using pyserial
 # This just makes calls to pyserial, but by abstracting would mean you could
 # replace easier if using a different way to connect to CANBUS
@@ -54,6 +58,8 @@ class CanUSB4 ():
         self.current_buffer = ''
         # Track if we are in a valid string (ie. ignore any data outside of : ; blocks
         self.data_start = False
+        # Functions called with (direction, packet) for every packet sent / received
+        self.listeners = ()
         self.connect()
         
         
@@ -98,6 +104,36 @@ class CanUSB4 ():
             logger.info("Connected to serial port")
 
 
+    def add_listener(self, listener: Callable[[str, str], None]) -> None:
+        """Add a function to be called for each packet sent or received
+
+        The listener is called with the direction (DIRECTION_RX or
+        DIRECTION_TX) and the packet as a string. It is called from the
+        thread calling send_data / read_data so should return quickly.
+        Exceptions raised by a listener are logged and ignored.
+
+        Args:
+            listener: Function called with (direction, packet)
+        """
+        # Replace rather than modify so changes are safe during a read
+        self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener: Callable[[str, str], None]) -> None:
+        """Remove a listener added using add_listener
+
+        Args:
+            listener: Function previously added
+        """
+        self.listeners = tuple(entry for entry in self.listeners if entry != listener)
+
+    # A failing listener must not stop the other listeners or lose the packets read
+    def _notify(self, direction: str, packet: str) -> None:
+        for listener in self.listeners:
+            try:
+                listener(direction, packet)
+            except Exception:
+                logger.exception("Error in listener")
+
     # Data can either be string or bytestring
     def send_data(self, data: Union[str, bytes]) -> None:
         """Send data to serial
@@ -110,7 +146,7 @@ class CanUSB4 ():
             TypeError: If data passed is not a string or a bytestring
             DeviceConnectionError: Error sending data - possible connection lost
         """
-        logger.debug(f"Sending {data}")
+        logger.debug("Sending %s", data)
         if isinstance(data, str):
             try:
                 # Convert string to bytes
@@ -129,6 +165,9 @@ class CanUSB4 ():
             self.ser.write(payload)
         except serial.SerialException as e:
             raise DeviceConnectionError("Connection lost during write") from e
+        if self.listeners:
+            packet = data if isinstance(data, str) else payload.decode('ascii', 'replace')
+            self._notify(DIRECTION_TX, packet)
     
     def read_data(self) -> List[str]:
         """Read data from CanUSB4
@@ -166,7 +205,7 @@ class CanUSB4 ():
                         continue
                     # Add the terminating char
                     self.current_buffer += this_char
-                    logger.debug (f"Read {self.current_buffer}")
+                    logger.debug ("Read %s", self.current_buffer)
                     received_data.append(self.current_buffer)
                     # delete the data
                     self.current_buffer = ''
@@ -182,5 +221,8 @@ class CanUSB4 ():
                 # If not then we are not in data block
                 else:
                     continue
+            if self.listeners:
+                for packet in received_data:
+                    self._notify(DIRECTION_RX, packet)
         return received_data    
         
@@ -0,0 +1,354 @@
+""" Compact binary capture files of bus traffic
+
+A capture file has a 16 byte file header followed by fixed size 24 byte
+records, so any record can be read directly without reading the rest of
+the file. The reader uses mmap so large captures open instantly.
+
+File header (little endian):
+    magic (8 bytes) b'VLCBCAP\\0', version (uint16), record size (uint16), reserved (uint32)
+
+Record (little endian):
+    timestamp (float64 seconds since epoch), header (uint32),
+    direction (uint8), flags (uint8), data (8 bytes), padding (2 bytes)
+
+For standard frames the header is the 16 bit value from the packet
+(eg. 0xB780 for :SB780N). Flags bits 0 to 3 are the number of data
+bytes, bit 4 is set for an extended frame and bit 5 for an RTR frame.
+"""
+
+import mmap
+import struct
+from datetime import datetime
+from typing import Any, Iterator, List, NamedTuple, Optional, Tuple, Union
+from .canusb import DIRECTION_RX, DIRECTION_TX
+from .exceptions import ProtocolError
+from .logs import iter_lines
+
+MAGIC = b'VLCBCAP\x00'
+VERSION = 1
+
+FLAG_LENGTH = 0x0F
+FLAG_EXTENDED = 0x10
+FLAG_RTR = 0x20
+
+# Direction is stored as a number
+DIRECTION_OTHER = "??"
+_directions = (DIRECTION_RX, DIRECTION_TX, DIRECTION_OTHER)
+_direction_codes = {DIRECTION_RX: 0, DIRECTION_TX: 1}
+
+_file_header = struct.Struct('<8sHHI')
+_record = struct.Struct('<dIBB8s2x')
+
+# Records copied from the file at a time when iterating
+ITER_BLOCK = 4096
+
+HEADER_SIZE = _file_header.size
+RECORD_SIZE = _record.size
+
+
+class CaptureRecord (NamedTuple):
+    """A single record from a capture file"""
+    timestamp: float
+    direction: str
+    header: int
+    flags: int
+    data: bytes
+
+    @property
+    def packet (self) -> str:
+        """Packet in the same format as received from CanUSB4 eg. ':SB780N2301;'"""
+        return record_to_packet(self.header, self.flags, self.data)
+
+
+def packet_to_record (packet: Union[str, bytes]) -> Tuple[int, int, bytes]:
+    """Convert a packet string to header, flags and data
+
+    Args:
+        packet: Packet eg. ':SB780N2301;'
+
+    Returns:
+        Tuple of (header, flags, data)
+
+    Raises:
+        ValueError: If the packet is not valid
+    """
+    if not isinstance(packet, str):
+        packet = packet.decode('ascii')
+    if len(packet) < 3 or packet[0] != ":" or packet[-1] != ";":
+        raise ValueError(f"Invalid packet {packet}")
+    if packet[1] == "S":
+        header_chars = 4
+        flags = 0
+    elif packet[1] == "X":
+        header_chars = 8
+        flags = FLAG_EXTENDED
+    else:
+        raise ValueError(f"Invalid packet {packet}")
+    header = int(packet[2:2 + header_chars], 16)
+    if packet[2 + header_chars] == "R":
+        flags |= FLAG_RTR
+    data = bytes.fromhex(packet[3 + header_chars:-1])
+    if len(data) > 8:
+        raise ValueError(f"Too much data in packet {packet}")
+    return (header, flags | len(data), data)
+
+
+def record_to_packet (header: int, flags: int, data: bytes) -> str:
+    """Convert header, flags and data back to a packet string"""
+    rtr = "R" if flags & FLAG_RTR else "N"
+    data_string = data[:flags & FLAG_LENGTH].hex().upper()
+    if flags & FLAG_EXTENDED:
+        return f":X{header:08X}{rtr}{data_string};"
+    return f":S{header:04X}{rtr}{data_string};"
+
+
+class CaptureWriter:
+    """Write packets to a capture file
+
+    Can be used as a CanUSB4 listener: usb.add_listener(writer.record)
+    Use as a context manager or call close when finished.
+    """
+    def __init__ (self, filename: str, append: bool = False, buffer_size: int = 1 << 16) -> None:
+        """Inits CaptureWriter and writes the file header
+
+        Args:
+            filename: Capture file
+            append: Add to an existing capture instead of creating a new file
+            buffer_size: Size of the write buffer
+        """
+        self.filename = filename
+        self.count = 0
+        if append:
+            # Check existing header before adding to the file
+            with open(filename, "rb") as f:
+                _check_header(f.read(HEADER_SIZE))
+            self._file = open(filename, "ab", buffering=buffer_size)
+        else:
+            self._file = open(filename, "wb", buffering=buffer_size)
+            self._file.write(_file_header.pack(MAGIC, VERSION, RECORD_SIZE, 0))
+
+    def write (self, timestamp: float, direction: str, packet: Union[str, bytes]) -> None:
+        """Write a packet
+
+        Args:
+            timestamp: Time in seconds since the epoch
+            direction: DIRECTION_RX or DIRECTION_TX
+            packet: Packet eg. ':SB780N2301;'
+
+        Raises:
+            ValueError: If the packet is not valid
+        """
+        header, flags, data = packet_to_record(packet)
+        self._file.write(_record.pack(timestamp, header, _direction_codes.get(direction, 2), flags, data))
+        self.count += 1
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Write a packet with the current time (signature matches CanUSB4.add_listener)"""
+        self.write(datetime.now().timestamp(), direction, packet)
+
+    def flush (self) -> None:
+        """Write any buffered records to the file"""
+        self._file.flush()
+
+    def close (self) -> None:
+        """Close the file"""
+        self._file.close()
+
+    def __enter__ (self) -> "CaptureWriter":
+        return self
+
+    def __exit__ (self, *args) -> None:
+        self.close()
+
+
+def _check_header (data: bytes) -> None:
+    if len(data) < HEADER_SIZE:
+        raise ProtocolError("Capture file is too short")
+    magic, version, record_size, reserved = _file_header.unpack_from(data)
+    if magic != MAGIC:
+        raise ProtocolError("Not a capture file")
+    if version != VERSION or record_size != RECORD_SIZE:
+        raise ProtocolError(f"Unsupported capture version {version} record size {record_size}")
+
+
+class CaptureReader:
+    """Read a capture file using mmap
+
+    Records can be accessed by index (reader[10]) or iterated. Only the
+    records which are accessed are read from the file.
+
+    The view returned by buffer refers to the file, so close releases it.
+    Anything created from the view (eg. a numpy array) must be deleted
+    before close, otherwise close raises BufferError.
+    """
+    def __init__ (self, filename: str) -> None:
+        """Inits CaptureReader
+
+        Args:
+            filename: Capture file
+
+        Raises:
+            ProtocolError: If the file is not a supported capture file
+        """
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            _check_header(self._file.read(HEADER_SIZE))
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        # Ignore any partly written record at the end
+        self._count = (len(self._map) - HEADER_SIZE) // RECORD_SIZE
+        # Views returned by buffer (released by close)
+        self._views: List[memoryview] = []
+
+    def __len__ (self) -> int:
+        return self._count
+
+    def __getitem__ (self, index: int) -> CaptureRecord:
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("Capture record out of range")
+        timestamp, header, direction, flags, data = _record.unpack_from(self._map, HEADER_SIZE + index * RECORD_SIZE)
+        return CaptureRecord(timestamp, _directions[min(direction, 2)], header, flags, data[:flags & FLAG_LENGTH])
+
+    def __iter__ (self) -> Iterator[CaptureRecord]:
+        return self.iter_records()
+
+    def iter_records (self, start: int = 0, stop: Optional[int] = None) -> Iterator[CaptureRecord]:
+        """Iterate over records
+
+        Args:
+            start: First record index
+            stop: Stop before this index (None for end of file)
+        """
+        stop = self._count if stop is None else min(stop, self._count)
+        # Blocks are copied rather than using a view so the file can be
+        # closed even if the iterator is not finished
+        for block in range(start, stop, ITER_BLOCK):
+            records = self._map[HEADER_SIZE + block * RECORD_SIZE:HEADER_SIZE + min(block + ITER_BLOCK, stop) * RECORD_SIZE]
+            for timestamp, header, direction, flags, data in _record.iter_unpack(records):
+                yield CaptureRecord(timestamp, _directions[min(direction, 2)], header, flags, data[:flags & FLAG_LENGTH])
+
+    def iter_packets (self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[float, str, str]]:
+        """Iterate over packets as strings ready for VLCB.parse_input
+
+        Returns:
+            Iterator of (timestamp, direction, packet)
+        """
+        for record in self.iter_records(start, stop):
+            yield (record.timestamp, record.direction, record_to_packet(record.header, record.flags, record.data))
+
+    def iter_decoded (self, vlcb, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[float, str, Any]]:
+        """Iterate over packets decoded by VLCB.parse_input
+
+        If the VLCB object has a cache then repeated packets are only decoded once.
+
+        Args:
+            vlcb: VLCB object used to decode the packets
+            start: First record index
+            stop: Stop before this index (None for end of file)
+
+        Returns:
+            Iterator of (timestamp, direction, VLCBFormat)
+        """
+        parse_input = vlcb.parse_input
+        for timestamp, direction, packet in self.iter_packets(start, stop):
+            yield (timestamp, direction, parse_input(packet))
+
+    def timestamp (self, index: int) -> float:
+        """Timestamp of a record (only reads the timestamp)"""
+        return struct.unpack_from('<d', self._map, HEADER_SIZE + index * RECORD_SIZE)[0]
+
+    def find_time (self, timestamp: float) -> int:
+        """Index of the first record at or after timestamp
+
+        Uses a binary search so records must be in time order.
+
+        Returns:
+            Int: Record index (len(reader) if all records are earlier)
+        """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @property
+    def buffer (self) -> memoryview:
+        """Read only view of all the records (eg. for numpy.frombuffer)
+
+        The view can not be used after close.
+        """
+        view = memoryview(self._map)[HEADER_SIZE:HEADER_SIZE + self._count * RECORD_SIZE]
+        self._views.append(view)
+        return view
+
+    def close (self) -> None:
+        """Close the file
+
+        Raises:
+            BufferError: If something created from buffer is still in use
+        """
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._map.close()
+        self._file.close()
+
+    def __enter__ (self) -> "CaptureReader":
+        return self
+
+    def __exit__ (self, *args) -> None:
+        self.close()
+
+
+def _parse_date (date_string: str) -> float:
+    try:
+        return datetime.strptime(date_string, "%Y-%m-%d %H:%M:%S.%f").timestamp()
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(date_string).timestamp()
+    except ValueError:
+        return float(date_string)
+
+
+def log_to_capture (log_filename: str, capture_filename: str) -> int:
+    """Convert a text log (num,date,direction,message) to a capture file
+
+    Lines with an invalid date or packet are skipped.
+
+    Returns:
+        Int: Number of packets written
+    """
+    with CaptureWriter(capture_filename) as writer:
+        for line in iter_lines(log_filename):
+            parts = line.split(',', 3)
+            if len(parts) < 4:
+                continue
+            try:
+                writer.write(_parse_date(parts[1]), parts[2], parts[3])
+            except ValueError:
+                continue
+        return writer.count
+
+
+def capture_to_log (capture_filename: str, log_filename: str) -> int:
+    """Convert a capture file to a text log (num,date,direction,message)
+
+    Returns:
+        Int: Number of packets written
+    """
+    count = 0
+    with CaptureReader(capture_filename) as reader, open(log_filename, "w") as f:
+        for timestamp, direction, packet in reader.iter_packets():
+            date_string = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            f.write(f"{count},{date_string},{direction},{packet}\n")
+            count += 1
+    return count
@@ -0,0 +1,184 @@
+""" Speed command coalescing
+
+DSPD should be sent at most once every 32 milliseconds for each session.
+SpeedCoalescer sends a speed change straight away if the window has
+passed, otherwise it keeps only the newest value for the session and
+sends it when the window ends. However quickly the speed is changed there
+is at most one DSPD per session per window. An emergency stop (speed 1)
+is always sent immediately.
+
+Commands are sent while holding the lock, so a speed taken from the
+waiting values can never be sent after an emergency stop for the session
+(which would start the loco again).
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Minimum time between DSPD for a session
+SPEED_WINDOW = 0.032
+
+# Speed step for emergency stop
+EMERGENCY_STOP = 1
+
+
+class SpeedCoalescer:
+    """Limit speed commands to one per session per window
+
+    Call poll regularly to send waiting values (or use start to send them
+    from a background thread).
+
+    Attributes:
+        window: Minimum time between speed commands for a session
+        sent: Number of commands sent
+        coalesced: Number of values replaced by a newer value before they were sent
+    """
+    def __init__ (self, vlcb, transport, window: float = SPEED_WINDOW,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits SpeedCoalescer
+
+        Args:
+            vlcb: VLCB object used to create the requests
+            transport: Object with a send_data method (eg. CanUSB4)
+            window: Minimum time between speed commands for a session (default 32ms)
+            clock: Function returning the current time in seconds
+        """
+        self.vlcb = vlcb
+        self.transport = transport
+        self.window = window
+        self.clock = clock
+        self.sent = 0
+        self.coalesced = 0
+        # Time last sent and value waiting for each session
+        self._last_sent: Dict[int, float] = {}
+        self._pending: Dict[int, int] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def set_speeddir (self, session_id: int, speeddir: int) -> bool:
+        """Set loco speed and direction
+
+        Args:
+            session_id: Session ID
+            speeddir: Unsigned 8 bit number. MSB is direction, 7 bits for speed
+
+        Returns:
+            Bool: True if sent now, False if waiting for the end of the window
+
+        Raises:
+            ValueError: If speeddir is not 0 to 255
+        """
+        if speeddir < 0 or speeddir > 0xFF:
+            raise ValueError(f"Speed and direction needs to be between 0 and 255. Value provided {speeddir}")
+        with self._condition:
+            now = self.clock()
+            last_sent = self._last_sent.get(session_id)
+            if ((speeddir & 0x7F) != EMERGENCY_STOP and last_sent is not None
+                    and now - last_sent < self.window):
+                if session_id in self._pending:
+                    self.coalesced += 1
+                self._pending[session_id] = speeddir
+                self._condition.notify()
+                return False
+            # Emergency stop also replaces any waiting value
+            self._pending.pop(session_id, None)
+            self._last_sent[session_id] = now
+            self.sent += 1
+            self.transport.send_data(self.vlcb.loco_speeddir(session_id, speeddir))
+        return True
+
+    def set_speed (self, session_id: int, speed: int, direction: int) -> bool:
+        """Set loco speed (0 to 127) and direction (1 forward, 0 reverse)
+
+        Speed 1 is increased to 2 to avoid emergency stop (use emergency_stop).
+
+        Returns:
+            Bool: True if sent now, False if waiting for the end of the window
+        """
+        if speed < 0 or speed > 127:
+            raise ValueError(f"Speed needs to be between 0 and 127. Value provided {speed}")
+        # special case - ignore emergency stop
+        if speed == EMERGENCY_STOP:
+            speed = 2
+        return self.set_speeddir(session_id, (0x80 if direction else 0) | speed)
+
+    def emergency_stop (self, session_id: int, direction: int = 1) -> None:
+        """Stop a loco immediately (ignores the window)"""
+        self.set_speeddir(session_id, (0x80 if direction else 0) | EMERGENCY_STOP)
+
+    def remove_session (self, session_id: int) -> None:
+        """Forget a session (eg. after it is released) - any waiting value is not sent"""
+        with self._condition:
+            self._pending.pop(session_id, None)
+            self._last_sent.pop(session_id, None)
+
+    def pending (self) -> Dict[int, int]:
+        """Copy of the values waiting to be sent for each session"""
+        with self._condition:
+            return dict(self._pending)
+
+    # Must be called with the condition held - returns (number sent, time until next value is due)
+    def _send_due (self, now: float, log_errors: bool = False) -> Tuple[int, Optional[float]]:
+        sent = 0
+        next_due = None
+        for session_id, speeddir in list(self._pending.items()):
+            wait = self._last_sent[session_id] + self.window - now
+            if wait <= 0:
+                del self._pending[session_id]
+                self._last_sent[session_id] = now
+                self.sent += 1
+                sent += 1
+                try:
+                    self.transport.send_data(self.vlcb.loco_speeddir(session_id, speeddir))
+                except Exception:
+                    if not log_errors:
+                        raise
+                    logger.exception("Error sending speed for session %s", session_id)
+            elif next_due is None or wait < next_due:
+                next_due = wait
+        return sent, next_due
+
+    def poll (self) -> int:
+        """Send any waiting values where the window has ended
+
+        Returns:
+            Int: Number of commands sent
+        """
+        with self._condition:
+            if not self._pending:
+                return 0
+            return self._send_due(self.clock())[0]
+
+    def start (self) -> None:
+        """Send waiting values from a background thread as each window ends"""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="SpeedCoalescer", daemon=True)
+        self._thread.start()
+
+    def _run (self) -> None:
+        with self._condition:
+            while self._running:
+                sent, next_due = self._send_due(self.clock(), log_errors=True) if self._pending else (0, None)
+                if not sent:
+                    # Wait until a value is due or a new value is added
+                    self._condition.wait(next_due)
+
+    def stop (self) -> None:
+        """Stop the background thread (waiting values are not sent)"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
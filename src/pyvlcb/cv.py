@@ -0,0 +1,493 @@
+""" Service mode CV programming
+
+Reads and writes decoder CVs on the programming track using QCVS / PCVS
+and WCVS / SSTAT. Operations are queued and each is sent as soon as the
+previous one has finished, so a whole CV sheet can be read or written
+without waiting between requests. The command station only programs one
+CV at a time and SSTAT does not include the CV, so only one operation is
+in progress at a time.
+
+Values are cached for each decoder address (CVCache), and write_profile
+only writes the CVs which are different from the target profile.
+"""
+
+import json
+import os
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Mapping, Optional, Union
+from .canusb import DIRECTION_TX
+from .vlcbformat import VLCBOpcode
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+OPCODE_SSTAT = 0x4C
+OPCODE_ERR = 0x63
+OPCODE_PCVS = 0x85
+
+# Service modes
+MODE_DIRECT_BYTE = 0
+MODE_DIRECT_BIT = 1
+MODE_PAGED = 2
+MODE_REGISTER = 3
+MODE_ADDRESS = 4
+
+# SSTAT status codes
+SSTAT_NO_ACK = 1
+SSTAT_OVERLOAD = 2
+SSTAT_WRITE_ACK = 3
+SSTAT_BUSY = 4
+SSTAT_OUT_OF_RANGE = 5
+
+# Status codes where the operation is sent again
+retry_status = (SSTAT_NO_ACK, SSTAT_BUSY)
+
+# ERR codes where Byte1 is a session which is no longer valid
+ERR_SESSION_CODES = (3, 8)
+
+# Status and error text indexed by int value
+sstat_text = {int(code, 16): text for code, text in VLCBOpcode.sstat_codes.items()}
+dcc_errors = {int(code, 16): text for code, text in VLCBOpcode.dcc_error_codes.items()}
+
+# Operation status
+STATUS_PENDING = "pending"
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+
+KIND_READ = "read"
+KIND_WRITE = "write"
+
+# CVs which hold the decoder address
+CV_SHORT_ADDRESS = 1
+CV_LONG_ADDRESS_HIGH = 17
+CV_LONG_ADDRESS_LOW = 18
+CV_CONFIG = 29
+address_cvs = (CV_SHORT_ADDRESS, CV_LONG_ADDRESS_HIGH, CV_LONG_ADDRESS_LOW, CV_CONFIG)
+
+
+def decoder_address (cvs: Mapping[int, int]) -> Optional[int]:
+    """Decoder address from CV1, CV17, CV18 and CV29
+
+    Returns:
+        Address (long addresses have 0xC000 added as VLCBFormat.get_loco_id)
+        or None if the CVs are not known
+    """
+    config = cvs.get(CV_CONFIG)
+    if config is None:
+        return None
+    if config & 0x20:
+        if CV_LONG_ADDRESS_HIGH not in cvs or CV_LONG_ADDRESS_LOW not in cvs:
+            return None
+        return 0xC000 | ((cvs[CV_LONG_ADDRESS_HIGH] & 0x3F) << 8) | cvs[CV_LONG_ADDRESS_LOW]
+    return cvs.get(CV_SHORT_ADDRESS)
+
+
+class CVCache:
+    """CV values for each decoder address
+
+    Attributes:
+        filename: File used by save (and loaded when created if it exists)
+    """
+    def __init__ (self, filename: Optional[str] = None) -> None:
+        """Inits CVCache
+
+        Args:
+            filename: JSON file to load from and save to
+
+        Raises:
+            ValueError: If the file is not a valid cache
+        """
+        self.filename = filename
+        self._decoders: Dict[int, Dict[int, int]] = {}
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    def get (self, address: int, cv: int) -> Optional[int]:
+        """Cached value of a CV (None if not known)"""
+        return self._decoders.get(address, {}).get(cv)
+
+    def set (self, address: int, cv: int, value: int) -> None:
+        """Set the cached value of a CV"""
+        self._decoders.setdefault(address, {})[cv] = value
+
+    def values (self, address: int) -> Dict[int, int]:
+        """Copy of the cached values for a decoder indexed by CV"""
+        return dict(self._decoders.get(address, {}))
+
+    def addresses (self) -> List[int]:
+        """Decoder addresses in the cache"""
+        return sorted(self._decoders)
+
+    def forget (self, address: int) -> None:
+        """Remove a decoder from the cache"""
+        self._decoders.pop(address, None)
+
+    def save (self, filename: Optional[str] = None) -> None:
+        """Save to a JSON file (replaced in a single step)"""
+        filename = filename or self.filename
+        if filename is None:
+            raise ValueError("No filename for the CV cache")
+        values = {str(address): {str(cv): value for cv, value in sorted(cvs.items())}
+                  for address, cvs in sorted(self._decoders.items())}
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(values, f, indent=1)
+        os.replace(temp_filename, filename)
+
+    def load (self, filename: str) -> None:
+        """Load values from a JSON file saved by save
+
+        Raises:
+            ValueError: If the file is not a valid cache
+        """
+        with open(filename) as f:
+            values = json.load(f)
+        try:
+            for address, cvs in values.items():
+                for cv, value in cvs.items():
+                    self.set(int(address), int(cv), int(value))
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid CV cache {filename}") from e
+
+
+class CVOperation:
+    """A CV read or write
+
+    Attributes:
+        kind: KIND_READ or KIND_WRITE
+        cv: CV number
+        value: Value read or value to write
+        status: STATUS_PENDING, STATUS_OK, STATUS_FAILED or STATUS_TIMEOUT
+        error_code: SSTAT status or ERR code if failed
+        error: Error text
+        attempts: Number of times the request was sent
+        elapsed: Time in seconds from first sent to finished
+    """
+    def __init__ (self, kind: str, cv: int, value: Optional[int] = None) -> None:
+        self.kind = kind
+        self.cv = cv
+        self.value = value
+        self.status = STATUS_PENDING
+        self.error_code: Optional[int] = None
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self.elapsed: Optional[float] = None
+        self.first_sent: Optional[float] = None
+        self.sent = 0.0
+        # Send again after this time (busy)
+        self.not_before = 0.0
+
+    @property
+    def ok (self) -> bool:
+        """True if finished without an error"""
+        return self.status == STATUS_OK
+
+    def __repr__ (self) -> str:
+        error = f" ({self.error})" if self.error else ""
+        return f"CVOperation({self.kind} CV{self.cv} = {self.value}: {self.status}{error})"
+
+
+class CVProgrammer:
+    """Read and write CVs in service mode
+
+    Add operations (read_range, write_profile, add_read or add_write) and
+    then either call run, which reads from the transport until all
+    operations have finished, or pass each received packet to receive (or
+    add record as a CanUSB4 listener) and call poll regularly until it
+    returns True.
+
+    The progress function (if set) is called with the programmer after
+    each operation finishes.
+
+    Attributes:
+        results: CVOperation for each operation in the order added
+        address: Decoder address used for the cache (None to not cache)
+        skipped: Number of CVs in write_profile which already had the value
+    """
+    def __init__ (self,
+                  vlcb,
+                  transport,
+                  session: int,
+                  mode: int = MODE_DIRECT_BYTE,
+                  address: Optional[int] = None,
+                  cache: Optional[CVCache] = None,
+                  timeout: float = 2.0,
+                  retries: int = 2,
+                  busy_delay: float = 0.25,
+                  progress: Optional[Callable[["CVProgrammer"], None]] = None,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits CVProgrammer
+
+        Args:
+            vlcb: VLCB object used to create the requests
+            transport: Object with send_data (and read_data if using run) eg. CanUSB4
+            session: Session used for the service mode requests
+            mode: Service mode (MODE_DIRECT_BYTE etc.)
+            address: Decoder address used for the cache
+            cache: CVCache shared between decoders (a new cache is created if not set)
+            timeout: Time in seconds to wait for each reply
+            retries: Number of times an operation is sent again (no reply, no acknowledge or busy)
+            busy_delay: Time in seconds to wait before sending again if the command station is busy
+            progress: Function called with this programmer after each operation finishes
+            clock: Function returning the current time in seconds
+        """
+        self.vlcb = vlcb
+        self.transport = transport
+        self.session = session
+        self.mode = mode
+        self.address = address
+        self.cache = cache if cache is not None else CVCache()
+        self.timeout = timeout
+        self.retries = retries
+        self.busy_delay = busy_delay
+        self.progress = progress
+        self.clock = clock
+        self.results: List[CVOperation] = []
+        self.skipped = 0
+        self._queue: Deque[CVOperation] = deque()
+        self._inflight: Optional[CVOperation] = None
+        # Target values for CVs which are read before writing
+        self._profile: Dict[int, int] = {}
+        self._started: Optional[float] = None
+        self._finished_time: Optional[float] = None
+
+    def add_read (self, cv: int) -> CVOperation:
+        """Add a CV read"""
+        operation = CVOperation(KIND_READ, cv)
+        self._add(operation)
+        return operation
+
+    def add_write (self, cv: int, value: int) -> CVOperation:
+        """Add a CV write
+
+        Raises:
+            ValueError: If the value is not 0 to 255
+        """
+        if value < 0 or value > 0xFF:
+            raise ValueError(f"CV value needs to be between 0 and 255. Value provided {value}")
+        operation = CVOperation(KIND_WRITE, cv, value)
+        self._add(operation)
+        return operation
+
+    def _add (self, operation: CVOperation) -> None:
+        self.results.append(operation)
+        self._queue.append(operation)
+        self._finished_time = None
+
+    def read_range (self, first: int, last: int) -> List[CVOperation]:
+        """Add reads for CVs first to last (inclusive)"""
+        return [self.add_read(cv) for cv in range(first, last + 1)]
+
+    def write_profile (self, profile: Mapping[int, int], use_cache: bool = True) -> List[CVOperation]:
+        """Write the CVs which are different from a profile
+
+        CVs with a cached value (if use_cache) are compared with the
+        cache, otherwise the CV is read first and only written if the
+        value is different.
+
+        Args:
+            profile: Target value for each CV
+            use_cache: Use cached values rather than reading the CVs
+
+        Returns:
+            List of CVOperation added (writes may also be added later
+            after a read)
+
+        Raises:
+            ValueError: If a value is not 0 to 255 (nothing is added)
+        """
+        # Check all the values first as writes after a read are added from receive
+        for cv, value in profile.items():
+            if value < 0 or value > 0xFF:
+                raise ValueError(f"CV{cv} value needs to be between 0 and 255. Value provided {value}")
+        added = []
+        for cv, value in sorted(profile.items()):
+            current = self.cache.get(self.address, cv) if use_cache and self.address is not None else None
+            if current is None:
+                self._profile[cv] = value
+                added.append(self.add_read(cv))
+            elif current != value:
+                added.append(self.add_write(cv, value))
+            else:
+                self.skipped += 1
+        return added
+
+    @property
+    def total (self) -> int:
+        """Number of operations"""
+        return len(self.results)
+
+    @property
+    def completed (self) -> int:
+        """Number of operations finished (including failed)"""
+        return sum(1 for operation in self.results if operation.status != STATUS_PENDING)
+
+    @property
+    def failed (self) -> int:
+        """Number of operations which failed or timed out"""
+        return sum(1 for operation in self.results if operation.status in (STATUS_FAILED, STATUS_TIMEOUT))
+
+    def elapsed (self) -> float:
+        """Time in seconds since the first operation was sent"""
+        if self._started is None:
+            return 0.0
+        end = self._finished_time if self._finished_time is not None else self.clock()
+        return end - self._started
+
+    def throughput (self) -> float:
+        """Operations finished per second"""
+        elapsed = self.elapsed()
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def stats (self) -> Dict[str, Union[int, float]]:
+        """Progress as a dict of total, completed, failed, skipped, elapsed and throughput"""
+        return {
+            'total': self.total,
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'elapsed': self.elapsed(),
+            'throughput': self.throughput()
+        }
+
+    def values (self) -> Dict[int, int]:
+        """Values read or written successfully indexed by CV"""
+        return {operation.cv: operation.value for operation in self.results
+                if operation.ok and operation.value is not None}
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Check a received frame (signature matches CanUSB4.add_listener)"""
+        if direction != DIRECTION_TX:
+            self.receive(packet)
+
+    def receive (self, packet: Union[str, bytes]) -> None:
+        """Check a received frame for a reply"""
+        operation = self._inflight
+        if operation is None:
+            return
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 12 or packet[1] != "S":
+            return
+        try:
+            opcode = int(packet[7:9], 16)
+            data = bytes.fromhex(packet[9:-1])
+        except ValueError:
+            return
+        now = self.clock()
+        if opcode == OPCODE_PCVS and len(data) >= 4 and data[0] == self.session:
+            if operation.kind == KIND_READ and (data[1] << 8) + data[2] == operation.cv:
+                operation.value = data[3]
+                self._succeeded(operation, now)
+        elif opcode == OPCODE_SSTAT and len(data) >= 2 and data[0] == self.session:
+            status = data[1]
+            if status == SSTAT_WRITE_ACK:
+                if operation.kind == KIND_WRITE:
+                    self._succeeded(operation, now)
+            elif status in retry_status and operation.attempts <= self.retries:
+                logger.debug("CV%s %s - sending again", operation.cv, sstat_text.get(status))
+                self._inflight = None
+                operation.not_before = now + (self.busy_delay if status == SSTAT_BUSY else 0.0)
+                self._queue.appendleft(operation)
+            else:
+                self._failed(operation, status, sstat_text.get(status, "Unknown status"), now)
+                if status == SSTAT_OVERLOAD:
+                    # Do not carry on with a short on the programming track
+                    self._fail_all(status, sstat_text[status], now)
+        elif opcode == OPCODE_ERR and len(data) >= 3 and data[0] == self.session and data[2] in ERR_SESSION_CODES:
+            self._failed(operation, data[2], dcc_errors[data[2]], now)
+            self._fail_all(data[2], dcc_errors[data[2]], now)
+
+    def _succeeded (self, operation: CVOperation, now: float) -> None:
+        self._inflight = None
+        operation.status = STATUS_OK
+        operation.elapsed = now - operation.first_sent
+        if self.address is not None:
+            self.cache.set(self.address, operation.cv, operation.value)
+        target = self._profile.pop(operation.cv, None) if operation.kind == KIND_READ else None
+        if target is not None:
+            if target != operation.value:
+                self.add_write(operation.cv, target)
+            else:
+                self.skipped += 1
+        self._report()
+
+    def _failed (self, operation: CVOperation, code: Optional[int], error: str, now: float) -> None:
+        self._inflight = None
+        operation.status = STATUS_TIMEOUT if code is None else STATUS_FAILED
+        operation.error_code = code
+        operation.error = error
+        if operation.first_sent is not None:
+            operation.elapsed = now - operation.first_sent
+        self._profile.pop(operation.cv, None)
+        logger.warning("CV%s %s failed: %s", operation.cv, operation.kind, error)
+        self._report()
+
+    # Stop all waiting operations
+    def _fail_all (self, code: int, error: str, now: float) -> None:
+        while self._queue:
+            self._failed(self._queue.popleft(), code, error, now)
+
+    def _report (self) -> None:
+        if self.progress is not None:
+            try:
+                self.progress(self)
+            except Exception:
+                logger.exception("Error in CV progress function")
+
+    def poll (self) -> bool:
+        """Send the next operation and handle timeouts
+
+        Returns:
+            Bool: True when all operations have finished
+        """
+        now = self.clock()
+        operation = self._inflight
+        if operation is not None and now - operation.sent >= self.timeout:
+            if operation.attempts <= self.retries:
+                logger.debug("No reply for CV%s - sending again", operation.cv)
+                self._send(operation, now)
+            else:
+                self._failed(operation, None, "No reply", now)
+        if self._inflight is None and self._queue and now >= self._queue[0].not_before:
+            self._send(self._queue.popleft(), now)
+        done = self._inflight is None and not self._queue
+        if done and self._started is not None and self._finished_time is None:
+            self._finished_time = now
+        return done
+
+    def _send (self, operation: CVOperation, now: float) -> None:
+        if self._started is None:
+            self._started = now
+        if operation.first_sent is None:
+            operation.first_sent = now
+        operation.sent = now
+        operation.attempts += 1
+        self._inflight = operation
+        if operation.kind == KIND_READ:
+            self.transport.send_data(self.vlcb.read_cv(self.session, operation.cv, self.mode))
+        else:
+            self.transport.send_data(self.vlcb.write_cv(self.session, operation.cv, operation.value, self.mode))
+
+    def run (self, timeout: Optional[float] = None, interval: float = 0.002) -> List[CVOperation]:
+        """Send all the operations and wait for the replies
+
+        Args:
+            timeout: Maximum time in seconds (default no limit - each operation has its own timeout)
+            interval: Time to wait when no data is received
+
+        Returns:
+            List of CVOperation in the order added
+        """
+        end = self.clock() + timeout if timeout is not None else None
+        while not self.poll() and (end is None or self.clock() < end):
+            packets = self.transport.read_data()
+            for packet in packets:
+                self.receive(packet)
+            if not packets:
+                time.sleep(interval)
+        return self.results
@@ -0,0 +1,425 @@
+""" Node discovery
+
+Sends QNN and collects the PNN replies, then reads the parameters, number
+of events (RQEVN / NUMEV), event space (NNEVN / EVNLF) and stored events
+(NERD / ENRSP) of each node.
+
+Each node has one request in progress at a time (so a node is never sent
+a new request before it has replied) and up to window nodes are queried
+at once, so a large layout is read quickly without flooding the bus.
+Requests without a reply are sent again up to retries times.
+
+Nodes which are in a previous snapshot (see pyvlcb.snapshot) are only
+validated: the PNN is compared and the firmware version parameters and
+number of events are read. A node is only fully read again if any of
+these have changed (or a validation request gets no reply).
+"""
+
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Union
+from .canusb import DIRECTION_TX
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Opcodes
+OPCODE_QNN = 0x0D
+OPCODE_NNEVN = 0x56
+OPCODE_NERD = 0x57
+OPCODE_RQEVN = 0x58
+OPCODE_CMDERR = 0x6F
+OPCODE_EVNLF = 0x70
+OPCODE_NVRD = 0x71
+OPCODE_RQNPN = 0x73
+OPCODE_NUMEV = 0x74
+OPCODE_NVANS = 0x97
+OPCODE_PARAN = 0x9B
+OPCODE_GRSP = 0xAF
+OPCODE_PNN = 0xB6
+OPCODE_ENRSP = 0xF2
+
+# Response expected for each request
+responses = {
+    OPCODE_RQNPN: OPCODE_PARAN,
+    OPCODE_RQEVN: OPCODE_NUMEV,
+    OPCODE_NNEVN: OPCODE_EVNLF,
+    OPCODE_NVRD: OPCODE_NVANS,
+    OPCODE_NERD: OPCODE_ENRSP
+}
+
+# Node parameter indexes
+PARAM_COUNT = 0
+PARAM_MANUFACTURER = 1
+PARAM_MINOR_VERSION = 2
+PARAM_MODULE_ID = 3
+PARAM_MAX_EVENTS = 4
+PARAM_NUM_NVS = 6
+PARAM_MAJOR_VERSION = 7
+
+# Parameters compared to validate a node from a snapshot
+validate_parameters = (PARAM_MINOR_VERSION, PARAM_MAJOR_VERSION)
+
+
+class NodeInfo:
+    """Details read from a node
+
+    Attributes:
+        node: Node number
+        can_id: CAN ID of the node (from the PNN)
+        manufacturer: Manufacturer ID (from the PNN)
+        module: Module ID (from the PNN)
+        flags: Module flags (from the PNN)
+        name: Name of the node (not read from the node - can be set by the user)
+        parameters: Node parameters indexed by parameter number
+        num_events: Number of stored events (NUMEV)
+        event_space: Space for more events (EVNLF)
+        events: Stored events (32 bit node and event) indexed by event index (ENRSP)
+        nvs: Node variables indexed by NV number (NVANS)
+        errors: Requests which failed (no reply or an error from the node)
+        complete: True when all requests have finished
+    """
+    def __init__ (self, node: int, can_id: Optional[int] = None, manufacturer: Optional[int] = None,
+                  module: Optional[int] = None, flags: Optional[int] = None) -> None:
+        self.node = node
+        self.can_id = can_id
+        self.manufacturer = manufacturer
+        self.module = module
+        self.flags = flags
+        self.name: Optional[str] = None
+        self.parameters: Dict[int, int] = {}
+        self.num_events: Optional[int] = None
+        self.event_space: Optional[int] = None
+        self.events: Dict[int, int] = {}
+        self.nvs: Dict[int, int] = {}
+        self.errors: List[str] = []
+        self.complete = False
+
+    def __repr__ (self) -> str:
+        return f"NodeInfo({self.node}, module={self.module}, {len(self.parameters)} parameters, {len(self.events)} events)"
+
+
+class _Request:
+    """A request to a node waiting to be sent or waiting for the reply"""
+    __slots__ = ("opcode", "index", "packet", "check", "sent", "attempts", "received")
+
+    def __init__ (self, opcode: int, packet: str, index: int = 0, check: bool = False) -> None:
+        self.opcode = opcode
+        self.index = index
+        self.packet = packet
+        # Reply is compared to the snapshot rather than stored
+        self.check = check
+        self.sent = 0.0
+        self.attempts = 0
+        # Number of replies received (NERD has one for each event)
+        self.received = 0
+
+
+class DiscoveryEngine:
+    """Discover the nodes on the bus and read their details
+
+    Either call run, which sends QNN and reads from the transport until
+    discovery has finished, or call start and then pass each received
+    packet to receive (or add record as a CanUSB4 listener) and call poll
+    regularly until it returns True.
+
+    Attributes:
+        nodes: NodeInfo for each node found
+        window: Maximum number of nodes with a request in progress
+        timeout: Time to wait for a reply before sending again
+        retries: Number of times a request is sent again
+        qnn_wait: Time to wait for PNN replies before querying the nodes
+        known: Nodes from a previous snapshot which are validated rather than fully read
+        validated: Nodes from the snapshot which have not changed
+        changed: Nodes from the snapshot which were fully read again (changed or no reply to validation)
+    """
+    def __init__ (self,
+                  vlcb,
+                  transport,
+                  window: int = 8,
+                  timeout: float = 0.5,
+                  retries: int = 2,
+                  qnn_wait: float = 0.5,
+                  read_parameters: bool = True,
+                  read_events: bool = True,
+                  read_nvs: bool = False,
+                  known: Optional[Dict[int, NodeInfo]] = None,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits DiscoveryEngine
+
+        Args:
+            vlcb: VLCB object used to create the requests
+            transport: Object with send_data (and read_data if using run) eg. CanUSB4
+            window: Maximum number of nodes with a request in progress
+            timeout: Time in seconds to wait for each reply
+            retries: Number of times a request is sent again if there is no reply
+            qnn_wait: Time in seconds to collect PNN replies
+            read_parameters: Read the node parameters
+            read_events: Read the number of events, event space and stored events
+            read_nvs: Read the node variables (needs read_parameters for the number of NVs)
+            known: Nodes from a previous snapshot (eg. load_snapshot)
+            clock: Function returning the current time in seconds
+        """
+        self.vlcb = vlcb
+        self.transport = transport
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.qnn_wait = qnn_wait
+        self.read_parameters = read_parameters
+        self.read_events = read_events
+        self.read_nvs = read_nvs
+        self.known = known if known is not None else {}
+        self.clock = clock
+        self.nodes: Dict[int, NodeInfo] = {}
+        self.validated: Set[int] = set()
+        self.changed: Set[int] = set()
+        self._queues: Dict[int, Deque[_Request]] = {}
+        self._ready: Deque[int] = deque()
+        self._inflight: Dict[int, _Request] = {}
+        self._qnn_sent: Optional[float] = None
+        self._querying = False
+
+    def start (self) -> None:
+        """Send QNN to find the nodes"""
+        self._qnn_sent = self.clock()
+        self._querying = False
+        self.transport.send_data(self.vlcb.discover())
+
+    def discover_node (self, node: int) -> NodeInfo:
+        """Read the details of a single node (without QNN)
+
+        Returns:
+            NodeInfo: Filled in as the replies are received
+        """
+        info = self.nodes.get(node)
+        if info is None:
+            info = NodeInfo(node)
+            self.nodes[node] = info
+        self._querying = True
+        self._queue_node(info)
+        return info
+
+    def _queue_node (self, info: NodeInfo) -> None:
+        node = info.node
+        info.complete = False
+        queue = deque()
+        if self.read_parameters:
+            # Parameter 0 is the number of parameters - others are added when it is received
+            queue.append(self._rqnpn(node, PARAM_COUNT))
+        if self.read_events:
+            queue.append(_Request(OPCODE_RQEVN, self.vlcb.discover_evn(node)))
+            queue.append(_Request(OPCODE_NNEVN, self.vlcb.discover_nevn(node)))
+        self._queues[node] = queue
+        if node not in self._inflight and node not in self._ready:
+            self._ready.append(node)
+
+    # Compare a node with the snapshot (only requests parameters and counts which were read before)
+    def _queue_validate (self, info: NodeInfo) -> None:
+        node = info.node
+        info.complete = False
+        queue = deque()
+        for index in validate_parameters:
+            if index in info.parameters:
+                queue.append(self._rqnpn(node, index, check=True))
+        if info.num_events is not None:
+            queue.append(_Request(OPCODE_RQEVN, self.vlcb.discover_evn(node), check=True))
+        if not queue:
+            # Nothing to compare other than the PNN
+            self.validated.add(node)
+            info.complete = True
+            return
+        self._queues[node] = queue
+        if node not in self._inflight and node not in self._ready:
+            self._ready.append(node)
+
+    # Node does not match the snapshot - read everything again
+    def _node_changed (self, node: int) -> None:
+        logger.info("Node %s has changed since the snapshot", node)
+        old = self.nodes[node]
+        info = NodeInfo(node, old.can_id, old.manufacturer, old.module, old.flags)
+        info.name = old.name
+        self.nodes[node] = info
+        self.changed.add(node)
+        self._queue_node(info)
+
+    def _rqnpn (self, node: int, index: int, check: bool = False) -> _Request:
+        return _Request(OPCODE_RQNPN, self.vlcb.encode('RQNPN', NN=node, ParaIndex=index), index, check)
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Check a received frame (signature matches CanUSB4.add_listener)"""
+        if direction != DIRECTION_TX:
+            self.receive(packet)
+
+    def receive (self, packet: Union[str, bytes]) -> None:
+        """Check a received frame for a reply"""
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 14 or packet[1] != "S":
+            return
+        try:
+            can_id = (int(packet[2:6], 16) & 0xfe0) >> 5
+            opcode = int(packet[7:9], 16)
+            data = bytes.fromhex(packet[9:-1])
+        except ValueError:
+            return
+        node = (data[0] << 8) + data[1]
+        if opcode == OPCODE_PNN and len(data) >= 5:
+            self._pnn(node, can_id, data)
+            return
+        request = self._inflight.get(node)
+        if request is None:
+            return
+        info = self.nodes[node]
+        if opcode == OPCODE_CMDERR or (opcode == OPCODE_GRSP and len(data) >= 5 and data[2] == request.opcode and data[4] != 0):
+            # Node does not support the request - do not retry
+            info.errors.append(f"{request.opcode:02X} error {data[-1]}")
+            if request.check:
+                self._inflight.pop(node, None)
+                self._node_changed(node)
+                return
+            self._finished(node)
+            return
+        if opcode != responses[request.opcode]:
+            return
+        if request.check:
+            self._check(node, info, request, opcode, data)
+            return
+        if opcode == OPCODE_PARAN and len(data) >= 4 and data[2] == request.index:
+            info.parameters[request.index] = data[3]
+            if request.index == PARAM_COUNT:
+                # Read the other parameters before the next request
+                queue = self._queues[node]
+                for index in range(data[3], 0, -1):
+                    queue.appendleft(self._rqnpn(node, index))
+            elif request.index == PARAM_NUM_NVS and self.read_nvs:
+                queue = self._queues[node]
+                for index in range(1, data[3] + 1):
+                    queue.append(_Request(OPCODE_NVRD, self.vlcb.encode('NVRD', NN=node, NVIndex=index), index))
+            self._finished(node)
+        elif opcode == OPCODE_NVANS and len(data) >= 4 and data[2] == request.index:
+            info.nvs[request.index] = data[3]
+            self._finished(node)
+        elif opcode == OPCODE_NUMEV and len(data) >= 3:
+            info.num_events = data[2]
+            if data[2] > 0:
+                self._queues[node].append(_Request(OPCODE_NERD, self.vlcb.discover_nerd(node)))
+            self._finished(node)
+        elif opcode == OPCODE_EVNLF and len(data) >= 3:
+            info.event_space = data[2]
+            self._finished(node)
+        elif opcode == OPCODE_ENRSP and len(data) >= 7:
+            info.events[data[6]] = int.from_bytes(data[2:6], 'big')
+            request.received += 1
+            # Each reply also counts as progress for the timeout
+            request.sent = self.clock()
+            if info.num_events is None or len(info.events) >= info.num_events:
+                self._finished(node)
+
+    # Reply to a validation request - compare with the snapshot
+    def _check (self, node: int, info: NodeInfo, request: _Request, opcode: int, data: bytes) -> None:
+        if opcode == OPCODE_PARAN and len(data) >= 4 and data[2] == request.index:
+            matches = info.parameters.get(request.index) == data[3]
+        elif opcode == OPCODE_NUMEV and len(data) >= 3:
+            matches = info.num_events == data[2]
+        else:
+            return
+        if not matches:
+            self._inflight.pop(node, None)
+            self._node_changed(node)
+            return
+        if not self._queues.get(node):
+            self.validated.add(node)
+        self._finished(node)
+
+    def _pnn (self, node: int, can_id: int, data: bytes) -> None:
+        # Nodes are only read once (eg. if there is another QNN on the bus)
+        if node in self.nodes:
+            self.nodes[node].can_id = can_id
+            return
+        known = self.known.get(node)
+        if known is not None and (known.manufacturer, known.module, known.flags) == (data[2], data[3], data[4]):
+            known.can_id = can_id
+            known.errors = []
+            self.nodes[node] = known
+            self._queue_validate(known)
+            return
+        info = NodeInfo(node, can_id, data[2], data[3], data[4])
+        if known is not None:
+            info.name = known.name
+            self.changed.add(node)
+        self.nodes[node] = info
+        self._queue_node(info)
+
+    # Request for a node has finished - node is ready for its next request
+    def _finished (self, node: int) -> None:
+        self._inflight.pop(node, None)
+        if self._queues.get(node):
+            self._ready.append(node)
+        else:
+            self.nodes[node].complete = True
+            self._queues.pop(node, None)
+
+    def poll (self) -> bool:
+        """Send requests and handle timeouts
+
+        Returns:
+            Bool: True when discovery has finished
+        """
+        now = self.clock()
+        if not self._querying:
+            if self._qnn_sent is None or now - self._qnn_sent < self.qnn_wait:
+                return False
+            self._querying = True
+        for node, request in list(self._inflight.items()):
+            if now - request.sent < self.timeout:
+                continue
+            if request.attempts <= self.retries:
+                logger.debug("No reply from node %s - sending again", node)
+                self._send(request, now)
+            elif request.check:
+                # Cannot compare with the snapshot so read everything again
+                logger.debug("No reply from node %s to validation request", node)
+                self._inflight.pop(node, None)
+                self._node_changed(node)
+            else:
+                self.nodes[node].errors.append(f"{request.opcode:02X} no reply")
+                self._finished(node)
+        while self._ready and len(self._inflight) < self.window:
+            node = self._ready.popleft()
+            queue = self._queues.get(node)
+            if not queue:
+                continue
+            request = queue.popleft()
+            self._inflight[node] = request
+            self._send(request, now)
+        return not self._inflight and not self._ready
+
+    def _send (self, request: _Request, now: float) -> None:
+        request.sent = now
+        request.attempts += 1
+        self.transport.send_data(request.packet)
+
+    def run (self, timeout: float = 60.0, interval: float = 0.005) -> Dict[int, NodeInfo]:
+        """Discover all nodes (sends QNN and reads from the transport until finished)
+
+        Args:
+            timeout: Maximum time in seconds
+            interval: Time to wait when no data is received
+
+        Returns:
+            Dict of NodeInfo indexed by node number
+        """
+        self.start()
+        end = self.clock() + timeout
+        while self.clock() < end:
+            packets = self.transport.read_data()
+            for packet in packets:
+                self.receive(packet)
+            if self.poll():
+                break
+            if not packets:
+                time.sleep(interval)
+        return self.nodes
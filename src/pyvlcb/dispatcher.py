@@ -0,0 +1,197 @@
+""" Dispatch received packets to registered handlers based on opcode """
+
+import threading
+from typing import Callable, Dict, Optional, Tuple, Union
+from .vlcbformat import VLCBFormat, VLCBOpcode
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Handler is called with the VLCBFormat packet
+Handler = Callable[[VLCBFormat], None]
+
+
+# Opcodes where the data starts with a node number (NN)
+# These support per-node handlers
+def _node_opcodes () -> frozenset:
+    return frozenset(int(code, 16) for code, details in VLCBOpcode.opcodes.items()
+                     if details['format'].split(',')[0] == 'NN')
+
+# Accessory events (ACON / ACOF / ASON / ASOF and the data variants)
+# NN followed by EnHigh_EnLow or DNHigh_DNLow - these support per-event handlers
+def _event_opcodes () -> frozenset:
+    return frozenset(int(code, 16) for code, details in VLCBOpcode.opcodes.items()
+                     if details['format'].startswith(('NN,EnHigh_EnLow', 'NN,DNHigh_DNLow')))
+
+
+def opcode_to_int (opcode: Union[int, str]) -> int:
+    """Convert an opcode to an int
+
+    Args:
+        opcode: Opcode as an int, 2 character hex string (eg. '90') or mnemonic (eg. 'ACON')
+
+    Returns:
+        Int: The opcode value (0 to 255)
+
+    Raises:
+        ValueError: If opcode not found
+    """
+    if isinstance(opcode, int):
+        if opcode < 0 or opcode > 0xFF:
+            raise ValueError(f"Opcode {opcode} is out of range")
+        return opcode
+    if opcode in VLCBOpcode.mnemonics:
+        return int(VLCBOpcode.mnemonics[opcode], 16)
+    if len(opcode) == 2 and opcode.upper() in VLCBOpcode.opcodes:
+        return int(opcode, 16)
+    raise ValueError(f"Opcode {opcode} is not defined.")
+
+
+class VLCBDispatcher:
+    """Dispatch packets to handlers using a table indexed by opcode
+
+    Handlers are stored in a 256 entry table so the cost of dispatch does not
+    depend on the number of opcodes that have handlers. Handlers can also be
+    registered for a specific node (opcodes starting with NN) or a specific
+    event (accessory opcodes such as ACON / ACOF / ASON / ASOF).
+
+    Registration uses copy on write, so handlers can be added or removed
+    from another thread (or from within a handler) while packets are
+    being dispatched.
+    """
+    node_opcodes = _node_opcodes()
+    event_opcodes = _event_opcodes()
+
+    def __init__ (self) -> None:
+        """Inits VLCBDispatcher with empty handler tables"""
+        # Lock is only used by register / unregister - dispatch does not lock
+        self._lock = threading.Lock()
+        # Tables hold tuples which are replaced (never modified) on change
+        self._table = [()] * 256
+        # Per opcode dict of node -> handlers and (node, event) -> handlers
+        self._node_table = [None] * 256
+        self._event_table = [None] * 256
+
+    def register (self,
+                  opcode: Union[int, str],
+                  handler: Handler,
+                  node: Optional[int] = None,
+                  event: Optional[int] = None) -> None:
+        """Register a handler for an opcode
+
+        Args:
+            opcode: Opcode as int, hex string or mnemonic
+            handler: Function called with the VLCBFormat packet
+            node: Only call for packets from / to this node number
+            event: Only call for this event number (requires node)
+
+        Raises:
+            ValueError: If opcode not found or does not support node / event
+        """
+        op = self._check_args(opcode, node, event)
+        with self._lock:
+            if event is not None:
+                self._event_table[op] = self._add_to(self._event_table[op], (node, event), handler)
+            elif node is not None:
+                self._node_table[op] = self._add_to(self._node_table[op], node, handler)
+            else:
+                self._table[op] = self._table[op] + (handler,)
+
+    def unregister (self,
+                    opcode: Union[int, str],
+                    handler: Handler,
+                    node: Optional[int] = None,
+                    event: Optional[int] = None) -> bool:
+        """Remove a handler previously registered
+
+        Must be called with the same arguments as register
+
+        Returns:
+            Bool: True if the handler was removed, False if not registered
+        """
+        op = self._check_args(opcode, node, event)
+        with self._lock:
+            if event is not None:
+                table, removed = self._remove_from(self._event_table[op], (node, event), handler)
+                self._event_table[op] = table
+            elif node is not None:
+                table, removed = self._remove_from(self._node_table[op], node, handler)
+                self._node_table[op] = table
+            else:
+                handlers = self._table[op]
+                removed = handler in handlers
+                if removed:
+                    handlers = list(handlers)
+                    handlers.remove(handler)
+                    self._table[op] = tuple(handlers)
+        return removed
+
+    def dispatch (self, packet: VLCBFormat) -> int:
+        """Call the handlers registered for this packet
+
+        Exceptions raised by a handler are logged and do not prevent
+        other handlers from being called.
+
+        Args:
+            packet: Packet from VLCB.parse_input
+
+        Returns:
+            Int: Number of handlers called
+        """
+        data = packet.data
+        try:
+            op = int(data[0:2], 16)
+        except ValueError:
+            # Null or invalid opcode - nothing registered
+            return 0
+        # Take local references so that a change during dispatch is not seen
+        handlers = self._table[op]
+        node_table = self._node_table[op]
+        event_table = self._event_table[op]
+        if node_table is not None or event_table is not None:
+            node = int(data[2:6], 16) if len(data) >= 6 else None
+            if node_table is not None and node in node_table:
+                handlers = handlers + node_table[node]
+            if event_table is not None and len(data) >= 10:
+                key = (node, int(data[6:10], 16))
+                if key in event_table:
+                    handlers = handlers + event_table[key]
+        for handler in handlers:
+            try:
+                handler(packet)
+            except Exception:
+                logger.exception(f"Handler {handler} failed for {data}")
+        return len(handlers)
+
+    def _check_args (self, opcode: Union[int, str], node: Optional[int], event: Optional[int]) -> int:
+        op = opcode_to_int(opcode)
+        if event is not None:
+            if node is None:
+                raise ValueError("An event handler also needs a node number")
+            if op not in self.event_opcodes:
+                raise ValueError(f"Opcode {opcode} does not include an event number")
+        elif node is not None and op not in self.node_opcodes:
+            raise ValueError(f"Opcode {opcode} does not include a node number")
+        return op
+
+    # Copy on write helpers for the sub tables
+    @staticmethod
+    def _add_to (table: Optional[Dict], key, handler: Handler) -> Dict:
+        new_table = dict(table) if table is not None else {}
+        new_table[key] = new_table.get(key, ()) + (handler,)
+        return new_table
+
+    @staticmethod
+    def _remove_from (table: Optional[Dict], key, handler: Handler) -> Tuple[Optional[Dict], bool]:
+        if table is None or handler not in table.get(key, ()):
+            return table, False
+        new_table = dict(table)
+        handlers = list(new_table[key])
+        handlers.remove(handler)
+        if handlers:
+            new_table[key] = tuple(handlers)
+        else:
+            del new_table[key]
+        return (new_table if new_table else None), True
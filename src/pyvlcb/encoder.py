@@ -0,0 +1,234 @@
+""" Fast encoding of packets using cached headers
+
+Used by the VLCB command methods. Headers are created once for each
+combination of priority and can_id and then reused. The functions
+ending _bytes return a bytestring which can be passed directly to
+CanUSB4.send_data.
+
+encode_data can encode any opcode. The field layout for each opcode is
+created from VLCBOpcode.opcodes and field_formats on first use.
+"""
+
+from typing import Callable, Dict, Tuple, Union
+from .dispatcher import opcode_to_int
+from .utils import hex_table
+from .vlcbformat import VLCBOpcode
+
+# Minimum priority for each opcode eg. opcode_minpri['23'] = 2
+opcode_minpri = {code: details['minpri'] for code, details in VLCBOpcode.opcodes.items() if code != ''}
+
+# Header strings indexed by (majpri, minpri, can_id)
+_headers: Dict[Tuple[int, int, int], str] = {}
+# Header and opcode indexed by (majpri, can_id, opcode)
+_prefixes: Dict[Tuple[int, int, str], str] = {}
+_prefixes_bytes: Dict[Tuple[int, int, str], bytes] = {}
+
+
+def header_string (majpri: int, minpri: int, can_id: int) -> str:
+    """Create a header string eg. ':SB780N'
+
+    The result is cached so it is only calculated once for each combination.
+
+    Args:
+        majpri: Major priority (2 bits)
+        minpri: Minor priority (2 bits)
+        can_id: CAN ID (7 bits)
+
+    Returns:
+        String: Header for a standard frame
+    """
+    key = (majpri, minpri, can_id)
+    header = _headers.get(key)
+    if header is None:
+        header_val = (majpri << 14) + (minpri << 12) + (can_id << 5)
+        header = f":S{header_val:04X}N"
+        _headers[key] = header
+    return header
+
+
+def command_prefix (can_id: int, opcode: str, majpri: int = 0b10) -> str:
+    """Header and opcode for a command eg. ':SB780N23'
+
+    Uses the minimum priority of the opcode.
+
+    Args:
+        can_id: CAN ID
+        opcode: Opcode as a 2 character hex string
+        majpri: Major priority
+
+    Returns:
+        String: Start of the packet - data bytes and ';' are added after
+
+    Raises:
+        ValueError: If opcode not found
+    """
+    key = (majpri, can_id, opcode)
+    prefix = _prefixes.get(key)
+    if prefix is None:
+        if opcode not in opcode_minpri:
+            raise ValueError(f"Opcode {opcode} is not defined.")
+        prefix = header_string(majpri, opcode_minpri[opcode], can_id) + opcode
+        _prefixes[key] = prefix
+    return prefix
+
+
+def command_prefix_bytes (can_id: int, opcode: str, majpri: int = 0b10) -> bytes:
+    """Bytestring version of command_prefix"""
+    key = (majpri, can_id, opcode)
+    prefix = _prefixes_bytes.get(key)
+    if prefix is None:
+        prefix = command_prefix(can_id, opcode, majpri).encode('ascii')
+        _prefixes_bytes[key] = prefix
+    return prefix
+
+
+def frame (can_id: int, opcode: str, *data: int) -> str:
+    """Create a packet from an opcode and data bytes
+
+    eg. frame(60, '23', 1) = ':SA780N2301;'
+
+    Args:
+        can_id: CAN ID
+        opcode: Opcode as a 2 character hex string
+        data: Each data byte as an int (0 to 255)
+
+    Returns:
+        String: Packet ready to send
+
+    Raises:
+        ValueError: If opcode not found or a data byte is out of range
+    """
+    prefix = command_prefix(can_id, opcode)
+    try:
+        return prefix + bytes(data).hex().upper() + ";"
+    except (ValueError, TypeError):
+        raise ValueError(f"Data bytes must be integers in range 0 to 255 {data}") from None
+
+
+def frame_bytes (can_id: int, opcode: str, *data: int) -> bytes:
+    """Create a packet as a bytestring ready for CanUSB4.send_data
+
+    eg. frame_bytes(60, '23', 1) = b':SA780N2301;'
+
+    Args:
+        can_id: CAN ID
+        opcode: Opcode as a 2 character hex string
+        data: Each data byte as an int (0 to 255)
+
+    Returns:
+        Bytes: Packet ready to send
+
+    Raises:
+        ValueError: If opcode not found or a data byte is out of range
+    """
+    prefix = command_prefix_bytes(can_id, opcode)
+    try:
+        return prefix + bytes(data).hex().upper().encode('ascii') + b";"
+    except (ValueError, TypeError):
+        raise ValueError(f"Data bytes must be integers in range 0 to 255 {data}") from None
+
+
+
+# Compiled encoders indexed by opcode (as passed to encode_data)
+_encoders: Dict[Union[int, str], Tuple[str, Callable[..., str]]] = {}
+
+
+def _range_error (name: str, value: int, num_chars: int) -> None:
+    raise ValueError(f"Field {name} value {value} is out of range (maximum {hex((1 << (num_chars * 4)) - 1)})")
+
+
+# Char fields are left as a string by parse_data
+def _char_field (name: str, value: str, num_chars: int) -> str:
+    if not isinstance(value, str) or len(value) != num_chars:
+        raise ValueError(f"Field {name} must be a string of {num_chars} characters")
+    return value
+
+
+# Ascii fields (eg. NAME) can be provided as a string which is padded with spaces
+def _ascii_field (value: Union[int, str], num_chars: int) -> int:
+    if isinstance(value, str):
+        return int(value.encode('ascii').ljust(num_chars // 2)[:num_chars // 2].hex(), 16)
+    return value
+
+
+# Create a function to encode the fields for an opcode
+# Each field is a keyword only argument
+def _compile_encoder (code: str) -> Callable[..., str]:
+    layout = VLCBOpcode.field_layout(code)
+    names = [name for name, start, end, field_type in layout]
+    if len(names) != len(set(names)):
+        raise ValueError(f"Opcode {code} has duplicate field names and cannot be encoded")
+    lines = ["def encode_fields (" + ("*, " + ", ".join(names) if names else "") + "):"]
+    parts = []
+    for name, start, end, field_type in layout:
+        num_chars = end - start
+        if field_type == 'char':
+            lines.append(f"    {name} = _char_field({name!r}, {name}, {num_chars})")
+            parts.append(name)
+            continue
+        if field_type == 'ascii':
+            lines.append(f"    {name} = _ascii_field({name}, {num_chars})")
+        lines.append(f"    if not 0 <= {name} < {1 << (num_chars * 4)}: _range_error({name!r}, {name}, {num_chars})")
+        if num_chars == 2:
+            parts.append(f"hex_table[{name}]")
+        elif num_chars == 4:
+            parts.append(f"hex_table[{name} >> 8] + hex_table[{name} & 0xFF]")
+        else:
+            parts.append(f"f'{{{name}:0{num_chars}X}}'")
+    lines.append("    return " + (" + ".join(parts) if parts else "''"))
+    namespace = {
+        'hex_table': hex_table,
+        '_range_error': _range_error,
+        '_char_field': _char_field,
+        '_ascii_field': _ascii_field
+    }
+    exec("\n".join(lines), namespace)
+    return namespace['encode_fields']
+
+
+def compiled_encoder (opcode: Union[int, str]) -> Tuple[str, Callable[..., str]]:
+    """Get the opcode hex string and compiled field encoder for an opcode
+
+    The encoder is created from the opcode format on first use.
+
+    Args:
+        opcode: Opcode as int, hex string (eg. '47') or mnemonic (eg. 'DSPD')
+
+    Returns:
+        Tuple of opcode hex string and a function which takes the fields
+        as keyword arguments and returns the data as a hex string
+
+    Raises:
+        ValueError: If opcode not found
+    """
+    entry = _encoders.get(opcode)
+    if entry is None:
+        op = opcode_to_int(opcode)
+        code = f"{op:02X}"
+        if code not in VLCBOpcode.opcodes:
+            raise ValueError(f"Opcode {opcode} is not defined.")
+        entry = (code, _compile_encoder(code))
+        _encoders[opcode] = entry
+    return entry
+
+
+def encode_data (opcode: Union[int, str], **fields: Union[int, str]) -> str:
+    """Encode the data section of a packet (opcode and fields)
+
+    Uses the same format and field_formats as VLCBOpcode.parse_data, so
+    parse_data(encode_data(opcode, **fields)) returns the same fields.
+    eg. encode_data('DSPD', Session=5, SpeedDir=130) = '470582'
+
+    Args:
+        opcode: Opcode as int, hex string or mnemonic
+        fields: Value for each field in the opcode format
+
+    Returns:
+        String: Opcode and data as a hex string
+
+    Raises:
+        ValueError: If opcode not found or a value is out of range
+        TypeError: If a field is missing or not part of the opcode
+    """
+    code, encode_fields = compiled_encoder(opcode)
+    return code + encode_fields(**fields)
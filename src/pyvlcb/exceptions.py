@@ -9,8 +9,22 @@ class MyLibraryError(Exception):
     
     Catching this exception allows the user to catch ANY error raised 
     specifically by this library, distinct from standard Python errors.
+
+    Functions in error_hooks are called with the exception when it is
+    created (eg. FlightRecorder.auto_dump). This is when the exception is
+    constructed, not when it is raised, so an error which is created and
+    then handled also calls the hooks.
     """
-    pass
+    error_hooks = ()
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        for hook in MyLibraryError.error_hooks:
+            # A failing hook must not hide the original error
+            try:
+                hook(self)
+            except Exception:
+                pass
 
 
 class DeviceConnectionError(MyLibraryError):
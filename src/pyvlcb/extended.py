@@ -0,0 +1,90 @@
+""" Extended (29 bit identifier) frames
+
+Extended frames are not VLCB opcodes - they are used by the bootloader to
+transfer firmware. In the CANUSB4 (GridConnect) format the 8 hex
+characters after :X are the SIDH, SIDL, EIDH and EIDL registers, where
+SIDL has the extended bit (0x08) set. eg. identifier 4 is ':X00080004N'.
+"""
+
+from typing import NamedTuple, Union
+
+# Extended identifier bit in SIDL
+SIDL_EXIDE = 0x08
+
+MAX_IDENTIFIER = 0x1FFFFFFF
+
+
+class ExtendedFrame (NamedTuple):
+    """An extended frame
+
+    Attributes:
+        identifier: 29 bit identifier
+        data: Data bytes (0 to 8)
+        rtr: True for a remote transmission request
+    """
+    identifier: int
+    data: bytes
+    rtr: bool = False
+
+    @property
+    def packet (self) -> str:
+        """Frame as a string eg. ':X00080004N0D;'"""
+        return encode_extended(self.identifier, self.data, self.rtr)
+
+
+def extended_header (identifier: int) -> str:
+    """Header registers for an identifier as 8 hex characters
+
+    Raises:
+        ValueError: If the identifier is more than 29 bits
+    """
+    if identifier < 0 or identifier > MAX_IDENTIFIER:
+        raise ValueError(f"Extended identifier needs to be 29 bits. Value provided {identifier}")
+    sid = identifier >> 18
+    eid = identifier & 0x3FFFF
+    sidl = ((sid & 0x07) << 5) | SIDL_EXIDE | (eid >> 16)
+    return f"{sid >> 3:02X}{sidl:02X}{(eid >> 8) & 0xFF:02X}{eid & 0xFF:02X}"
+
+
+def extended_identifier (header: Union[str, int]) -> int:
+    """Identifier from the header registers (8 hex characters or int)"""
+    if isinstance(header, str):
+        header = int(header, 16)
+    sidh = (header >> 24) & 0xFF
+    sidl = (header >> 16) & 0xFF
+    eid = ((sidl & 0x03) << 16) | (header & 0xFFFF)
+    return (((sidh << 3) | (sidl >> 5)) << 18) | eid
+
+
+def encode_extended (identifier: int, data: Union[bytes, bytearray, list] = b"", rtr: bool = False) -> str:
+    """Create an extended frame string
+
+    eg. encode_extended(4, b'\\x0d') = ':X00080004N0D;'
+
+    Raises:
+        ValueError: If the identifier is more than 29 bits or more than 8 data bytes
+    """
+    data = bytes(data)
+    if len(data) > 8:
+        raise ValueError(f"Maximum of 8 data bytes. {len(data)} provided")
+    return f":X{extended_header(identifier)}{'R' if rtr else 'N'}{data.hex().upper()};"
+
+
+def parse_extended (packet: Union[str, bytes]) -> ExtendedFrame:
+    """Parse an extended frame string
+
+    Raises:
+        ValueError: If not a valid extended frame
+    """
+    if not isinstance(packet, str):
+        packet = packet.decode('ascii', 'replace')
+    if len(packet) < 12 or packet[0:2] != ":X" or packet[-1] != ";" or packet[10] not in "NR":
+        raise ValueError(f"Invalid extended frame {packet}")
+    try:
+        identifier = extended_identifier(packet[2:10])
+        data = bytes.fromhex(packet[11:-1])
+    except ValueError:
+        raise ValueError(f"Invalid extended frame {packet}") from None
+    if len(data) > 8:
+        raise ValueError(f"Too much data in extended frame {packet}")
+    return ExtendedFrame(identifier, data, packet[10] == "R")
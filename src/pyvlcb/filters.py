@@ -0,0 +1,332 @@
+""" Filter expressions for selecting VLCB traffic
+
+Expressions such as "opc in (ACON, ACOF) and NN == 256 and EN > 100"
+are compiled once into a Python function which can then be used to test
+raw packets, VLCBFormat packets or decoded records (from parse_data).
+
+Field names are those in VLCBOpcode.field_formats, plus opc (opcode),
+can_id and priority. Opcodes are referred to by their mnemonic.
+EN and DN can be used as short names for EnHigh_EnLow and DNHigh_DNLow.
+"""
+
+import re
+from collections.abc import Mapping
+from typing import Any, Dict, List, Tuple, Union
+from .vlcbformat import VLCBFormat, VLCBOpcode
+
+# Fields which are not part of the opcode data
+_header_fields = ('opc', 'can_id', 'priority')
+
+# Short names for commonly used fields
+field_aliases = {
+    'EN': 'EnHigh_EnLow',
+    'DN': 'DNHigh_DNLow',
+    'Addr': 'AddrHigh_AddrLow',
+    'CV': 'CVHigh_CVLow'
+}
+
+_comparisons = ('==', '!=', '<', '<=', '>', '>=')
+
+_token_re = re.compile(r"""\s*(?:
+    (?P<num>0[xX][0-9a-fA-F]+|\d+) |
+    (?P<str>'[^']*'|"[^"]*") |
+    (?P<op>==|!=|<=|>=|<|>|\(|\)|,) |
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""", re.VERBOSE)
+
+
+def _tokenize (expression: str) -> List[Tuple[str, Any]]:
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _token_re.match(expression, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f"Invalid filter syntax at '{expression[pos:]}'")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'num':
+            tokens.append(('const', int(value, 0)))
+        elif kind == 'str':
+            tokens.append(('const', value[1:-1]))
+        elif kind == 'name' and value in ('and', 'or', 'not', 'in'):
+            tokens.append(('op', value))
+        else:
+            tokens.append((kind, value))
+    tokens.append(('end', None))
+    return tokens
+
+
+# Recursive descent parser - creates a tree of tuples
+class _Parser:
+    def __init__ (self, expression: str) -> None:
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.fields = set()
+
+    def peek (self) -> Tuple[str, Any]:
+        return self.tokens[self.pos]
+
+    def take (self) -> Tuple[str, Any]:
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect (self, value: str) -> None:
+        token = self.take()
+        if token != ('op', value):
+            raise ValueError(f"Expected '{value}' in filter, found '{token[1]}'")
+
+    def parse (self):
+        tree = self.parse_or()
+        if self.peek()[0] != 'end':
+            raise ValueError(f"Unexpected '{self.peek()[1]}' in filter")
+        return tree
+
+    def parse_or (self):
+        terms = [self.parse_and()]
+        while self.peek() == ('op', 'or'):
+            self.take()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else ('or', terms)
+
+    def parse_and (self):
+        terms = [self.parse_not()]
+        while self.peek() == ('op', 'and'):
+            self.take()
+            terms.append(self.parse_not())
+        return terms[0] if len(terms) == 1 else ('and', terms)
+
+    def parse_not (self):
+        if self.peek() == ('op', 'not'):
+            self.take()
+            return ('not', self.parse_not())
+        if self.peek() == ('op', '('):
+            self.take()
+            tree = self.parse_or()
+            self.expect(')')
+            return tree
+        return self.parse_comparison()
+
+    def parse_comparison (self):
+        left = self.parse_operand()
+        token = self.take()
+        negate = False
+        if token == ('op', 'not'):
+            negate = True
+            token = self.take()
+        if token == ('op', 'in'):
+            self.expect('(')
+            values = [self.parse_operand()]
+            while self.peek() == ('op', ','):
+                self.take()
+                values.append(self.parse_operand())
+            self.expect(')')
+            if any(value[0] != 'const' for value in values):
+                raise ValueError("Values in an 'in' list must be constants")
+            return ('in', left, [self.convert(left, value[1]) for value in values], negate)
+        if negate or token[0] != 'op' or token[1] not in _comparisons:
+            raise ValueError(f"Comparison expected in filter, found '{token[1]}'")
+        right = self.parse_operand()
+        if left[0] == 'const' and right[0] == 'const':
+            raise ValueError("Comparison needs at least one field")
+        if right[0] == 'const':
+            right = ('const', self.convert(left, right[1]))
+        elif left[0] == 'const':
+            left = ('const', self.convert(right, left[1]))
+        return ('cmp', token[1], left, right)
+
+    def parse_operand (self):
+        kind, value = self.take()
+        if kind == 'const':
+            return ('const', value)
+        if kind != 'name':
+            raise ValueError(f"Field or value expected in filter, found '{value}'")
+        value = field_aliases.get(value, value)
+        if value in _header_fields or value in VLCBOpcode.field_formats:
+            self.fields.add(value)
+            return ('field', value)
+        if value in VLCBOpcode.mnemonics and value != 'N/A':
+            return ('const', int(VLCBOpcode.mnemonics[value], 16))
+        raise ValueError(f"Unknown field or opcode '{value}' in filter")
+
+    # Allow opc to be compared with a quoted mnemonic eg. opc == 'ACON'
+    @staticmethod
+    def convert (field, value):
+        if field == ('field', 'opc') and isinstance(value, str):
+            if value not in VLCBOpcode.mnemonics:
+                raise ValueError(f"Unknown opcode '{value}' in filter")
+            return int(VLCBOpcode.mnemonics[value], 16)
+        return value
+
+
+def _operand_code (operand) -> str:
+    if operand[0] == 'const':
+        return repr(operand[1])
+    return 'f_' + operand[1]
+
+
+# Convert the tree to a python expression
+# Any comparison against a field that is not present (None) is False
+def _tree_code (tree) -> str:
+    kind = tree[0]
+    if kind in ('and', 'or'):
+        return '(' + f' {kind} '.join(_tree_code(term) for term in tree[1]) + ')'
+    if kind == 'not':
+        return f'(not {_tree_code(tree[1])})'
+    if kind == 'in':
+        _, operand, values, negate = tree
+        value_code = repr(tuple(values))
+        if negate:
+            return f'({_operand_code(operand)} is not None and {_operand_code(operand)} not in {value_code})'
+        return f'({_operand_code(operand)} in {value_code})'
+    _, op, left, right = tree
+    checks = [f'{_operand_code(side)} is not None' for side in (left, right) if side[0] == 'field']
+    return '(' + ' and '.join(checks + [f'{_operand_code(left)} {op} {_operand_code(right)}']) + ')'
+
+
+# Lookup of field positions for every opcode {opcode: (start, end, numeric)}
+def _field_positions (field: str) -> Dict[int, Tuple[int, int, bool]]:
+    positions = {}
+    for code in VLCBOpcode.opcodes:
+        if code == '':
+            continue
+        for name, start, end, field_type in VLCBOpcode.field_layout(code):
+            if name == field:
+                positions[int(code, 16)] = (start, end, field_type != 'char')
+    return positions
+
+
+class VLCBFilter:
+    """A compiled filter expression
+
+    Create using compile_filter. The filter can then be called with a raw
+    packet (str or bytes), a VLCBFormat or a dict from VLCBOpcode.parse_data.
+
+    Attributes:
+        expression: The filter expression
+        fields: Fields used in the expression
+    """
+    def __init__ (self, expression: str) -> None:
+        """Inits VLCBFilter by compiling the expression
+
+        Args:
+            expression: Filter expression eg. "opc == ACON and NN == 256"
+
+        Raises:
+            ValueError: If the expression is not valid
+        """
+        self.expression = expression
+        parser = _Parser(expression)
+        tree = parser.parse()
+        self.fields = frozenset(parser.fields)
+        code = _tree_code(tree)
+        namespace = {}
+        data_fields = [field for field in sorted(self.fields) if field not in _header_fields]
+        # Function used for packets - fields are extracted from the data string
+        lines = ["def match_data (opc, data, can_id, priority):"]
+        for field in data_fields:
+            namespace[f'L_{field}'] = _field_positions(field)
+            lines += [
+                f"    pos = L_{field}.get(opc)",
+                f"    if pos is None or len(data) < pos[1]:",
+                f"        f_{field} = None",
+                f"    elif pos[2]:",
+                f"        f_{field} = int(data[pos[0]:pos[1]], 16)",
+                f"    else:",
+                f"        f_{field} = data[pos[0]:pos[1]]"
+            ]
+        lines.append(f"    f_opc, f_can_id, f_priority = opc, can_id, priority")
+        lines.append(f"    return {code}")
+        # Function used for records - fields are read from the dict
+        lines.append("def match_record (record):")
+        lines.append("    opid = record.get('opid')")
+        lines.append("    f_opc = int(opid, 16) if opid else None")
+        lines.append("    f_can_id = record.get('can_id')")
+        lines.append("    f_priority = record.get('priority')")
+        for field in data_fields:
+            lines.append(f"    f_{field} = record.get({field!r})")
+            # Numeric fields are a string if Insufficient data
+            if VLCBOpcode.field_formats[field][1] != 'char':
+                lines.append(f"    if isinstance(f_{field}, str): f_{field} = None")
+        lines.append(f"    return {code}")
+        exec("\n".join(lines), namespace)
+        self._match_data = namespace['match_data']
+        self._match_record = namespace['match_record']
+
+    def match_frame (self, frame: Union[str, bytes]) -> bool:
+        """Test a raw packet eg. ':SB780N9001000002;'
+
+        Returns:
+            Bool: True if the packet matches, False if not or invalid packet
+        """
+        if not isinstance(frame, str):
+            frame = frame.decode('ascii', 'replace')
+        if len(frame) < 8 or frame[0] != ':' or frame[1] != 'S':
+            return False
+        try:
+            header = int(frame[2:6], 16)
+            data = frame[7:-1]
+            opc = int(data[0:2], 16) if len(data) >= 2 else None
+            return self._match_data(opc, data, (header & 0xfe0) >> 5, (header & 0xf000) >> 12)
+        except (ValueError, TypeError):
+            return False
+
+    def match_packet (self, packet: VLCBFormat) -> bool:
+        """Test a packet from VLCB.parse_input
+
+        Returns:
+            Bool: True if the packet matches
+        """
+        data = packet.data
+        try:
+            opc = int(data[0:2], 16) if len(data) >= 2 else None
+            return self._match_data(opc, data, packet.can_id, packet.priority)
+        except (ValueError, TypeError):
+            return False
+
+    def match_record (self, record: Dict[str, Any]) -> bool:
+        """Test a decoded record
+
+        Record is a dict from VLCBOpcode.parse_data, optionally with
+        can_id and priority added.
+
+        Returns:
+            Bool: True if the record matches
+        """
+        try:
+            return self._match_record(record)
+        except (ValueError, TypeError):
+            # Typically a field with Insufficient data
+            return False
+
+    def __call__ (self, item: Union[str, bytes, VLCBFormat, Dict[str, Any]]) -> bool:
+        if isinstance(item, VLCBFormat):
+            return self.match_packet(item)
+        # Mapping includes the read only records from DecodeCache
+        if isinstance(item, Mapping):
+            return self.match_record(item)
+        return self.match_frame(item)
+
+    def __repr__ (self) -> str:
+        return f"VLCBFilter({self.expression!r})"
+
+
+def compile_filter (expression: str) -> VLCBFilter:
+    """Compile a filter expression
+
+    Expressions use comparisons (== != < <= > >=), in (...) and not in (...)
+    combined with and, or, not and brackets.
+    eg. "opc in (ACON, ACOF) and NN == 256 and EN > 100" or "can_id == 60"
+
+    Args:
+        expression: Filter expression
+
+    Returns:
+        VLCBFilter: Compiled filter, call with a packet or record
+
+    Raises:
+        ValueError: If the expression is not valid
+    """
+    return VLCBFilter(expression)
@@ -0,0 +1,603 @@
+""" Module firmware upload
+
+Streams an Intel HEX image to a node using the CBUS bootloader. The node
+is put into bootloader mode with BOOTM and the bootloader then uses
+extended frames with fixed identifiers:
+
+    ID_CONTROL (4)  Address (3 bytes, low byte first), reserved, control
+                    bits, command and checksum (2 bytes, low byte first)
+    ID_DATA (5)     8 bytes written at the current address, which then
+                    increments by 8
+    ID_RESPONSE     1 byte - 1 (OK) or 0 (error). In acknowledge mode each
+                    data frame is acknowledged, as is the checksum check.
+
+Several data frames are sent before waiting for the acknowledgements
+(window). Acknowledgements do not include the address so they are matched
+to the oldest data frame waiting. After an error or a timeout, responses
+are ignored for one timeout (so a late acknowledgement is not matched to
+the wrong frame), then the address is set again and the data is sent
+again from the frame which failed.
+
+The bootloader adds every data byte it receives to a 16 bit checksum, so
+the checksum sent at the end is for all the data frames sent (including
+any sent again). If a frame was lost the checksums do not match and the
+whole image is sent again (up to retries times).
+
+As the bootloader identifiers are fixed, every node in bootloader mode on
+a bus accepts the same data, so only one node can be uploaded at a time on
+each bus. FirmwareUploadGroup runs uploads on different transports at the
+same time and queues the uploads on the same transport.
+"""
+
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple, Union
+from .canusb import DIRECTION_TX
+from .extended import encode_extended, parse_extended
+from .exceptions import InvalidConfigurationError
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Bootloader extended identifiers
+ID_CONTROL = 0x00000004
+ID_DATA = 0x00000005
+ID_RESPONSE = 0x10000004
+
+# Control bits
+MODE_WRT_UNLCK = 0x01
+MODE_ERASE_ONLY = 0x02
+MODE_AUTO_ERASE = 0x04
+MODE_AUTO_INC = 0x08
+MODE_ACK = 0x10
+CONTROL_BITS = MODE_WRT_UNLCK | MODE_AUTO_ERASE | MODE_AUTO_INC | MODE_ACK
+
+# Bootloader commands
+CMD_NOP = 0x00
+CMD_RESET = 0x01
+CMD_RST_CHKSM = 0x02
+CMD_CHK_RUN = 0x03
+
+# Program memory after the bootloader (config and EEPROM are not written)
+PROGRAM_START = 0x000800
+PROGRAM_END = 0x300000
+
+FRAME_SIZE = 8
+# Flash is erased in rows so whole rows are written
+ROW_SIZE = 64
+
+# Intel HEX record types
+RECORD_DATA = 0x00
+RECORD_EOF = 0x01
+RECORD_SEGMENT = 0x02
+RECORD_LINEAR = 0x04
+
+# Upload status
+STATUS_PENDING = "pending"
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+
+# Upload states
+STATE_BOOT = "boot"
+STATE_DATA = "data"
+STATE_CHECK = "check"
+STATE_DONE = "done"
+
+
+def read_intel_hex (source: Union[str, Iterable[str]]) -> Dict[int, int]:
+    """Read an Intel HEX image
+
+    Supports data, end of file, extended segment and extended linear
+    address records (start address records are ignored).
+
+    Args:
+        source: Contents of the file as a string, or an iterable of lines (eg. open file)
+
+    Returns:
+        Dict of byte values indexed by address
+
+    Raises:
+        ValueError: If a line is invalid or the checksum is wrong
+    """
+    if isinstance(source, str):
+        source = source.splitlines()
+    memory: Dict[int, int] = {}
+    base = 0
+    for number, line in enumerate(source, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] != ":":
+            raise ValueError(f"Line {number} does not start with ':'")
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError(f"Line {number} is not hex") from None
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError(f"Line {number} has the wrong length")
+        if sum(record) & 0xFF:
+            raise ValueError(f"Line {number} checksum error")
+        record_type = record[3]
+        data = record[4:-1]
+        if record_type == RECORD_DATA:
+            address = base + (record[1] << 8) + record[2]
+            for offset, value in enumerate(data):
+                memory[address + offset] = value
+        elif record_type == RECORD_EOF:
+            break
+        elif record_type == RECORD_SEGMENT:
+            base = int.from_bytes(data, 'big') << 4
+        elif record_type == RECORD_LINEAR:
+            base = int.from_bytes(data, 'big') << 16
+    return memory
+
+
+class FirmwareImage:
+    """Program memory to upload, as data frames
+
+    Only addresses from start to end are included (so the bootloader is
+    not overwritten). Each row containing any data is sent in full, with
+    unused bytes set to 0xFF.
+
+    Attributes:
+        frames: List of (address, 8 bytes) in address order
+    """
+    def __init__ (self, memory: Dict[int, int], start: int = PROGRAM_START, end: int = PROGRAM_END) -> None:
+        """Inits FirmwareImage
+
+        Args:
+            memory: Byte values indexed by address (eg. from read_intel_hex)
+            start: First address to write
+            end: Address after the last address to write
+        """
+        rows = sorted({address - address % ROW_SIZE for address in memory if start <= address < end})
+        self.frames: List[Tuple[int, bytes]] = []
+        for row in rows:
+            for address in range(max(row, start), min(row + ROW_SIZE, end), FRAME_SIZE):
+                self.frames.append((address, bytes(memory.get(address + offset, 0xFF)
+                                                   for offset in range(FRAME_SIZE))))
+
+    @classmethod
+    def from_file (cls, filename: str, start: int = PROGRAM_START, end: int = PROGRAM_END) -> "FirmwareImage":
+        """Read an image from an Intel HEX file
+
+        Raises:
+            ValueError: If the file is not valid Intel HEX
+        """
+        with open(filename) as hex_file:
+            return cls(read_intel_hex(hex_file), start, end)
+
+    @property
+    def size (self) -> int:
+        """Number of bytes to send"""
+        return len(self.frames) * FRAME_SIZE
+
+    def checksum (self) -> int:
+        """Checksum sent to the bootloader when each frame is sent once"""
+        return -sum(sum(data) for address, data in self.frames) & 0xFFFF
+
+
+class FirmwareUploader:
+    """Upload a firmware image to one node
+
+    Either call run, which reads from the transport until the upload has
+    finished, or pass each received packet to receive (or add record as a
+    CanUSB4 listener) and call poll regularly until it returns True.
+
+    The progress function (if set) is called with the uploader each time
+    a data frame is acknowledged.
+
+    Attributes:
+        node: Node number sent with BOOTM
+        status: STATUS_PENDING, STATUS_OK or STATUS_FAILED
+        error: Reason the upload failed
+        state: Current stage of the upload (STATE_BOOT etc.)
+        acknowledged: Number of data frames acknowledged
+        frames_sent: Number of data frames sent (including sent again)
+        frames_resent: Number of data frames sent again
+        naks: Number of error responses
+        timeouts: Number of times there was no response
+        attempts: Number of times the whole image has been sent
+    """
+    def __init__ (self,
+                  vlcb,
+                  transport,
+                  node: int,
+                  image: FirmwareImage,
+                  window: int = 8,
+                  timeout: float = 0.5,
+                  retries: int = 3,
+                  boot_delay: float = 0.5,
+                  send_bootm: bool = True,
+                  progress: Optional[Callable[["FirmwareUploader"], None]] = None,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits FirmwareUploader
+
+        Args:
+            vlcb: VLCB object used to create BOOTM
+            transport: Object with send_data (and read_data if using run) eg. CanUSB4
+            node: Node number (0 for a SLiM node with no node number)
+            image: FirmwareImage to upload
+            window: Maximum number of data frames waiting for acknowledgement
+            timeout: Time in seconds to wait for each response
+            retries: Number of times a frame (or the whole image) is sent again
+            boot_delay: Time in seconds for the node to restart in bootloader mode
+            send_bootm: Send BOOTM (False if the node is already in bootloader mode)
+            progress: Function called with this uploader when a data frame is acknowledged
+            clock: Function returning the current time in seconds
+        """
+        if window < 1:
+            raise InvalidConfigurationError(f"Window must be at least 1, not {window}")
+        if not image.frames:
+            raise InvalidConfigurationError("Firmware image has no program data")
+        self.vlcb = vlcb
+        self.transport = transport
+        self.node = node
+        self.image = image
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.boot_delay = boot_delay
+        self.send_bootm = send_bootm
+        self.progress = progress
+        self.clock = clock
+        self.status = STATUS_PENDING
+        self.error: Optional[str] = None
+        self.state = STATE_BOOT
+        self.acknowledged = 0
+        self.frames_sent = 0
+        self.frames_resent = 0
+        self.naks = 0
+        self.timeouts = 0
+        self.attempts = 0
+        # Index of the next frame to send and the frames waiting for acknowledgement
+        self._next = 0
+        self._inflight: Deque[int] = deque()
+        # Next address the bootloader will write (None if not known)
+        self._address: Optional[int] = None
+        # Highest frame sent this attempt (frames before it are being sent again)
+        self._sent_to = 0
+        # Responses are ignored until this time after an error
+        self._quiet_until = 0.0
+        # Failures since the last acknowledgement
+        self._failures = 0
+        self._sum = 0
+        self._deadline = 0.0
+        self._started: Optional[float] = None
+        self._finished_time: Optional[float] = None
+
+    @property
+    def done (self) -> bool:
+        """True when the upload has finished (successfully or not)"""
+        return self.status != STATUS_PENDING
+
+    @property
+    def bytes_acknowledged (self) -> int:
+        """Number of bytes of the image acknowledged by the bootloader"""
+        return self.acknowledged * FRAME_SIZE
+
+    def elapsed (self) -> float:
+        """Time in seconds since BOOTM was sent"""
+        if self._started is None:
+            return 0.0
+        end = self._finished_time if self._finished_time is not None else self.clock()
+        return end - self._started
+
+    def throughput (self) -> float:
+        """Bytes of the image acknowledged per second"""
+        elapsed = self.elapsed()
+        return self.bytes_acknowledged / elapsed if elapsed > 0 else 0.0
+
+    def stats (self) -> Dict[str, Union[int, float, str]]:
+        """Progress as a dict"""
+        return {
+            'node': self.node,
+            'status': self.status,
+            'state': self.state,
+            'size': self.image.size,
+            'acknowledged': self.bytes_acknowledged,
+            'frames_sent': self.frames_sent,
+            'frames_resent': self.frames_resent,
+            'naks': self.naks,
+            'timeouts': self.timeouts,
+            'attempts': self.attempts,
+            'elapsed': self.elapsed(),
+            'throughput': self.throughput()
+        }
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Check a received frame (signature matches CanUSB4.add_listener)"""
+        if direction != DIRECTION_TX:
+            self.receive(packet)
+
+    def receive (self, packet: Union[str, bytes]) -> None:
+        """Check a received frame for a bootloader response"""
+        if self.done:
+            return
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 12 or packet[1] != "X":
+            return
+        try:
+            frame = parse_extended(packet)
+        except ValueError:
+            return
+        if frame.identifier != ID_RESPONSE or not frame.data:
+            return
+        now = self.clock()
+        if now < self._quiet_until:
+            return
+        ok = frame.data[0] == 1
+        if self.state == STATE_DATA:
+            self._data_response(ok, now)
+        elif self.state == STATE_CHECK:
+            self._check_response(ok, now)
+
+    def _data_response (self, ok: bool, now: float) -> None:
+        if not self._inflight:
+            return
+        if ok:
+            self.acknowledged = max(self.acknowledged, self._inflight.popleft() + 1)
+            self._failures = 0
+            self._deadline = now + self.timeout
+            self._report()
+        else:
+            self.naks += 1
+            logger.debug("Node %s error writing %06X", self.node, self.image.frames[self._inflight[0]][0])
+            self._rewind(now, "Write error")
+
+    def _check_response (self, ok: bool, now: float) -> None:
+        if ok:
+            self._send_control(self.image.frames[0][0], CMD_RESET)
+            self._finish(STATUS_OK, None, now)
+            logger.info("Node %s upload complete %d bytes in %.1fs", self.node, self.image.size, self.elapsed())
+        elif self.attempts <= self.retries:
+            logger.warning("Node %s checksum error - sending the image again", self.node)
+            self._start_attempt(now)
+        else:
+            self._finish(STATUS_FAILED, "Checksum error", now)
+
+    # Send again from the oldest frame waiting for acknowledgement
+    def _rewind (self, now: float, reason: str) -> None:
+        self._failures += 1
+        if self._failures > self.retries:
+            self._finish(STATUS_FAILED, f"{reason} at {self.image.frames[self._inflight[0]][0]:06X}", now)
+            return
+        self._next = self._inflight[0]
+        self._inflight.clear()
+        self._quiet_until = now + self.timeout
+        self._address = None
+
+    def _finish (self, status: str, error: Optional[str], now: float) -> None:
+        self.status = status
+        self.error = error
+        self.state = STATE_DONE
+        self._inflight.clear()
+        self._finished_time = now
+        if error is not None:
+            logger.warning("Node %s upload failed: %s", self.node, error)
+        self._report()
+
+    def _report (self) -> None:
+        if self.progress is not None:
+            try:
+                self.progress(self)
+            except Exception:
+                logger.exception("Error in firmware progress function")
+
+    def poll (self) -> bool:
+        """Send the next data frames and handle timeouts
+
+        Returns:
+            Bool: True when the upload has finished
+        """
+        if self.done:
+            return True
+        now = self.clock()
+        if self.state == STATE_BOOT:
+            if self._started is None:
+                self._started = now
+                self._deadline = now + self.boot_delay
+                if self.send_bootm:
+                    self.transport.send_data(self.vlcb.bootloader_mode(self.node))
+            if now >= self._deadline:
+                self._start_attempt(now)
+        elif self.state == STATE_DATA:
+            if self._inflight and now >= self._deadline:
+                self.timeouts += 1
+                logger.debug("Node %s no response", self.node)
+                self._rewind(now, "No response")
+            if not self.done:
+                self._send_frames(now)
+        elif self.state == STATE_CHECK and now >= self._deadline:
+            self.timeouts += 1
+            self._failures += 1
+            if self._failures > self.retries:
+                self._finish(STATUS_FAILED, "No response to checksum", now)
+            else:
+                self._send_check(now)
+        return self.done
+
+    def _start_attempt (self, now: float) -> None:
+        self.attempts += 1
+        self.state = STATE_DATA
+        self._next = 0
+        self._sent_to = 0
+        self._inflight.clear()
+        self._quiet_until = 0.0
+        self._failures = 0
+        self._sum = 0
+        self._address = None
+        self.acknowledged = 0
+        self._send_control(self.image.frames[0][0], CMD_RST_CHKSM)
+
+    def _send_frames (self, now: float) -> None:
+        if now < self._quiet_until:
+            return
+        frames = self.image.frames
+        while len(self._inflight) < self.window and self._next < len(frames):
+            address, data = frames[self._next]
+            if address != self._address:
+                self._send_control(address, CMD_NOP)
+            if not self._inflight:
+                self._deadline = now + self.timeout
+            self.transport.send_data(encode_extended(ID_DATA, data))
+            self._sum += sum(data)
+            self._address = address + FRAME_SIZE
+            self._inflight.append(self._next)
+            self.frames_sent += 1
+            if self._next < self._sent_to:
+                self.frames_resent += 1
+            self._next += 1
+            self._sent_to = max(self._sent_to, self._next)
+        if self._next >= len(frames) and not self._inflight:
+            self.state = STATE_CHECK
+            self._failures = 0
+            self._send_check(now)
+
+    def _send_check (self, now: float) -> None:
+        self._deadline = now + self.timeout
+        self._send_control(self.image.frames[0][0], CMD_CHK_RUN, -self._sum & 0xFFFF)
+
+    def _send_control (self, address: int, command: int, checksum: int = 0) -> None:
+        self.transport.send_data(encode_extended(ID_CONTROL, (
+            address & 0xFF, (address >> 8) & 0xFF, (address >> 16) & 0xFF, 0,
+            CONTROL_BITS, command, checksum & 0xFF, checksum >> 8)))
+
+    def run (self, timeout: Optional[float] = None, interval: float = 0.001) -> bool:
+        """Upload the image and wait for it to finish
+
+        Args:
+            timeout: Maximum time in seconds (default no limit)
+            interval: Time to wait when no data is received
+
+        Returns:
+            Bool: True if the upload was successful
+        """
+        end = self.clock() + timeout if timeout is not None else None
+        while not self.poll() and (end is None or self.clock() < end):
+            packets = self.transport.read_data()
+            for packet in packets:
+                self.receive(packet)
+            if not packets:
+                time.sleep(interval)
+        return self.status == STATUS_OK
+
+
+class FirmwareUploadGroup:
+    """Upload firmware to several nodes
+
+    Uploads on different transports (buses) run at the same time. The
+    bootloader identifiers are fixed, so uploads on the same transport are
+    run one after another - the next node is only put into bootloader mode
+    once the previous upload has finished.
+
+        group = FirmwareUploadGroup()
+        group.add(FirmwareUploader(vlcb, usb1, 256, image))
+        group.add(FirmwareUploader(vlcb, usb2, 257, image))
+        group.run()
+    """
+    def __init__ (self, clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits FirmwareUploadGroup
+
+        Args:
+            clock: Function returning the current time in seconds
+        """
+        self.clock = clock
+        self.uploaders: List[FirmwareUploader] = []
+        # Uploads waiting for each transport (the first is the current upload)
+        self._queues: Dict[int, Deque[FirmwareUploader]] = {}
+        self._transports: Dict[int, object] = {}
+        self._started: Optional[float] = None
+        self._finished_time: Optional[float] = None
+
+    def add (self, uploader: FirmwareUploader) -> FirmwareUploader:
+        """Add an upload
+
+        Raises:
+            InvalidConfigurationError: If the node has already been added for the same transport
+        """
+        key = id(uploader.transport)
+        queue = self._queues.setdefault(key, deque())
+        if any(queued.node == uploader.node for queued in queue):
+            raise InvalidConfigurationError(f"Node {uploader.node} has already been added")
+        queue.append(uploader)
+        self._transports[key] = uploader.transport
+        self.uploaders.append(uploader)
+        return uploader
+
+    def active (self) -> List[FirmwareUploader]:
+        """Uploads in progress (one for each transport)"""
+        return [queue[0] for queue in self._queues.values() if queue]
+
+    def receive (self, transport, packet: Union[str, bytes]) -> None:
+        """Pass a received frame to the current upload on a transport"""
+        queue = self._queues.get(id(transport))
+        if queue:
+            queue[0].receive(packet)
+
+    def poll (self) -> bool:
+        """Poll the current upload on each transport
+
+        Returns:
+            Bool: True when all uploads have finished
+        """
+        now = self.clock()
+        if self._started is None:
+            self._started = now
+        for queue in self._queues.values():
+            while queue and queue[0].poll():
+                queue.popleft()
+        done = not any(self._queues.values())
+        if done and self._finished_time is None:
+            self._finished_time = now
+        return done
+
+    def elapsed (self) -> float:
+        """Time in seconds since the first poll"""
+        if self._started is None:
+            return 0.0
+        end = self._finished_time if self._finished_time is not None else self.clock()
+        return end - self._started
+
+    def throughput (self) -> float:
+        """Total bytes acknowledged per second for all the uploads"""
+        elapsed = self.elapsed()
+        return sum(uploader.bytes_acknowledged for uploader in self.uploaders) / elapsed if elapsed > 0 else 0.0
+
+    def stats (self) -> Dict[str, Union[int, float]]:
+        """Progress as a dict of total, completed, failed, bytes, elapsed and throughput"""
+        return {
+            'total': len(self.uploaders),
+            'completed': sum(1 for uploader in self.uploaders if uploader.done),
+            'failed': sum(1 for uploader in self.uploaders if uploader.status == STATUS_FAILED),
+            'bytes': sum(uploader.bytes_acknowledged for uploader in self.uploaders),
+            'elapsed': self.elapsed(),
+            'throughput': self.throughput()
+        }
+
+    def run (self, timeout: Optional[float] = None, interval: float = 0.001) -> bool:
+        """Run all the uploads
+
+        Args:
+            timeout: Maximum time in seconds (default no limit)
+            interval: Time to wait when no data is received
+
+        Returns:
+            Bool: True if all uploads were successful
+        """
+        end = self.clock() + timeout if timeout is not None else None
+        while not self.poll() and (end is None or self.clock() < end):
+            received = False
+            for key, transport in self._transports.items():
+                if not self._queues[key]:
+                    continue
+                packets = transport.read_data()
+                for packet in packets:
+                    self.receive(transport, packet)
+                received = received or bool(packets)
+            if not received:
+                time.sleep(interval)
+        return all(uploader.status == STATUS_OK for uploader in self.uploaders)
@@ -0,0 +1,172 @@
+""" Loco function state stored as a bitmask """
+
+from typing import Iterable, List, Tuple
+
+# Highest function number - DFNON / DFNOF use a single byte
+MAX_FUNCTION = 255
+
+# DFUN groups - (first function, last function) for group 1 to 5
+# Group 1 also includes F0 (bit 4)
+dfun_groups = {
+    1: (1, 4),
+    2: (5, 8),
+    3: (9, 12),
+    4: (13, 20),
+    5: (21, 28)
+}
+
+
+class LocoFunctions:
+    """Function state (F0 upwards) for a loco
+
+    Stored as a single int with bit n for function Fn, so setting,
+    clearing and reading a function does not need a list. Can create the
+    DFUN bytes for each group and be updated directly from a PLOC.
+
+    Attributes:
+        mask: Bitmask of functions that are on (bit 0 = F0)
+    """
+    def __init__ (self, mask: int = 0) -> None:
+        """Inits LocoFunctions
+
+        Args:
+            mask: Initial bitmask (bit 0 = F0)
+        """
+        self.mask = mask
+
+    @staticmethod
+    def _check (f_num: int) -> int:
+        if f_num < 0 or f_num > MAX_FUNCTION:
+            raise ValueError (f"Fnumber needs to be between 0 and {MAX_FUNCTION}. Number provided {f_num}")
+        return 1 << f_num
+
+    @classmethod
+    def from_list (cls, function_status: Iterable[int]) -> "LocoFunctions":
+        """Create from a list of 0 / 1 values (as used by f_to_bytes)"""
+        mask = 0
+        for f_num, value in enumerate(function_status):
+            if value:
+                mask |= 1 << f_num
+        return cls(mask)
+
+    @classmethod
+    def from_ploc (cls, fn1: int, fn2: int, fn3: int) -> "LocoFunctions":
+        """Create from the Fn1, Fn2 and Fn3 bytes of a PLOC"""
+        functions = cls()
+        functions.update_from_ploc(fn1, fn2, fn3)
+        return functions
+
+    def update_from_ploc (self, fn1: int, fn2: int, fn3: int) -> None:
+        """Update F0 to F12 from the Fn1, Fn2 and Fn3 bytes of a PLOC
+
+        Args:
+            fn1: F0 (bit 4) and F1 to F4 (bits 0 to 3)
+            fn2: F5 to F8 (bits 0 to 3)
+            fn3: F9 to F12 (bits 0 to 3)
+        """
+        ploc_mask = (((fn1 >> 4) & 1) | ((fn1 & 0xF) << 1) |
+                     ((fn2 & 0xF) << 5) | ((fn3 & 0xF) << 9))
+        self.mask = (self.mask & ~0x1FFF) | ploc_mask
+
+    def get (self, f_num: int) -> int:
+        """Returns 1 if function is on, 0 if off"""
+        return 1 if self.mask & self._check(f_num) else 0
+
+    def set (self, f_num: int) -> None:
+        """Turn function on"""
+        self.mask |= self._check(f_num)
+
+    def clear (self, f_num: int) -> None:
+        """Turn function off"""
+        self.mask &= ~self._check(f_num)
+
+    def toggle (self, f_num: int) -> int:
+        """Change function state
+
+        Returns:
+            Int: New value 1 (on) or 0 (off)
+        """
+        self.mask ^= self._check(f_num)
+        return self.get(f_num)
+
+    def __getitem__ (self, f_num: int) -> int:
+        return self.get(f_num)
+
+    def __setitem__ (self, f_num: int, value: int) -> None:
+        if value:
+            self.set(f_num)
+        else:
+            self.clear(f_num)
+
+    def __eq__ (self, other) -> bool:
+        return isinstance(other, LocoFunctions) and other.mask == self.mask
+
+    def __repr__ (self) -> str:
+        return f"LocoFunctions({hex(self.mask)})"
+
+    def to_list (self, length: int = 29) -> List[int]:
+        """Returns list of 0 / 1 values for F0 upwards (as bytes_to_functions)"""
+        return [(self.mask >> f_num) & 1 for f_num in range(length)]
+
+    @staticmethod
+    def group (f_num: int) -> int:
+        """DFUN group (1 to 5) for a function number 0 to 28
+
+        Raises:
+            ValueError: If function is above F28 (use DFNON / DFNOF)
+        """
+        if f_num < 0 or f_num > 28:
+            raise ValueError (f"Fnumber needs to be between 0 and 28. Number provided {f_num}")
+        if f_num <= 4:
+            return 1
+        if f_num <= 8:
+            return 2
+        if f_num <= 12:
+            return 3
+        if f_num <= 20:
+            return 4
+        return 5
+
+    def group_byte (self, group: int) -> int:
+        """Second DFUN byte for a group (1 to 5)"""
+        mask = self.mask
+        if group == 1:
+            # F0 is bit 4, F1 to F4 bits 0 to 3
+            return ((mask >> 1) & 0xF) | ((mask & 1) << 4)
+        if group not in dfun_groups:
+            raise ValueError (f"DFUN group needs to be between 1 and 5. Group provided {group}")
+        first, last = dfun_groups[group]
+        return (mask >> first) & ((1 << (last - first + 1)) - 1)
+
+    def dfun_bytes (self, f_num: int) -> Tuple[int, int]:
+        """DFUN bytes for the group containing a function
+
+        Returns:
+            Tuple of (group, function byte) for VLCB.loco_set_dfun
+        """
+        group = self.group(f_num)
+        return (group, self.group_byte(group))
+
+    def all_dfun_bytes (self) -> List[Tuple[int, int]]:
+        """DFUN bytes for all 5 groups (F0 to F28)"""
+        return [(group, self.group_byte(group)) for group in dfun_groups]
+
+    def command (self, vlcb, session_id: int, f_num: int) -> str:
+        """Create the request to send the current state of a function
+
+        Uses DFUN for F0 to F28 (whole group is sent), or DFNON / DFNOF above F28
+
+        Args:
+            vlcb: VLCB object used to create the request
+            session_id: Session ID
+            f_num: Function number
+
+        Returns:
+            String: A string for the request
+        """
+        if f_num <= 28:
+            group, byte2 = self.dfun_bytes(f_num)
+            return vlcb.loco_set_dfun(session_id, group, byte2)
+        if self.get(f_num):
+            return vlcb.loco_function_on(session_id, f_num)
+        return vlcb.loco_function_off(session_id, f_num)
@@ -0,0 +1,292 @@
+""" Request / response latency histograms
+
+Measures the time between a request and the matching response for
+RLOC -> PLOC (or ERR), QNN -> PNN, RQNPN -> PARAN and NVRD -> NVANS.
+Times are stored in histograms with logarithmic buckets so recording a
+time is a single increment and memory use is fixed. Results can be
+exported in the Prometheus text format to a file or over HTTP.
+"""
+
+import bisect
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple, Union
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Bucket upper bounds in seconds - 4 buckets per doubling from 100us to about 100s
+BUCKET_BOUNDS = tuple(0.0001 * 2 ** (n / 4) for n in range(81))
+
+# Default time to wait for a response
+TIMEOUT = 5.0
+
+METRIC_NAME = "vlcb_request_latency_seconds"
+
+
+class LatencyHistogram:
+    """Histogram of times using logarithmic buckets
+
+    Percentiles are the upper bound of the bucket containing the
+    percentile (limited to the maximum), so are within one bucket
+    (about 19%) of the actual value.
+
+    Attributes:
+        count: Number of times recorded
+        total: Sum of all times
+        maximum: Largest time
+        buckets: Count for each bucket in BUCKET_BOUNDS (plus one for larger times)
+    """
+    def __init__ (self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def add (self, value: float) -> None:
+        """Record a time in seconds"""
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def percentile (self, percent: float) -> float:
+        """Get a percentile eg. percentile(99)
+
+        Returns:
+            Float: Time in seconds (0.0 if no times recorded)
+        """
+        if self.count == 0:
+            return 0.0
+        target = max(1, math.ceil(self.count * percent / 100))
+        cumulative = 0
+        for index, bucket_count in enumerate(self.buckets):
+            cumulative += bucket_count
+            if cumulative >= target:
+                if index >= len(BUCKET_BOUNDS):
+                    return self.maximum
+                return min(BUCKET_BOUNDS[index], self.maximum)
+        return self.maximum
+
+    def summary (self) -> Dict[str, float]:
+        """Count, p50, p90, p99 and max"""
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.maximum
+        }
+
+
+# Key for a histogram (request mnemonic, label, target)
+# label is "node" for node requests or "address" for loco requests
+HistogramKey = Tuple[str, str, int]
+
+
+class LatencyTracker:
+    """Match requests to responses and record the time between them
+
+    Attach to the send and receive paths as a CanUSB4 listener:
+    usb.add_listener(tracker.record)
+    Requests and responses are matched whichever direction they are seen
+    in, so requests from other controllers on the bus are also measured.
+
+    Attributes:
+        timeout: Requests without a response after this time are counted as a timeout
+        histograms: LatencyHistogram for each (request, label, target)
+        timeouts: Number of timeouts for each (request, label, target)
+    """
+    def __init__ (self, timeout: float = TIMEOUT, clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits LatencyTracker
+
+        Args:
+            timeout: Time in seconds to wait for a response
+            clock: Function returning the current time in seconds
+        """
+        self.timeout = timeout
+        self.clock = clock
+        self.histograms: Dict[HistogramKey, LatencyHistogram] = {}
+        self.timeouts: Dict[HistogramKey, int] = {}
+        self._lock = threading.Lock()
+        # Requests waiting for a response in time order - key is (opcode, values in request)
+        self._pending: "OrderedDict[Tuple, Tuple[float, HistogramKey]]" = OrderedDict()
+        # Time of last QNN and nodes which have responded
+        self._qnn_time: Optional[float] = None
+        self._qnn_nodes: set = set()
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Check a frame for a request or response (signature matches CanUSB4.add_listener)"""
+        self.add(packet)
+
+    def add (self, packet: Union[str, bytes], timestamp: Optional[float] = None) -> None:
+        """Check a frame for a request or response
+
+        Args:
+            packet: Packet eg. ':SB780N7101000001;'
+            timestamp: Time of the frame (default is current time)
+        """
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 10 or packet[1] != "S":
+            return
+        try:
+            opcode = int(packet[7:9], 16)
+            now = self.clock() if timestamp is None else timestamp
+            with self._lock:
+                self._expire(now)
+                self._check(opcode, packet, now)
+        except ValueError:
+            return
+
+    # Fields are at fixed positions in the packet (data starts at 7)
+    # Must be called with the lock held
+    def _check (self, opcode: int, packet: str, now: float) -> None:
+        # Requests
+        if opcode == 0x40 and len(packet) >= 14:
+            # RLOC AddrHigh_AddrLow
+            address = int(packet[9:13], 16)
+            self._add_request(('loco', address), now, ('RLOC', 'address', address & 0x3FFF))
+        elif (opcode == 0x73 or opcode == 0x71) and len(packet) >= 16:
+            # RQNPN / NVRD NN,Index
+            node = int(packet[9:13], 16)
+            index = int(packet[13:15], 16)
+            request = 'RQNPN' if opcode == 0x73 else 'NVRD'
+            self._add_request((opcode, node, index), now, (request, 'node', node))
+        elif opcode == 0x0D:
+            self._qnn_time = now
+            self._qnn_nodes = set()
+        # Responses
+        elif opcode == 0xE1 and len(packet) >= 16:
+            # PLOC Session,AddrHigh_AddrLow
+            self._response(('loco', int(packet[11:15], 16)), now)
+        elif opcode == 0x63 and len(packet) >= 14:
+            # ERR Byte1,Byte2 (loco address),ErrCode
+            self._response(('loco', int(packet[9:13], 16)), now)
+        elif (opcode == 0x9B or opcode == 0x97) and len(packet) >= 16:
+            # PARAN / NVANS NN,Index,Value
+            request_opcode = 0x73 if opcode == 0x9B else 0x71
+            self._response((request_opcode, int(packet[9:13], 16), int(packet[13:15], 16)), now)
+        elif opcode == 0xB6 and len(packet) >= 14 and self._qnn_time is not None:
+            # PNN - each node responds once to QNN
+            node = int(packet[9:13], 16)
+            if node not in self._qnn_nodes:
+                self._qnn_nodes.add(node)
+                self._add_time(('QNN', 'node', node), now - self._qnn_time)
+
+    def _add_request (self, match: Tuple, now: float, key: HistogramKey) -> None:
+        # A repeated request replaces the earlier one
+        self._pending.pop(match, None)
+        self._pending[match] = (now, key)
+
+    def _response (self, match: Tuple, now: float) -> None:
+        entry = self._pending.pop(match, None)
+        if entry is not None:
+            self._add_time(entry[1], now - entry[0])
+
+    def _add_time (self, key: HistogramKey, value: float) -> None:
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            self.histograms[key] = histogram
+        histogram.add(value)
+
+    # Remove requests which have timed out (oldest are first)
+    def _expire (self, now: float) -> None:
+        pending = self._pending
+        while pending:
+            match, (sent, key) = next(iter(pending.items()))
+            if now - sent <= self.timeout:
+                break
+            del pending[match]
+            self.timeouts[key] = self.timeouts.get(key, 0) + 1
+        if self._qnn_time is not None and now - self._qnn_time > self.timeout:
+            self._qnn_time = None
+
+    def summary (self) -> Dict[HistogramKey, Dict[str, float]]:
+        """Count, p50, p90, p99 and max for each request and target"""
+        with self._lock:
+            return {key: histogram.summary() for key, histogram in self.histograms.items()}
+
+    def prometheus_text (self) -> str:
+        """Export all histograms in the Prometheus text exposition format
+
+        Returns:
+            String: Metrics including a histogram, quantiles and timeouts
+                for each request and target
+        """
+        with self._lock:
+            self._expire(self.clock())
+            items = sorted(self.histograms.items())
+            timeouts = sorted(self.timeouts.items())
+        lines = [
+            f"# HELP {METRIC_NAME} Time between a VLCB request and its response",
+            f"# TYPE {METRIC_NAME} histogram"
+        ]
+        for (request, label, target), histogram in items:
+            labels = f'request="{request}",{label}="{target}"'
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKET_BOUNDS, histogram.buckets):
+                cumulative += bucket_count
+                lines.append(f'{METRIC_NAME}_bucket{{{labels},le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'{METRIC_NAME}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{METRIC_NAME}_sum{{{labels}}} {histogram.total:.6g}')
+            lines.append(f'{METRIC_NAME}_count{{{labels}}} {histogram.count}')
+        lines.append(f"# HELP {METRIC_NAME}_quantile Estimated percentile of the request latency")
+        lines.append(f"# TYPE {METRIC_NAME}_quantile gauge")
+        for (request, label, target), histogram in items:
+            labels = f'request="{request}",{label}="{target}"'
+            for quantile in (0.5, 0.9, 0.99):
+                lines.append(f'{METRIC_NAME}_quantile{{{labels},quantile="{quantile}"}} {histogram.percentile(quantile * 100):.6g}')
+            lines.append(f'{METRIC_NAME}_quantile{{{labels},quantile="1"}} {histogram.maximum:.6g}')
+        lines.append("# HELP vlcb_request_timeouts_total Requests without a response")
+        lines.append("# TYPE vlcb_request_timeouts_total counter")
+        for (request, label, target), count in timeouts:
+            lines.append(f'vlcb_request_timeouts_total{{request="{request}",{label}="{target}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus (self, filename: str) -> None:
+        """Write the metrics to a file (eg. for the node exporter textfile collector)
+
+        The file is replaced in a single step so a partly written file is never read.
+        """
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_filename, filename)
+
+    def serve_prometheus (self, port: int, address: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve the metrics over HTTP in a background thread
+
+        Args:
+            port: TCP port (0 to choose a free port)
+            address: Address to listen on (default is local only)
+
+        Returns:
+            ThreadingHTTPServer: Call shutdown() and server_close() to stop
+        """
+        tracker = self
+
+        class MetricsHandler (BaseHTTPRequestHandler):
+            def do_GET (self) -> None:
+                body = tracker.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message (self, format: str, *args) -> None:
+                logger.debug(format, *args)
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
@@ -0,0 +1,219 @@
+""" Streaming analysis of log files
+
+Log files have one packet per line in the num,date,direction,message
+format used by VLCB.log_entry. The file is read in large chunks and
+results are returned by a generator, so memory use does not depend on
+the size of the file. Large files can be split across multiple
+processes with the results returned in the original order.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from .vlcbformat import VLCBOpcode
+from .utils import dict_to_string
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Output formats
+OUTPUT_ROWS = "rows"          # Same list of strings as VLCB.log_entry
+OUTPUT_RECORDS = "records"    # Dict of values
+
+# Default size of each read
+CHUNK_SIZE = 1 << 20
+
+# Size of the part of the file sent to each process
+SEGMENT_SIZE = 8 << 20
+
+
+def iter_lines (filename: str, chunk_size: int = CHUNK_SIZE, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+    """Read lines from a file in large chunks
+
+    Args:
+        filename: File to read
+        chunk_size: Number of bytes for each read
+        start: Position to start (must be the start of a line)
+        end: Position to stop (must be the start of a line) or None for end of file
+
+    Returns:
+        Iterator of lines without the line ending (empty lines are skipped)
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        partial = b""
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            lines = (partial + chunk).split(b"\n")
+            partial = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield line.decode("utf-8", "replace")
+        partial = partial.strip()
+        if partial:
+            yield partial.decode("utf-8", "replace")
+
+
+# Decoded values which are the same every time a message is seen
+# Cached so repeated messages (eg. DKEEP) are only decoded once
+@lru_cache(maxsize=4096)
+def _decode_message (message: str) -> Tuple[Any, ...]:
+    if len(message) < 8 or message[0] != ":" or message[1] != "S":
+        raise ValueError(f"Invalid packet {message}")
+    header_val = int(message[2:6], 16)
+    priority = (header_val & 0xf000) >> 12
+    can_id = (header_val & 0xfe0) >> 5
+    data = message[7:-1]
+    opcode = data[0:2]
+    fields = VLCBOpcode.parse_data(data)
+    opcode_string = f'{opcode} - {VLCBOpcode.opcode_mnemonic(opcode)}'
+    description = VLCBOpcode.opcode_title(opcode)
+    return (priority, can_id, opcode_string, dict_to_string(fields), description, fields)
+
+
+def parse_line (line: str, output: str = OUTPUT_ROWS) -> Union[List[str], Dict[str, Any]]:
+    """Parse a single log line
+
+    Rows are the same as VLCB.log_entry. Records are a dict with num,
+    date, direction, message, priority, can_id and the fields from
+    VLCBOpcode.parse_data (including opid and opcode).
+    If the message is invalid then the row has "Invalid data" as the
+    description and the record has an error entry.
+
+    Args:
+        line: Log entry num,date,direction,message
+        output: OUTPUT_ROWS or OUTPUT_RECORDS
+
+    Returns:
+        List of strings or dict depending upon output
+    """
+    entry_parts = line.split(',', 3)
+    if len(entry_parts) < 4:
+        entry_parts += [""] * (4 - len(entry_parts))
+    num, date_string, direction, message = entry_parts
+    try:
+        priority, can_id, opcode_string, data_string, description, fields = _decode_message(message)
+    except ValueError as e:
+        if output == OUTPUT_RECORDS:
+            return {'num': num, 'date': date_string, 'direction': direction, 'message': message, 'error': str(e)}
+        return [date_string, direction, message, "", "??", "", "Invalid data"]
+    if output == OUTPUT_RECORDS:
+        record = {'num': num, 'date': date_string, 'direction': direction, 'message': message,
+                  'priority': priority, 'can_id': can_id}
+        record.update(fields)
+        return record
+    return [date_string, direction, message, str(can_id), opcode_string, data_string, description]
+
+
+def iter_log (filename: str, output: str = OUTPUT_ROWS, chunk_size: int = CHUNK_SIZE,
+              start: int = 0, end: Optional[int] = None) -> Iterator[Union[List[str], Dict[str, Any]]]:
+    """Parse a log file one entry at a time
+
+    Args:
+        filename: Log file
+        output: OUTPUT_ROWS (list of strings as VLCB.log_entry) or OUTPUT_RECORDS (dict)
+        chunk_size: Number of bytes for each read
+        start: Position to start (must be the start of a line)
+        end: Position to stop or None for end of file
+
+    Returns:
+        Iterator of parsed entries
+
+    Raises:
+        ValueError: If output is not valid
+    """
+    if output not in (OUTPUT_ROWS, OUTPUT_RECORDS):
+        raise ValueError(f"Invalid output {output}")
+    for line in iter_lines(filename, chunk_size, start, end):
+        yield parse_line(line, output)
+
+
+# Split a file into segments which start at the beginning of a line
+def split_file (filename: str, segment_size: int = SEGMENT_SIZE) -> List[Tuple[int, int]]:
+    """Split a file into parts which each start at the beginning of a line
+
+    Args:
+        filename: File to split
+        segment_size: Approximate size of each part in bytes
+
+    Returns:
+        List of (start, end) positions
+    """
+    file_size = os.path.getsize(filename)
+    segments = []
+    start = 0
+    with open(filename, "rb") as f:
+        while start < file_size:
+            end = start + segment_size
+            if end >= file_size:
+                end = file_size
+            else:
+                f.seek(end)
+                f.readline()
+                end = min(f.tell(), file_size)
+            segments.append((start, end))
+            start = end
+    return segments
+
+
+# Run in a worker process - returns all entries for the segment
+def _process_segment (filename: str, start: int, end: int, output: str, chunk_size: int) -> List[Any]:
+    return list(iter_log(filename, output, chunk_size, start, end))
+
+
+def analyse_log (filename: str,
+                 output: str = OUTPUT_ROWS,
+                 processes: Optional[int] = None,
+                 chunk_size: int = CHUNK_SIZE,
+                 segment_size: int = SEGMENT_SIZE) -> Iterator[Union[List[str], Dict[str, Any]]]:
+    """Parse a log file using multiple processes
+
+    The file is split on line boundaries and each part is parsed in a
+    separate process. Results are returned in the same order as the file.
+    Only a limited number of parts are in progress at once so memory
+    use is bounded.
+
+    Args:
+        filename: Log file
+        output: OUTPUT_ROWS or OUTPUT_RECORDS
+        processes: Number of processes (default is number of CPUs). 1 parses in this process
+        chunk_size: Number of bytes for each read
+        segment_size: Approximate size of the part sent to each process
+
+    Returns:
+        Iterator of parsed entries
+    """
+    if output not in (OUTPUT_ROWS, OUTPUT_RECORDS):
+        raise ValueError(f"Invalid output {output}")
+    if processes is None:
+        processes = os.cpu_count() or 1
+    segments = split_file(filename, segment_size)
+    if processes <= 1 or len(segments) <= 1:
+        yield from iter_log(filename, output, chunk_size)
+        return
+    logger.debug(f"Analysing {filename} in {len(segments)} parts using {processes} processes")
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        segment_iter = iter(segments)
+        # Keep two parts per process queued
+        for start, end in segment_iter:
+            pending.append(executor.submit(_process_segment, filename, start, end, output, chunk_size))
+            if len(pending) >= processes * 2:
+                break
+        while pending:
+            results = pending.popleft().result()
+            next_segment = next(segment_iter, None)
+            if next_segment is not None:
+                pending.append(executor.submit(_process_segment, filename, next_segment[0], next_segment[1], output, chunk_size))
+            yield from results
@@ -0,0 +1,238 @@
+""" Bus utilisation monitor
+
+Counts frames in one second buckets held in a fixed size ring, so memory
+use does not grow however long the monitor runs. Bus load is calculated
+from the number of bits each frame uses on the bus (including the CAN
+framing and an estimate of the stuff bits) divided by the bits available
+at the bit rate.
+
+Rates and counts are for whole seconds which have completed, so the
+second in progress (which has only been partly counted) is not included.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from .vlcbformat import VLCBOpcode
+
+# CBUS / VLCB bit rate
+BIT_RATE = 125000
+
+# Longest window in seconds
+MAX_WINDOW = 60
+# Buckets in the ring (the longest window plus the second in progress)
+RING_SIZE = MAX_WINDOW + 1
+
+# Bits which can be stuffed (SOF to end of CRC) excluding the data
+# Standard: SOF, 11 bit ID, RTR, IDE, r0, 4 bit DLC, 15 bit CRC
+# Extended: SOF, 11 bit ID, SRR, IDE, 18 bit ID, RTR, r1, r0, 4 bit DLC, 15 bit CRC
+STUFFED_BITS_STANDARD = 34
+STUFFED_BITS_EXTENDED = 54
+# CRC delimiter, ACK slot and delimiter, 7 bit EOF and 3 bit interframe space
+FIXED_BITS = 13
+
+# Stuffing as a fraction of the worst case (1.0 = every possible stuff bit)
+STUFFING_WORST = 1.0
+
+
+def frame_bits (data_length: int, extended: bool = False, stuffing: float = STUFFING_WORST) -> float:
+    """Number of bits a frame uses on the bus
+
+    A stuff bit is added after 5 bits of the same value, so the worst
+    case is one stuff bit for every 4 bits after the first.
+
+    Args:
+        data_length: Number of data bytes (0 to 8)
+        extended: True for an extended (29 bit ID) frame
+        stuffing: Fraction of the worst case stuff bits to include
+
+    Returns:
+        Float: Number of bits including framing and interframe space
+    """
+    stuffable = (STUFFED_BITS_EXTENDED if extended else STUFFED_BITS_STANDARD) + 8 * data_length
+    return stuffable + FIXED_BITS + stuffing * ((stuffable - 1) // 4)
+
+
+class _Bucket:
+    """Totals for one second"""
+    __slots__ = ("second", "frames", "bits", "opcodes", "can_ids")
+
+    def __init__ (self) -> None:
+        self.second = -1
+        self.frames = 0
+        self.bits = 0.0
+        self.opcodes: Dict[int, int] = {}
+        self.can_ids: Dict[int, int] = {}
+
+    def reset (self, second: int) -> None:
+        self.second = second
+        self.frames = 0
+        self.bits = 0.0
+        self.opcodes.clear()
+        self.can_ids.clear()
+
+
+class BusMonitor:
+    """Measure bus load and traffic by opcode and CAN ID
+
+    Attach to the receive path as a CanUSB4 listener:
+    usb.add_listener(monitor.record)
+    Frames sent and received are both counted as they both use the bus.
+
+    Attributes:
+        bit_rate: Bus bit rate in bits per second
+        stuffing: Fraction of worst case stuff bits included in the load
+        total_frames: Number of frames since the monitor was created
+    """
+    def __init__ (self, bit_rate: int = BIT_RATE, stuffing: float = STUFFING_WORST,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits BusMonitor
+
+        Args:
+            bit_rate: Bus bit rate (default 125 kbit/s)
+            stuffing: Fraction of the worst case stuff bits (0.0 to 1.0)
+            clock: Function returning the current time in seconds (default
+                time.monotonic - use time.time to add frames with wall clock timestamps)
+        """
+        self.bit_rate = bit_rate
+        self.stuffing = stuffing
+        self.clock = clock
+        self.total_frames = 0
+        self._lock = threading.Lock()
+        self._buckets = [_Bucket() for _ in range(RING_SIZE)]
+        # Bits for standard and extended frames with 0 to 8 data bytes
+        self._bits = (tuple(frame_bits(n, False, stuffing) for n in range(9)),
+                      tuple(frame_bits(n, True, stuffing) for n in range(9)))
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Count a frame (signature matches CanUSB4.add_listener)"""
+        self.add(packet)
+
+    def add (self, packet: Union[str, bytes], timestamp: Optional[float] = None) -> None:
+        """Count a frame
+
+        Packets which are not valid frames are ignored.
+
+        Args:
+            packet: Packet eg. ':SB780N2301;'
+            timestamp: Time of the frame from the same clock as the monitor
+                (default is current time). Frames with timestamps from a
+                different clock are counted in the wrong second.
+        """
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 8:
+            return
+        if packet[1] == "S":
+            data_length = (len(packet) - 8) >> 1
+            extended = 0
+        elif packet[1] == "X":
+            data_length = (len(packet) - 12) >> 1
+            extended = 1
+        else:
+            return
+        if data_length < 0 or data_length > 8:
+            return
+        can_id = opcode = None
+        try:
+            if not extended:
+                can_id = (int(packet[2:6], 16) & 0xfe0) >> 5
+                if data_length:
+                    opcode = int(packet[7:9], 16)
+        except ValueError:
+            return
+        second = int(self.clock() if timestamp is None else timestamp)
+        with self._lock:
+            bucket = self._buckets[second % RING_SIZE]
+            if bucket.second != second:
+                bucket.reset(second)
+            bucket.frames += 1
+            bucket.bits += self._bits[extended][data_length]
+            if opcode is not None:
+                bucket.opcodes[opcode] = bucket.opcodes.get(opcode, 0) + 1
+            if can_id is not None:
+                bucket.can_ids[can_id] = bucket.can_ids.get(can_id, 0) + 1
+            self.total_frames += 1
+
+    # Buckets for the last window completed seconds (not the current second)
+    def _window (self, window: int) -> List[_Bucket]:
+        if window < 1 or window > MAX_WINDOW:
+            raise ValueError(f"Window needs to be between 1 and {MAX_WINDOW} seconds")
+        now = int(self.clock())
+        return [bucket for bucket in self._buckets if now - window <= bucket.second < now]
+
+    def load (self, window: int = 1) -> float:
+        """Bus load over the last window seconds
+
+        Args:
+            window: Number of seconds (1 to 60)
+
+        Returns:
+            Float: Fraction of the bus capacity used (1.0 is saturated)
+        """
+        with self._lock:
+            bits = sum(bucket.bits for bucket in self._window(window))
+        return bits / (self.bit_rate * window)
+
+    def frame_rate (self, window: int = 1) -> float:
+        """Frames per second over the last window seconds"""
+        with self._lock:
+            frames = sum(bucket.frames for bucket in self._window(window))
+        return frames / window
+
+    def opcode_counts (self, window: int = 1) -> Dict[str, int]:
+        """Number of frames for each opcode mnemonic over the last window seconds"""
+        totals: Dict[int, int] = {}
+        with self._lock:
+            for bucket in self._window(window):
+                for opcode, count in bucket.opcodes.items():
+                    totals[opcode] = totals.get(opcode, 0) + count
+        counts: Dict[str, int] = {}
+        for opcode, count in totals.items():
+            code = f"{opcode:02X}"
+            mnemonic = VLCBOpcode.opcodes[code]['opc'] if code in VLCBOpcode.opcodes else code
+            counts[mnemonic] = counts.get(mnemonic, 0) + count
+        return counts
+
+    def can_id_counts (self, window: int = 1) -> Dict[int, int]:
+        """Number of frames from each CAN ID over the last window seconds"""
+        counts: Dict[int, int] = {}
+        with self._lock:
+            for bucket in self._window(window):
+                for can_id, count in bucket.can_ids.items():
+                    counts[can_id] = counts.get(can_id, 0) + count
+        return counts
+
+    def top_talkers (self, window: int = 10, count: int = 5) -> List[Tuple[int, float]]:
+        """CAN IDs sending the most frames
+
+        Args:
+            window: Number of seconds (1 to 60)
+            count: Maximum number of CAN IDs
+
+        Returns:
+            List of (can_id, frames per second) highest first
+        """
+        counts = self.can_id_counts(window)
+        talkers = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:count]
+        return [(can_id, frames / window) for can_id, frames in talkers]
+
+    def summary (self, windows: Tuple[int, ...] = (1, 10, 60)) -> Dict[int, Dict[str, object]]:
+        """Load, frame rate and top talkers for each window
+
+        Returns:
+            Dict indexed by window with load, frame_rate, opcodes and top_talkers
+        """
+        return {window: {
+            'load': self.load(window),
+            'frame_rate': self.frame_rate(window),
+            'opcodes': self.opcode_counts(window),
+            'top_talkers': self.top_talkers(window)
+        } for window in windows}
+
+    def reset (self) -> None:
+        """Clear all counts"""
+        with self._lock:
+            for bucket in self._buckets:
+                bucket.reset(-1)
+            self.total_frames = 0
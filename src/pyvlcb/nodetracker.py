@@ -0,0 +1,278 @@
+""" Incremental re-discovery
+
+After a full discovery NodeChangeTracker keeps the node table up to date
+by watching the frames which show a node has changed:
+
+    NNACK   node has a new node number - read it
+    NNREL   node has been taken out of service - removed from the table
+    RQNN    node is in setup mode - read again (will normally be followed by NNACK)
+    PNN     unknown node, or the module has changed - read it
+    NNLRN   node is in learn mode - read once it leaves learn mode
+    NNULN   node has left learn mode - read again
+    WRACK / GRSP    write to the node completed - read again (GRSP only if successful)
+
+Affected nodes are marked dirty and read again in the background, one
+node at a time using DiscoveryEngine, after no more changes have been
+seen for settle seconds (so a burst of writes only causes one read).
+The rest of the application reads the cached table without using the bus.
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Union
+from .canusb import DIRECTION_TX
+from .discovery import DiscoveryEngine, NodeInfo, OPCODE_PNN, responses
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+OPCODE_RQNN = 0x50
+OPCODE_NNREL = 0x51
+OPCODE_NNACK = 0x52
+OPCODE_NNLRN = 0x53
+OPCODE_NNULN = 0x54
+OPCODE_WRACK = 0x59
+OPCODE_GRSP = 0xAF
+
+# Opcodes which mean the node (first field) should be read again
+dirty_opcodes = frozenset((OPCODE_RQNN, OPCODE_NNACK, OPCODE_NNULN, OPCODE_WRACK))
+
+# Parameters used for the module details of a new node (not from a PNN)
+PARAM_MANUFACTURER = 1
+PARAM_MODULE_ID = 3
+PARAM_FLAGS = 8
+
+
+class NodeChangeTracker:
+    """Keep a cached node table up to date by re-reading nodes which change
+
+    Add record as a CanUSB4 listener and call poll regularly (or use start
+    to poll from a background thread):
+
+        tracker = NodeChangeTracker(vlcb, usb, nodes=DiscoveryEngine(vlcb, usb).run())
+        usb.add_listener(tracker.record)
+        tracker.start()
+
+    Listeners are called with (node, NodeInfo) after a node is read, or
+    (node, None) when a node is removed.
+
+    Attributes:
+        settle: Time in seconds without changes before a dirty node is read
+        interval: Time in seconds between reading one node and the next
+        refreshes: Number of nodes read again
+    """
+    def __init__ (self,
+                  vlcb,
+                  transport,
+                  nodes: Optional[Dict[int, NodeInfo]] = None,
+                  settle: float = 1.0,
+                  interval: float = 0.5,
+                  timeout: float = 0.5,
+                  retries: int = 2,
+                  read_nvs: bool = False,
+                  poll_interval: float = 0.05,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits NodeChangeTracker
+
+        Args:
+            vlcb: VLCB object used to create the requests
+            transport: Object with a send_data method (eg. CanUSB4)
+            nodes: Node table from a full discovery (or load_snapshot)
+            settle: Time in seconds without changes before a dirty node is read
+            interval: Time in seconds between reading one node and the next
+            timeout: Time in seconds to wait for each reply
+            retries: Number of times a request is sent again if there is no reply
+            read_nvs: Read the node variables
+            poll_interval: Time between polls when using start
+            clock: Function returning the current time in seconds
+        """
+        self.vlcb = vlcb
+        self.transport = transport
+        self.settle = settle
+        self.interval = interval
+        self.timeout = timeout
+        self.retries = retries
+        self.read_nvs = read_nvs
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.refreshes = 0
+        self._nodes: Dict[int, NodeInfo] = dict(nodes) if nodes is not None else {}
+        # Time of the last change for each dirty node
+        self._dirty: Dict[int, float] = {}
+        self._learning: Set[int] = set()
+        # PNN details (can_id, manufacturer, module, flags) for nodes not in the table
+        self._announced: Dict[int, tuple] = {}
+        self._listeners: List[Callable[[int, Optional[NodeInfo]], None]] = []
+        # Re-entrant as sending a request calls record on the same thread
+        self._lock = threading.RLock()
+        self._engine: Optional[DiscoveryEngine] = None
+        self._engine_node: Optional[int] = None
+        self._next_read = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def add_listener (self, listener: Callable[[int, Optional[NodeInfo]], None]) -> None:
+        """Add a function called with (node, NodeInfo) when a node is updated or (node, None) if removed"""
+        self._listeners.append(listener)
+
+    def nodes (self) -> Dict[int, NodeInfo]:
+        """Copy of the node table indexed by node number"""
+        with self._lock:
+            return dict(self._nodes)
+
+    def node (self, node: int) -> Optional[NodeInfo]:
+        """NodeInfo for a node (None if not known)"""
+        return self._nodes.get(node)
+
+    def dirty (self) -> Set[int]:
+        """Nodes waiting to be read again (including any being read now)"""
+        with self._lock:
+            dirty = set(self._dirty)
+            if self._engine_node is not None:
+                dirty.add(self._engine_node)
+            return dirty
+
+    def mark_dirty (self, node: int) -> None:
+        """Read a node again (eg. after changing it without a WRACK)"""
+        with self._lock:
+            self._dirty[node] = self.clock()
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Check a frame sent or received (signature matches CanUSB4.add_listener)"""
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 14 or packet[1] != "S":
+            return
+        try:
+            opcode = int(packet[7:9], 16)
+            data = bytes.fromhex(packet[9:-1])
+        except ValueError:
+            return
+        node = (data[0] << 8) + data[1]
+        removed = False
+        with self._lock:
+            now = self.clock()
+            if opcode == OPCODE_PNN and len(data) >= 5:
+                info = self._nodes.get(node)
+                if info is None or (info.manufacturer, info.module, info.flags) != (data[2], data[3], data[4]):
+                    can_id = (int(packet[2:6], 16) & 0xfe0) >> 5
+                    self._announced[node] = (can_id, data[2], data[3], data[4])
+                    self._dirty[node] = now
+            elif opcode == OPCODE_NNREL:
+                self._dirty.pop(node, None)
+                self._learning.discard(node)
+                removed = self._nodes.pop(node, None) is not None
+            elif opcode == OPCODE_NNLRN:
+                self._learning.add(node)
+            elif opcode == OPCODE_GRSP and len(data) >= 5 and data[4] == 0 and data[2] not in responses:
+                # Successful change (not a reply to one of the read requests)
+                self._dirty[node] = now
+            elif opcode in dirty_opcodes:
+                if opcode == OPCODE_NNULN:
+                    self._learning.discard(node)
+                self._dirty[node] = now
+            elif self._engine is not None and direction != DIRECTION_TX:
+                # Replies to the node being read
+                self._engine.receive(packet)
+        if removed:
+            logger.info("Node %s released", node)
+            self._notify(node, None)
+
+    def _notify (self, node: int, info: Optional[NodeInfo]) -> None:
+        for listener in self._listeners:
+            try:
+                listener(node, info)
+            except Exception:
+                logger.exception("Error in node change listener")
+
+    def poll (self) -> bool:
+        """Read the next dirty node and check for replies
+
+        Returns:
+            Bool: True if there is nothing waiting to be read
+        """
+        updated = None
+        with self._lock:
+            now = self.clock()
+            if self._engine is not None:
+                if self._engine.poll():
+                    updated = self._read_finished(now)
+            elif now >= self._next_read:
+                node = self._next_dirty(now)
+                if node is not None:
+                    del self._dirty[node]
+                    self._engine_node = node
+                    self._engine = DiscoveryEngine(self.vlcb, self.transport, window=1, timeout=self.timeout,
+                                                   retries=self.retries, read_nvs=self.read_nvs, clock=self.clock)
+                    # Keep the PNN details (not part of the read)
+                    old = self._nodes.get(node)
+                    announced = self._announced.pop(node, None)
+                    if announced is not None:
+                        info = NodeInfo(node, *announced)
+                    elif old is not None:
+                        info = NodeInfo(node, old.can_id, old.manufacturer, old.module, old.flags)
+                    else:
+                        info = NodeInfo(node)
+                    if old is not None:
+                        info.name = old.name
+                    self._engine.nodes[node] = info
+                    self._engine.discover_node(node)
+                    self._engine.poll()
+            idle = self._engine is None and not self._dirty
+        if updated is not None:
+            self._notify(*updated)
+        return idle
+
+    # Must be called with the lock held
+    def _next_dirty (self, now: float) -> Optional[int]:
+        for node, changed in self._dirty.items():
+            if node not in self._learning and now - changed >= self.settle:
+                return node
+        return None
+
+    # Must be called with the lock held - returns (node, info) to pass to the listeners
+    def _read_finished (self, now: float):
+        node = self._engine_node
+        info = self._engine.nodes[node]
+        self._engine = None
+        self._engine_node = None
+        self._next_read = now + self.interval
+        if node in self._dirty:
+            # Changed again while it was being read
+            return None
+        if not info.parameters and info.num_events is None and info.errors:
+            logger.warning("Node %s did not reply: %s", node, info.errors)
+            return None
+        if info.manufacturer is None:
+            # New node (eg. after NNACK) so no PNN details
+            info.manufacturer = info.parameters.get(PARAM_MANUFACTURER)
+            info.module = info.parameters.get(PARAM_MODULE_ID)
+            info.flags = info.parameters.get(PARAM_FLAGS)
+        self._nodes[node] = info
+        self.refreshes += 1
+        logger.debug("Node %s read again", node)
+        return (node, info)
+
+    def start (self) -> None:
+        """Poll from a background thread"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="NodeChangeTracker", daemon=True)
+        self._thread.start()
+
+    def _run (self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Error reading node")
+
+    def stop (self) -> None:
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
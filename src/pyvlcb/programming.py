@@ -0,0 +1,379 @@
+""" Bulk node programming
+
+Sends node variable (NVSET) and event (EVLRN) writes with several writes
+in progress at once, rather than waiting for each acknowledgement before
+sending the next write.
+
+A node replies to each write in order, so WRACK is matched to the oldest
+write in progress for the node and GRSP to the oldest write for the node
+with the same opcode. VLCB nodes may send both WRACK and GRSP for the same
+write, so an acknowledgement of the other type straight after a write has
+completed is treated as part of that write. WRACK and GRSP do not include
+the NV or event, so if a write is lost the next acknowledgement is matched
+to the wrong write. An acknowledgement is only confirmed once the node
+has no writes in progress; if a write is not acknowledged then all the
+writes to the node since it last had none in progress are sent again
+(writing the same value again is harmless). Errors (GRSP with a non zero
+result or CMDERR) are decoded using VLCBOpcode.grsp_error_codes.
+
+EVLRN is stored by every node in learn mode, so event writes are sent to
+one node at a time: NNLRN, the event writes, then NNULN once they have
+all been acknowledged. Node variable writes for other nodes continue
+while a node is in learn mode.
+"""
+
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from .canusb import DIRECTION_TX
+from .vlcbformat import VLCBOpcode
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+OPCODE_WRACK = 0x59
+OPCODE_CMDERR = 0x6F
+OPCODE_NVSET = 0x96
+OPCODE_GRSP = 0xAF
+OPCODE_EVLRN = 0xD2
+
+# Result status
+STATUS_PENDING = "pending"
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+
+# Error text indexed by int value
+grsp_errors = {int(code, 16): text for code, text in VLCBOpcode.grsp_error_codes.items()}
+
+KIND_NV = "nv"
+KIND_EVENT = "event"
+
+
+class WriteResult:
+    """Result of a single write
+
+    Attributes:
+        kind: KIND_NV or KIND_EVENT
+        node: Node being programmed
+        index: NV index or event variable index
+        value: Value written
+        event: Event (32 bit) for event writes, None for NV writes
+        status: STATUS_PENDING, STATUS_OK, STATUS_FAILED or STATUS_TIMEOUT
+        error_code: Error code from GRSP or CMDERR (None if no error)
+        error: Error text
+        attempts: Number of times the write was sent
+        acknowledged_by: Mnemonic of the acknowledgement (WRACK, GRSP or CMDERR)
+        elapsed: Time in seconds from first sent to acknowledged
+    """
+    def __init__ (self, kind: str, node: int, index: int, value: int, event: Optional[int], packet: str) -> None:
+        self.kind = kind
+        self.node = node
+        self.index = index
+        self.value = value
+        self.event = event
+        self.packet = packet
+        self.opcode = OPCODE_NVSET if kind == KIND_NV else OPCODE_EVLRN
+        self.status = STATUS_PENDING
+        self.error_code: Optional[int] = None
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self.acknowledged_by: Optional[str] = None
+        self.elapsed: Optional[float] = None
+        self.first_sent: Optional[float] = None
+        self.sent = 0.0
+
+    @property
+    def ok (self) -> bool:
+        """True if the write was acknowledged without an error"""
+        return self.status == STATUS_OK
+
+    def __repr__ (self) -> str:
+        if self.kind == KIND_NV:
+            target = f"NV{self.index}"
+        else:
+            target = f"event 0x{self.event:08X} EV{self.index}"
+        error = f" ({self.error})" if self.error else ""
+        return f"WriteResult(node {self.node} {target} = {self.value}: {self.status}{error})"
+
+
+class ProgrammingEngine:
+    """Write node variables and events with several writes in progress
+
+    Add the writes (add_config, add_nv or add_event) and then either call
+    run, which reads from the transport until all writes have finished, or
+    pass each received packet to receive (or add record as a CanUSB4
+    listener) and call poll regularly until it returns True.
+
+    Writes without an acknowledgement are sent again up to retries times.
+    Writes which the node rejects are not sent again.
+
+    Attributes:
+        results: WriteResult for each write in the order added
+        window: Maximum number of writes in progress
+        node_window: Maximum number of writes in progress for each node
+        timeout: Time to wait for an acknowledgement before sending again
+        retries: Number of times a write is sent again
+    """
+    def __init__ (self,
+                  vlcb,
+                  transport,
+                  window: int = 8,
+                  node_window: int = 4,
+                  timeout: float = 1.0,
+                  retries: int = 2,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits ProgrammingEngine
+
+        Args:
+            vlcb: VLCB object used to create the requests
+            transport: Object with send_data (and read_data if using run) eg. CanUSB4
+            window: Maximum number of writes in progress
+            node_window: Maximum number of writes in progress for each node
+            timeout: Time in seconds to wait for each acknowledgement
+            retries: Number of times a write is sent again if not acknowledged
+            clock: Function returning the current time in seconds
+        """
+        self.vlcb = vlcb
+        self.transport = transport
+        self.window = window
+        self.node_window = node_window
+        self.timeout = timeout
+        self.retries = retries
+        self.clock = clock
+        self.results: List[WriteResult] = []
+        self._nv_queues: Dict[int, Deque[WriteResult]] = {}
+        self._event_queues: Dict[int, Deque[WriteResult]] = {}
+        self._inflight: Dict[int, Deque[WriteResult]] = {}
+        self._inflight_count = 0
+        # Node in learn mode (only one at a time)
+        self._learning: Optional[int] = None
+        # Last write completed for each node and the acknowledgement used
+        self._last_acked: Dict[int, Tuple[WriteResult, int]] = {}
+        # Acknowledged writes for each node not confirmed yet
+        self._unconfirmed: Dict[int, List[WriteResult]] = {}
+
+    def add_nv (self, node: int, index: int, value: int) -> WriteResult:
+        """Add a node variable write
+
+        Raises:
+            ValueError: If a value is out of range
+        """
+        result = WriteResult(KIND_NV, node, index, value, None, self.vlcb.set_nv(node, index, value))
+        self.results.append(result)
+        self._nv_queues.setdefault(node, deque()).append(result)
+        return result
+
+    def add_event (self, node: int, event: int, ev_index: int, value: int) -> WriteResult:
+        """Add an event variable write (teaches the event to the node)
+
+        Args:
+            node: Node to teach the event to
+            event: Event as a 32 bit number (producer node ID << 16 + event number)
+            ev_index: Event variable index
+            value: Event variable value
+
+        Raises:
+            ValueError: If a value is out of range
+        """
+        result = WriteResult(KIND_EVENT, node, ev_index, value, event, self.vlcb.learn_event(event, ev_index, value))
+        self.results.append(result)
+        self._event_queues.setdefault(node, deque()).append(result)
+        return result
+
+    def add_config (self,
+                    node: int,
+                    nvs: Optional[Mapping[int, int]] = None,
+                    events: Optional[Mapping[int, Union[Mapping[int, int], Sequence[int]]]] = None) -> List[WriteResult]:
+        """Add the configuration for a node
+
+        Args:
+            node: Node to program
+            nvs: Value for each NV index
+            events: Event variables for each event (32 bit), either a dict
+                indexed by EV index or a list of values for EV1, EV2 ...
+
+        Returns:
+            List of WriteResult for the writes added
+        """
+        added = []
+        for index, value in (nvs or {}).items():
+            added.append(self.add_nv(node, index, value))
+        for event, variables in (events or {}).items():
+            if not isinstance(variables, Mapping):
+                variables = {index: value for index, value in enumerate(variables, 1)}
+            for ev_index, value in variables.items():
+                added.append(self.add_event(node, event, ev_index, value))
+        return added
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Check a received frame (signature matches CanUSB4.add_listener)"""
+        if direction != DIRECTION_TX:
+            self.receive(packet)
+
+    def receive (self, packet: Union[str, bytes]) -> None:
+        """Check a received frame for an acknowledgement"""
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 14 or packet[1] != "S":
+            return
+        try:
+            opcode = int(packet[7:9], 16)
+            data = bytes.fromhex(packet[9:-1])
+        except ValueError:
+            return
+        if opcode not in (OPCODE_WRACK, OPCODE_GRSP, OPCODE_CMDERR):
+            return
+        node = (data[0] << 8) + data[1]
+        now = self.clock()
+        last = self._last_acked.pop(node, None)
+        if opcode == OPCODE_WRACK:
+            if last is not None and last[1] == OPCODE_GRSP:
+                # WRACK for the write already acknowledged by GRSP
+                return
+            self._complete(node, None, opcode, 0, now)
+        elif opcode == OPCODE_GRSP and len(data) >= 5:
+            if last is not None and last[1] == OPCODE_WRACK and last[0].opcode == data[2]:
+                # GRSP for the write already acknowledged by WRACK
+                if data[4] != 0:
+                    self._error(last[0], data[4], "GRSP")
+                return
+            self._complete(node, data[2], opcode, data[4], now)
+        elif opcode == OPCODE_CMDERR and len(data) >= 3:
+            self._complete(node, None, opcode, data[2], now)
+
+    # Complete the oldest write in progress for the node (with the opcode if set)
+    def _complete (self, node: int, write_opcode: Optional[int], ack_opcode: int, error_code: int, now: float) -> None:
+        inflight = self._inflight.get(node)
+        if not inflight:
+            return
+        for result in inflight:
+            if write_opcode is None or result.opcode == write_opcode:
+                break
+        else:
+            return
+        inflight.remove(result)
+        self._inflight_count -= 1
+        result.elapsed = now - result.first_sent
+        mnemonic = VLCBOpcode.opcodes[f"{ack_opcode:02X}"]['opc']
+        if error_code == 0 and ack_opcode != OPCODE_CMDERR:
+            result.status = STATUS_OK
+            result.acknowledged_by = mnemonic
+            self._last_acked[node] = (result, ack_opcode)
+            self._unconfirmed.setdefault(node, []).append(result)
+        else:
+            self._error(result, error_code, mnemonic)
+        if not inflight:
+            # Number of acknowledgements matches the writes so all are confirmed
+            self._unconfirmed.pop(node, None)
+
+    def _error (self, result: WriteResult, error_code: int, mnemonic: str) -> None:
+        result.status = STATUS_FAILED
+        result.error_code = error_code
+        result.error = grsp_errors.get(error_code, "Unknown error")
+        result.acknowledged_by = mnemonic
+        logger.warning("Write to node %s failed: %s", result.node, result.error)
+
+    def poll (self) -> bool:
+        """Send writes and handle timeouts
+
+        Returns:
+            Bool: True when all writes have finished
+        """
+        now = self.clock()
+        for node, inflight in self._inflight.items():
+            if inflight and now - inflight[0].sent >= self.timeout:
+                self._timeout(node, inflight)
+        self._send_nvs(now)
+        self._send_events(now)
+        return (self._inflight_count == 0 and self._learning is None
+                and not any(self._nv_queues.values()) and not any(self._event_queues.values()))
+
+    # Oldest write for the node was not acknowledged - the acknowledgements
+    # may have been matched to the wrong writes so send all the writes in
+    # progress and the unconfirmed writes for the node again
+    def _timeout (self, node: int, inflight: Deque[WriteResult]) -> None:
+        self._last_acked.pop(node, None)
+        writes = self._unconfirmed.pop(node, []) + list(inflight)
+        self._inflight_count -= len(inflight)
+        inflight.clear()
+        retry = []
+        for result in writes:
+            if result.attempts > self.retries:
+                result.status = STATUS_TIMEOUT
+                result.error = "No acknowledgement"
+                logger.warning("No acknowledgement from node %s", node)
+            else:
+                result.status = STATUS_PENDING
+                result.acknowledged_by = None
+                retry.append(result)
+        # Add back to the front of the queues in the original order
+        for result in reversed(retry):
+            if result.kind == KIND_EVENT:
+                self._event_queues.setdefault(node, deque()).appendleft(result)
+            else:
+                self._nv_queues.setdefault(node, deque()).appendleft(result)
+
+    def _can_send (self, node: int) -> bool:
+        return self._inflight_count < self.window and len(self._inflight.get(node, ())) < self.node_window
+
+    def _send_nvs (self, now: float) -> None:
+        sent = True
+        # Take a write from each node in turn so all nodes are written at the same time
+        while sent and self._inflight_count < self.window:
+            sent = False
+            for node, queue in self._nv_queues.items():
+                if queue and self._can_send(node):
+                    self._send(queue.popleft(), now)
+                    sent = True
+
+    def _send_events (self, now: float) -> None:
+        if self._learning is None:
+            for node, queue in self._event_queues.items():
+                # Node variables are written before the events
+                if queue and not self._nv_queues.get(node) and not self._inflight.get(node):
+                    self._learning = node
+                    self.transport.send_data(self.vlcb.node_learn(node))
+                    break
+            else:
+                return
+        node = self._learning
+        queue = self._event_queues.get(node)
+        while queue and self._can_send(node):
+            self._send(queue.popleft(), now)
+        if not queue and not self._inflight.get(node):
+            self.transport.send_data(self.vlcb.node_unlearn(node))
+            self._learning = None
+            # Next node can go into learn mode now
+            if any(self._event_queues.values()):
+                self._send_events(now)
+
+    def _send (self, result: WriteResult, now: float) -> None:
+        if result.first_sent is None:
+            result.first_sent = now
+        result.sent = now
+        result.attempts += 1
+        self._inflight.setdefault(result.node, deque()).append(result)
+        self._inflight_count += 1
+        self.transport.send_data(result.packet)
+
+    def run (self, timeout: float = 60.0, interval: float = 0.002) -> List[WriteResult]:
+        """Send all the writes and wait for the acknowledgements
+
+        Args:
+            timeout: Maximum time in seconds
+            interval: Time to wait when no data is received
+
+        Returns:
+            List of WriteResult in the order the writes were added
+        """
+        end = self.clock() + timeout
+        while not self.poll() and self.clock() < end:
+            packets = self.transport.read_data()
+            for packet in packets:
+                self.receive(packet)
+            if not packets:
+                time.sleep(interval)
+        return self.results
@@ -0,0 +1,145 @@
+""" Flight recorder - keeps the most recent packets in memory """
+
+import itertools
+import time
+from datetime import datetime
+from typing import Callable, List, Optional, TextIO, Tuple, Union
+from .exceptions import MyLibraryError
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class FlightRecorder:
+    """Fixed size ring buffer of recent packets
+
+    Designed to be left running. Recording a packet just stores references
+    in preallocated lists - no formatting is performed until the recorder
+    is dumped. Can be added as a listener to CanUSB4 to record all packets
+    sent and received.
+
+    Dump output uses the num,date,direction,message format used by
+    VLCB.log_entry.
+
+    Attributes:
+        size: Number of packets kept
+    """
+    def __init__ (self, size: int = 4096, clock: Callable[[], float] = time.time) -> None:
+        """Inits FlightRecorder
+
+        Args:
+            size: Number of packets kept (older packets are overwritten)
+            clock: Function returning the current time in seconds
+        """
+        if size < 1:
+            raise ValueError(f"Recorder size must be at least 1, not {size}")
+        self.size = size
+        self._clock = clock
+        self._times = [0.0] * size
+        self._directions = [''] * size
+        self._packets = [''] * size
+        # next() on a count is atomic so record can be called from multiple threads
+        self._counter = itertools.count()
+        self._count = 0
+        self._dump_target = None
+        # Number of the first packet not yet written by auto_dump
+        self._auto_dumped = 0
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Record a packet
+
+        Signature matches CanUSB4.add_listener eg. usb.add_listener(recorder.record)
+
+        Args:
+            direction: Direction of the packet eg. DIRECTION_RX
+            packet: Raw packet
+        """
+        count = next(self._counter)
+        index = count % self.size
+        self._times[index] = self._clock()
+        self._directions[index] = direction
+        self._packets[index] = packet
+        self._count = count + 1
+
+    def __len__ (self) -> int:
+        return min(self._count, self.size)
+
+    def clear (self) -> None:
+        """Remove all recorded packets"""
+        self._counter = itertools.count()
+        self._count = 0
+        self._auto_dumped = 0
+
+    def snapshot (self, first: int = 0) -> List[Tuple[int, float, str, str]]:
+        """Get the recorded packets, oldest first
+
+        Args:
+            first: Only include packets with this number or later
+
+        Returns:
+            List of (number, timestamp, direction, packet)
+        """
+        count = self._count
+        entries = []
+        for number in range(max(first, count - self.size), count):
+            index = number % self.size
+            packet = self._packets[index]
+            if isinstance(packet, bytes):
+                packet = packet.decode('ascii', 'replace')
+            entries.append((number, self._times[index], self._directions[index], packet))
+        return entries
+
+    def dump (self, target: Union[str, TextIO], append: bool = False) -> int:
+        """Write the recorded packets in log format
+
+        Args:
+            target: Filename or open text file
+            append: Add to the end of the file rather than overwriting it (filename only)
+
+        Returns:
+            Int: Number of packets written
+        """
+        return self._write(target, self.snapshot(), append)
+
+    def _write (self, target: Union[str, TextIO], entries: List[Tuple[int, float, str, str]], append: bool) -> int:
+        lines = []
+        for number, timestamp, direction, packet in entries:
+            date_string = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+            lines.append(f"{number},{date_string},{direction},{packet}\n")
+        if isinstance(target, str):
+            with open(target, "a" if append else "w") as f:
+                f.writelines(lines)
+        else:
+            target.writelines(lines)
+        return len(lines)
+
+    # Called by MyLibraryError when an error is created
+    # Appends the packets not already written so earlier dumps are kept
+    def _error_hook (self, error: MyLibraryError) -> None:
+        if self._dump_target is None:
+            return
+        entries = self.snapshot(self._auto_dumped)
+        self._auto_dumped = self._count
+        num_packets = self._write(self._dump_target, entries, True)
+        logger.warning("%s created - %s packets written to %s", type(error).__name__, num_packets, self._dump_target)
+
+    def auto_dump (self, target: Optional[Union[str, TextIO]]) -> None:
+        """Dump automatically whenever a library error (MyLibraryError) is created
+
+        The hook runs when the exception is constructed (see MyLibraryError),
+        which includes errors which are handled within the library. Each dump
+        is appended to the target and only includes the packets recorded
+        since the previous automatic dump, so the packets leading up to the
+        first error are not overwritten.
+
+        Args:
+            target: Filename or open text file - None to stop automatic dumps
+        """
+        self._dump_target = target
+        self._auto_dumped = 0
+        hooks = tuple(hook for hook in MyLibraryError.error_hooks if hook != self._error_hook)
+        if target is not None:
+            hooks += (self._error_hook,)
+        MyLibraryError.error_hooks = hooks
@@ -0,0 +1,211 @@
+""" Human readable rendering of packets
+
+A renderer is created for each opcode from VLCBOpcode.opcodes and
+field_formats on first use. The renderer slices each field directly from
+the data string and formats it in a single f-string, so no dict is
+created for each packet.
+
+Fields are shown using their format: hex as 0x.., num as a number, char
+unchanged and ascii as text. Loco addresses are shown as the loco number,
+accessory opcodes include the on / off state and error codes in ERR,
+CMDERR and GRSP include the error text.
+"""
+
+from typing import Callable, Dict, List, Tuple
+from .vlcbformat import VLCBOpcode
+
+# Error codes indexed by int value
+dcc_errors = {int(code, 16): text for code, text in VLCBOpcode.dcc_error_codes.items()}
+grsp_errors = {int(code, 16): text for code, text in VLCBOpcode.grsp_error_codes.items()}
+
+# Accessory state indexed by mnemonic
+accessory_states = {mnemonic: state for state, mnemonics in VLCBOpcode.accessory_codes.items() for mnemonic in mnemonics}
+
+# Error codes where ERR Byte1, Byte2 is a loco address (as VLCBFormat.get_loco_id)
+ERR_LOCO_CODES = (1, 2, 7)
+
+# Fields with error codes - (opcode, field) : lookup
+_error_fields = {
+    ('63', 'ErrCode'): 'dcc_errors',
+    ('6F', 'Error'): 'grsp_errors',
+    ('AF', 'Result'): 'grsp_errors'
+}
+
+# Renderers indexed by opcode hex string
+_renderers: Dict[str, Callable[[str], Tuple[str, str]]] = {}
+
+
+def loco_string (address: int) -> str:
+    """Loco number from AddrHigh_AddrLow eg. 200 or 3 (long)"""
+    if address & 0xC000:
+        return f"{address & 0x3FFF} (long)"
+    return str(address)
+
+
+def _ascii (value: str) -> str:
+    return bytes.fromhex(value).decode('ascii', 'replace').rstrip(' \x00')
+
+
+def _error_text (lookup: Dict[int, str], value: int) -> str:
+    return lookup.get(value, "Unknown error")
+
+
+# Used when the data is not the expected length (parse_data reports any missing fields)
+def _render_slow (data: str) -> Tuple[str, str]:
+    fields = VLCBOpcode.parse_data(data)
+    code = fields['opid']
+    parts = []
+    loco = None
+    error = None
+    if code in VLCBOpcode.opcodes:
+        mnemonic = fields['opcode']
+        if mnemonic in accessory_states:
+            parts.append(f"State = {accessory_states[mnemonic]}")
+        description = VLCBOpcode.opcodes[code]['title']
+    else:
+        description = "Unknown opcode"
+    for name, value in fields.items():
+        if name in ('opid', 'opcode'):
+            continue
+        if isinstance(value, str):
+            # char fields, ExtraData and Insufficient data
+            parts.append(f"{name} = {value}")
+            continue
+        num_chars, field_type = VLCBOpcode.field_formats.get(name, (2, 'hex'))
+        if name == 'AddrHigh_AddrLow':
+            loco = loco_string(value)
+            parts.append(f"Loco = {loco}")
+        elif field_type == 'ascii':
+            parts.append(f"{name} = '{_ascii(f'{value:0{num_chars}X}')}'")
+        elif field_type == 'hex':
+            parts.append(f"{name} = 0x{value:0{num_chars}X}")
+        else:
+            parts.append(f"{name} = {value}")
+        lookup = _error_fields.get((code, name))
+        if lookup is not None:
+            error = _error_text(globals()[lookup], value)
+            parts[-1] += f" ({error})"
+    if error is not None:
+        description += f" - {error}"
+        if code == '63' and fields['ErrCode'] in ERR_LOCO_CODES and isinstance(fields['Byte2'], int):
+            loco = loco_string((fields['Byte1'] << 8) + fields['Byte2'])
+    if loco is not None:
+        description += f" - loco {loco}"
+    return (" , ".join(parts), description)
+
+
+def _compile_renderer (code: str) -> Callable[[str], Tuple[str, str]]:
+    details = VLCBOpcode.opcodes[code]
+    layout = VLCBOpcode.field_layout(code)
+    expected = layout[-1][2] if layout else 2
+    lines = ["def render (data):", f"    if len(data) != {expected}: return _render_slow(data)"]
+    parts = []
+    description = details['title'].replace("{", "{{").replace("}", "}}")
+    if details['opc'] in accessory_states:
+        parts.append(f"State = {accessory_states[details['opc']]}")
+    error_part = ""
+    loco_part = ""
+    for number, (name, start, end, field_type) in enumerate(layout):
+        num_chars = end - start
+        var = f"v{number}"
+        if field_type == 'char':
+            parts.append(f"{name} = {{data[{start}:{end}]}}")
+            continue
+        if field_type == 'ascii':
+            parts.append(f"{name} = '{{_ascii(data[{start}:{end}])}}'")
+            continue
+        lines.append(f"    {var} = int(data[{start}:{end}], 16)")
+        if name == 'AddrHigh_AddrLow':
+            lines.append(f"    loco = loco_string({var})")
+            parts.append("Loco = {loco}")
+            loco_part = " - loco {loco}"
+        elif field_type == 'hex':
+            parts.append(f"{name} = 0x{{{var}:0{num_chars}X}}")
+        else:
+            parts.append(f"{name} = {{{var}}}")
+        lookup = _error_fields.get((code, name))
+        if lookup is not None:
+            lines.append(f"    error = _error_text({lookup}, {var})")
+            parts[-1] += " ({error})"
+            error_part = " - {error}"
+    if code == '63':
+        # Byte1, Byte2 is a loco address for some error codes
+        lines.append(f"    loco_description = (' - loco ' + loco_string((v0 << 8) + v1)) if v2 in {ERR_LOCO_CODES} else ''")
+        loco_part = "{loco_description}"
+    data_string = " , ".join(parts)
+    lines.append(f"    return (f{data_string!r}, f{(description + error_part + loco_part)!r})")
+    namespace = {
+        '_render_slow': _render_slow,
+        '_ascii': _ascii,
+        '_error_text': _error_text,
+        'loco_string': loco_string,
+        'dcc_errors': dcc_errors,
+        'grsp_errors': grsp_errors
+    }
+    exec("\n".join(lines), namespace)
+    return namespace['render']
+
+
+def renderer (opcode: str) -> Callable[[str], Tuple[str, str]]:
+    """Get the renderer for an opcode (created on first use)
+
+    Args:
+        opcode: Opcode as a 2 character hex string
+
+    Returns:
+        Function which takes a data string (including the opcode) and
+        returns a tuple of (fields, description)
+    """
+    render = _renderers.get(opcode)
+    if render is None:
+        if opcode in VLCBOpcode.opcodes and opcode != '':
+            render = _compile_renderer(opcode)
+        else:
+            render = _render_slow
+        _renderers[opcode] = render
+    return render
+
+
+def render_data (data: str) -> Tuple[str, str]:
+    """Render the data from a packet
+
+    eg. render_data('E101C0C800000000') =
+    ('Session = 0x01 , Loco = 200 (long) , ...', 'Engine Report - loco 200 (long)')
+
+    Args:
+        data: Data string including the opcode (VLCBFormat.data)
+
+    Returns:
+        Tuple of (fields, description)
+
+    Raises:
+        ValueError: If the data is not valid hex
+    """
+    return renderer(data[0:2].upper())(data)
+
+
+def render_entry (input_string: str) -> List[str]:
+    """Render a log entry (num,date,direction,message)
+
+    Returns the same columns as VLCB.log_entry, with the fields and
+    description from render_data.
+
+    Returns:
+        List of date, direction, message, can_id, opcode, fields, description
+    """
+    entry_parts = input_string.split(',', 3)
+    if len(entry_parts) < 4:
+        entry_parts += [""] * (4 - len(entry_parts))
+    num, date_string, direction, message = entry_parts
+    try:
+        if len(message) < 10 or message[1] != "S":
+            raise ValueError(f"Invalid packet {message}")
+        header_val = int(message[2:6], 16)
+        data = message[7:-1]
+        opcode = data[0:2]
+        fields, description = render_data(data)
+        opcode_string = f'{opcode} - {VLCBOpcode.opcode_mnemonic(opcode)}'
+    except ValueError:
+        return [date_string, direction, message, "", "??", "", "Invalid data"]
+    can_id = (header_val & 0xfe0) >> 5
+    return [date_string, direction, message, str(can_id), opcode_string, fields, description]
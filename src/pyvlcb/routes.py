@@ -0,0 +1,143 @@
+""" Routes - groups of accessory commands sent together """
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from .encoder import frame
+from .exceptions import InvalidConfigurationError
+
+# Entry in a route (node_id, ev_id, state)
+RouteEntry = Tuple[int, Union[int, str], Union[str, bool]]
+
+
+def _parse_state (state: Union[str, bool]) -> bool:
+    if state is True or state == "on":
+        return True
+    if state is False or state == "off":
+        return False
+    raise InvalidConfigurationError(f"Invalid accessory state {state} - use 'on' / 'off' or True / False")
+
+
+class Route:
+    """A list of accessory commands encoded once for repeated use
+
+    Each entry is validated and converted to a packet when the route is
+    created, using the same short / long rules as VLCB.accessory_command.
+    All the packets are joined into a single bytestring so sending the
+    route is a single write.
+
+    Attributes:
+        name: Name of the route (optional)
+        can_id: CAN ID used for the packets
+        packets: Tuple of packet strings
+        payload: All packets as a single bytestring
+    """
+    def __init__ (self, entries: Iterable[RouteEntry], can_id: int = 60, name: Optional[str] = None) -> None:
+        """Inits Route and encodes the packets
+
+        Args:
+            entries: List of (node_id, ev_id, state). ev_id can be an int or
+                string (base 10 or hex with 0x). state is "on" / "off" or True / False
+            can_id: CAN ID for the packets
+            name: Name of the route
+
+        Raises:
+            InvalidConfigurationError: If an entry is not valid
+        """
+        self.name = name
+        self.can_id = can_id
+        packets = []
+        for entry in entries:
+            try:
+                node_id, ev_id, state = entry
+            except (TypeError, ValueError):
+                raise InvalidConfigurationError(f"Route entry {entry} must be (node, event, state)")
+            packets.append(self._encode(node_id, ev_id, state))
+        self.packets = tuple(packets)
+        self.payload = "".join(self.packets).encode('ascii')
+
+    def _encode (self, node_id: int, ev_id: Union[int, str], state: Union[str, bool]) -> str:
+        on = _parse_state(state)
+        if isinstance(ev_id, str):
+            try:
+                ev_id = int(ev_id, 0)
+            except ValueError:
+                raise InvalidConfigurationError(f"Invalid event {ev_id}")
+        if not isinstance(node_id, int) or node_id < 0 or node_id > 0xFFFF:
+            raise InvalidConfigurationError(f"Invalid node {node_id}")
+        if not isinstance(ev_id, int) or ev_id < 0 or ev_id > 0xFFFFFFFF:
+            raise InvalidConfigurationError(f"Invalid event {ev_id}")
+        if ev_id <= 0xFFFF:
+            # Short event ASON / ASOF
+            return frame(self.can_id, '98' if on else '99', node_id >> 8, node_id & 0xFF, ev_id >> 8, ev_id & 0xFF)
+        # Long event ACON / ACOF - event includes the node number
+        return frame(self.can_id, '90' if on else '91', ev_id >> 24, (ev_id >> 16) & 0xFF, (ev_id >> 8) & 0xFF, ev_id & 0xFF)
+
+    def __len__ (self) -> int:
+        return len(self.packets)
+
+    def send (self, transport) -> None:
+        """Send all packets in the route as a single write
+
+        Args:
+            transport: Object with a send_data method (eg. CanUSB4)
+        """
+        transport.send_data(self.payload)
+
+
+class RouteCache:
+    """Named routes which are encoded once and reused
+
+    Routes are encoded using the can_id of the VLCB object. If the can_id
+    is changed then the routes are encoded again when next used.
+    """
+    def __init__ (self, vlcb) -> None:
+        """Inits RouteCache
+
+        Args:
+            vlcb: VLCB object providing the can_id
+        """
+        self.vlcb = vlcb
+        self._entries: Dict[str, List[RouteEntry]] = {}
+        self._routes: Dict[str, Route] = {}
+
+    def add (self, name: str, entries: Iterable[RouteEntry]) -> Route:
+        """Add (or replace) a named route
+
+        Returns:
+            Route: The encoded route
+
+        Raises:
+            InvalidConfigurationError: If an entry is not valid
+        """
+        entries = list(entries)
+        route = Route(entries, self.vlcb.can_id, name)
+        self._entries[name] = entries
+        self._routes[name] = route
+        return route
+
+    def remove (self, name: str) -> None:
+        """Remove a named route"""
+        self._entries.pop(name, None)
+        self._routes.pop(name, None)
+
+    def get (self, name: str) -> Route:
+        """Get a named route
+
+        Raises:
+            KeyError: If the route has not been added
+        """
+        route = self._routes[name]
+        if route.can_id != self.vlcb.can_id:
+            route = self.add(name, self._entries[name])
+        return route
+
+    def __contains__ (self, name: str) -> bool:
+        return name in self._routes
+
+    def send (self, name: str, transport) -> None:
+        """Send a named route
+
+        Args:
+            name: Name of the route
+            transport: Object with a send_data method (eg. CanUSB4)
+        """
+        self.get(name).send(transport)
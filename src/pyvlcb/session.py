@@ -0,0 +1,255 @@
+""" Loco session manager
+
+Tracks the loco sessions allocated to this controller and sends a keep
+alive (DKEEP) only when no other command has been sent to that session
+recently. Sessions are held in a hashed timer wheel: each session is in
+the slot for the time its keep alive is due, so each tick only looks at
+the sessions in one slot however many sessions there are.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+from .canusb import DIRECTION_TX
+from .vlcbformat import VLCBOpcode
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Command station releases a session after 4 seconds without a command
+SESSION_TIMEOUT = 4.0
+
+# Opcodes where the first field is the session (any of these keeps the session alive)
+session_opcodes = frozenset(int(code, 16) for code, details in VLCBOpcode.opcodes.items()
+                            if code != '' and details['format'].split(',')[0] == 'Session')
+
+# ERR codes where Byte1 is a session number which is no longer valid
+ERR_SESSION_CODES = (3, 8)
+# ERR codes where Byte1, Byte2 is the loco address requested
+ERR_LOCO_CODES = (1, 2, 7)
+
+
+class LocoSession:
+    """A loco session allocated to this controller
+
+    Attributes:
+        session: Session number
+        address: Loco address (as VLCBFormat.get_loco_id)
+        last_tx: Time a command was last sent to the session
+        keep_alives: Number of keep alives sent
+    """
+    def __init__ (self, session: int, address: int, now: float) -> None:
+        self.session = session
+        self.address = address
+        self.last_tx = now
+        self.keep_alives = 0
+        # Tick when the keep alive is due (position in the timer wheel)
+        self.due_tick = 0
+
+    def __repr__ (self) -> str:
+        return f"LocoSession({self.session}, {self.address})"
+
+
+class SessionManager:
+    """Send keep alives for allocated loco sessions
+
+    Attach to the send and receive paths as a CanUSB4 listener and call
+    poll regularly (or use start to poll from a background thread):
+
+        manager = SessionManager(vlcb, usb)
+        usb.add_listener(manager.record)
+
+    Sessions are added when a PLOC is received for a loco requested by
+    this controller (RLOC or GLOC sent), and removed on KLOC or on an ERR
+    for the session.
+
+    Attributes:
+        sessions: LocoSession for each session number
+        keepalive_interval: Send a keep alive if nothing sent to the session for this time
+        warn_after: Report sessions where the time between commands reaches this
+        near_timeouts: Recent reports of (time, session, address, gap)
+    """
+    def __init__ (self,
+                  vlcb,
+                  transport,
+                  keepalive_interval: float = 2.0,
+                  warn_after: float = 3.0,
+                  tick: float = 0.1,
+                  wheel_size: int = 64,
+                  on_near_timeout: Optional[Callable[[LocoSession, float], None]] = None,
+                  clock: Callable[[], float] = time.monotonic) -> None:
+        """Inits SessionManager
+
+        Args:
+            vlcb: VLCB object used to create the keep alive requests
+            transport: Object with a send_data method (eg. CanUSB4)
+            keepalive_interval: Time since the last command before a keep alive is sent
+            warn_after: Time since the last command which is reported as close to timing out
+            tick: Resolution of the timer wheel in seconds
+            wheel_size: Number of slots in the timer wheel
+            on_near_timeout: Function called with (session, gap) when a session is close to timing out
+            clock: Function returning the current time in seconds
+        """
+        self.vlcb = vlcb
+        self.transport = transport
+        self.keepalive_interval = keepalive_interval
+        self.warn_after = warn_after
+        self.tick = tick
+        self.on_near_timeout = on_near_timeout
+        self.clock = clock
+        self.sessions: Dict[int, LocoSession] = {}
+        self.near_timeouts: Deque[Tuple[float, int, int, float]] = deque(maxlen=100)
+        self._lock = threading.Lock()
+        self._wheel: List[Set[int]] = [set() for _ in range(wheel_size)]
+        self._current_tick = int(clock() / tick)
+        # Loco addresses requested (RLOC / GLOC) waiting for a PLOC
+        self._requested: Set[int] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def _schedule (self, loco_session: LocoSession) -> None:
+        loco_session.due_tick = max(math.ceil((loco_session.last_tx + self.keepalive_interval) / self.tick),
+                                    self._current_tick + 1)
+        self._wheel[loco_session.due_tick % len(self._wheel)].add(loco_session.session)
+
+    def add_session (self, session: int, address: int) -> LocoSession:
+        """Track a session (eg. allocated before the manager was created)
+
+        Returns:
+            LocoSession: The session
+        """
+        with self._lock:
+            return self._add(session, address, self.clock())
+
+    def _add (self, session: int, address: int, now: float) -> LocoSession:
+        loco_session = LocoSession(session, address, now)
+        self.sessions[session] = loco_session
+        self._schedule(loco_session)
+        logger.debug("Session %s allocated to loco %s", session, address)
+        return loco_session
+
+    def remove_session (self, session: int) -> None:
+        """Stop tracking a session (any entry in the timer wheel is ignored)"""
+        with self._lock:
+            if self.sessions.pop(session, None) is not None:
+                logger.debug("Session %s removed", session)
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Check a frame sent or received (signature matches CanUSB4.add_listener)"""
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        if len(packet) < 10 or packet[1] != "S":
+            return
+        try:
+            opcode = int(packet[7:9], 16)
+            # Data bytes after the opcode
+            data = bytes.fromhex(packet[9:-1])
+        except ValueError:
+            return
+        with self._lock:
+            now = self.clock()
+            if direction == DIRECTION_TX:
+                self._sent(opcode, data, now)
+            else:
+                self._received(opcode, data, now)
+
+    # Must be called with the lock held
+    def _sent (self, opcode: int, data: bytes, now: float) -> None:
+        if opcode in (0x40, 0x61) and len(data) >= 2:
+            # RLOC / GLOC
+            self._requested.add(((data[0] << 8) + data[1]) & 0x3FFF)
+        elif opcode == 0x21 and len(data) >= 1:
+            # KLOC
+            self.sessions.pop(data[0], None)
+        elif opcode in session_opcodes and len(data) >= 1:
+            loco_session = self.sessions.get(data[0])
+            if loco_session is not None:
+                # Keep alive is rescheduled when its slot is reached
+                loco_session.last_tx = now
+
+    # Must be called with the lock held
+    def _received (self, opcode: int, data: bytes, now: float) -> None:
+        if opcode == 0xE1 and len(data) >= 3:
+            # PLOC Session,AddrHigh_AddrLow
+            address = ((data[1] << 8) + data[2]) & 0x3FFF
+            if address in self._requested:
+                self._requested.discard(address)
+                self._add(data[0], address, now)
+        elif opcode == 0x63 and len(data) >= 3:
+            # ERR Byte1,Byte2,ErrCode
+            if data[2] in ERR_SESSION_CODES:
+                if self.sessions.pop(data[0], None) is not None:
+                    logger.warning("Session %s ended by command station (error %s)", data[0], data[2])
+            elif data[2] in ERR_LOCO_CODES:
+                self._requested.discard(((data[0] << 8) + data[1]) & 0x3FFF)
+
+    def poll (self) -> int:
+        """Send any keep alives which are due
+
+        Returns:
+            Int: Number of keep alives sent
+        """
+        due = []
+        with self._lock:
+            now = self.clock()
+            target_tick = int(now / self.tick)
+            # After a long delay only need to go round the wheel once
+            first_tick = max(self._current_tick + 1, target_tick - len(self._wheel) + 1)
+            for tick in range(first_tick, target_tick + 1):
+                self._current_tick = tick
+                slot = self._wheel[tick % len(self._wheel)]
+                if not slot:
+                    continue
+                for session in list(slot):
+                    loco_session = self.sessions.get(session)
+                    if loco_session is None:
+                        slot.discard(session)
+                        continue
+                    if loco_session.due_tick > target_tick:
+                        # Due on a later time round the wheel
+                        continue
+                    slot.discard(session)
+                    gap = now - loco_session.last_tx
+                    if gap >= self.keepalive_interval:
+                        due.append((loco_session, gap))
+                        loco_session.last_tx = now
+                        loco_session.keep_alives += 1
+                    self._schedule(loco_session)
+            self._current_tick = max(self._current_tick, target_tick)
+        for loco_session, gap in due:
+            if gap >= self.warn_after:
+                self._near_timeout(loco_session, gap, now)
+            self.transport.send_data(self.vlcb.keep_alive(loco_session.session))
+        return len(due)
+
+    def _near_timeout (self, loco_session: LocoSession, gap: float, now: float) -> None:
+        logger.warning("Session %s (loco %s) had no command for %.2f seconds", loco_session.session, loco_session.address, gap)
+        self.near_timeouts.append((now, loco_session.session, loco_session.address, gap))
+        if self.on_near_timeout is not None:
+            self.on_near_timeout(loco_session, gap)
+
+    def start (self) -> None:
+        """Poll from a background thread every tick"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SessionManager", daemon=True)
+        self._thread.start()
+
+    def _run (self) -> None:
+        while not self._stop.wait(self.tick):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Error sending keep alive")
+
+    def stop (self) -> None:
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,105 @@
+""" Node table snapshots
+
+Saves the nodes found by DiscoveryEngine (parameters, name, NVs and
+events) to a JSON file which can be loaded when the software starts.
+Pass the loaded nodes to DiscoveryEngine as known so that each node is
+only validated against the snapshot and fully read if it has changed:
+
+    known = load_snapshot("nodes.json")
+    engine = DiscoveryEngine(vlcb, usb, known=known)
+    save_snapshot("nodes.json", engine.run())
+"""
+
+import json
+import os
+from typing import Any, Dict
+from .discovery import NodeInfo
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+SNAPSHOT_VERSION = 1
+
+
+def _int_keys (values: Dict[str, Any]) -> Dict[int, int]:
+    return {int(key): int(value) for key, value in values.items()}
+
+
+def node_to_dict (info: NodeInfo) -> Dict[str, Any]:
+    """Convert a NodeInfo to a dict which can be saved as JSON"""
+    return {
+        'node': info.node,
+        'can_id': info.can_id,
+        'manufacturer': info.manufacturer,
+        'module': info.module,
+        'flags': info.flags,
+        'name': info.name,
+        'parameters': {str(key): value for key, value in sorted(info.parameters.items())},
+        'num_events': info.num_events,
+        'event_space': info.event_space,
+        'events': {str(key): value for key, value in sorted(info.events.items())},
+        'nvs': {str(key): value for key, value in sorted(info.nvs.items())}
+    }
+
+
+def node_from_dict (values: Dict[str, Any]) -> NodeInfo:
+    """Create a NodeInfo from a dict created by node_to_dict
+
+    Raises:
+        ValueError: If the node details are not valid
+    """
+    try:
+        info = NodeInfo(int(values['node']), values.get('can_id'), values.get('manufacturer'),
+                        values.get('module'), values.get('flags'))
+        info.name = values.get('name')
+        info.parameters = _int_keys(values.get('parameters', {}))
+        info.num_events = values.get('num_events')
+        info.event_space = values.get('event_space')
+        info.events = _int_keys(values.get('events', {}))
+        info.nvs = _int_keys(values.get('nvs', {}))
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Invalid node in snapshot {values}") from e
+    info.complete = True
+    return info
+
+
+def save_snapshot (filename: str, nodes: Dict[int, NodeInfo], complete_only: bool = True) -> None:
+    """Save the node table to a file
+
+    The file is replaced in a single step so a partly written file is never read.
+
+    Args:
+        filename: Snapshot file
+        nodes: NodeInfo indexed by node number (eg. DiscoveryEngine.nodes)
+        complete_only: Only save nodes which were read without errors
+    """
+    saved = [node_to_dict(info) for number, info in sorted(nodes.items())
+             if not complete_only or (info.complete and not info.errors)]
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        json.dump({'version': SNAPSHOT_VERSION, 'nodes': saved}, f, indent=1)
+    os.replace(temp_filename, filename)
+    logger.debug("Saved %s nodes to %s", len(saved), filename)
+
+
+def load_snapshot (filename: str) -> Dict[int, NodeInfo]:
+    """Load a node table saved by save_snapshot
+
+    Returns:
+        Dict of NodeInfo indexed by node number
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If the file is not a valid snapshot
+    """
+    with open(filename) as f:
+        values = json.load(f)
+    if not isinstance(values, dict) or values.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot {filename}")
+    nodes = {}
+    for node_values in values.get('nodes', []):
+        info = node_from_dict(node_values)
+        nodes[info.node] = info
+    return nodes
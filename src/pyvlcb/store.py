@@ -0,0 +1,373 @@
+""" SQLite store of bus traffic with indexed queries
+
+Frames are added to a pending list and written in a single transaction
+once batch_size frames are waiting (or flush_interval has passed), so
+adding a frame does not wait for the database. The timestamp, opcode,
+can_id, node number and event number are stored in indexed columns so
+queries by time, opcode and node do not need to decode every frame.
+
+Queries on a database file use their own read only connection (the
+database uses WAL so reading does not block frames being written). An
+in memory database cannot be shared between connections, so queries read
+blocks of rows with the lock held.
+"""
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from .dispatcher import opcode_to_int
+from .vlcbformat import VLCBOpcode
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Rows read at a time when a query uses the shared connection
+QUERY_BLOCK = 256
+
+# Fields stored in the node and event columns
+NODE_FIELDS = ("NN",)
+EVENT_FIELDS = ("EnHigh_EnLow", "DNHigh_DNLow")
+
+_schema = """
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    direction TEXT NOT NULL,
+    priority INTEGER,
+    can_id INTEGER,
+    opcode INTEGER,
+    node INTEGER,
+    event INTEGER,
+    packet TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frames_ts ON frames (ts);
+CREATE INDEX IF NOT EXISTS frames_opcode ON frames (opcode, ts);
+CREATE INDEX IF NOT EXISTS frames_can_id ON frames (can_id, ts);
+CREATE INDEX IF NOT EXISTS frames_node ON frames (node, ts);
+CREATE INDEX IF NOT EXISTS frames_event ON frames (event, ts);
+"""
+
+_insert = "INSERT INTO frames (ts, direction, priority, can_id, opcode, node, event, packet) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def _find_field (layout: Tuple[Tuple[str, int, int, str], ...], names: Tuple[str, ...]) -> Optional[Tuple[int, int]]:
+    for name, start, end, field_type in layout:
+        if name in names:
+            return (start, end)
+    return None
+
+
+# Position of the node and event fields for each opcode (indexed by opcode value)
+# Positions are within the packet string - the data starts at character 7
+def _build_positions () -> Tuple[Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]], ...]:
+    positions = []
+    for op in range(256):
+        code = f"{op:02X}"
+        if code not in VLCBOpcode.opcodes:
+            positions.append((None, None))
+            continue
+        layout = VLCBOpcode.field_layout(code)
+        node = _find_field(layout, NODE_FIELDS)
+        event = _find_field(layout, EVENT_FIELDS)
+        positions.append((
+            None if node is None else (node[0] + 7, node[1] + 7),
+            None if event is None else (event[0] + 7, event[1] + 7)
+        ))
+    return tuple(positions)
+
+_positions = _build_positions()
+
+
+def frame_columns (packet: str) -> Tuple[Optional[int], ...]:
+    """Get the indexed values for a standard frame
+
+    Args:
+        packet: Packet eg. ':SB020N9001000002;'
+
+    Returns:
+        Tuple of (priority, can_id, opcode, node, event). Values which are
+        not part of the frame are None.
+    """
+    if len(packet) < 8 or packet[1] != "S":
+        return (None, None, None, None, None)
+    try:
+        header_val = int(packet[2:6], 16)
+        priority = (header_val & 0xf000) >> 12
+        can_id = (header_val & 0xfe0) >> 5
+        if len(packet) < 10:
+            return (priority, can_id, None, None, None)
+        opcode = int(packet[7:9], 16)
+    except ValueError:
+        return (None, None, None, None, None)
+    node_pos, event_pos = _positions[opcode]
+    node = event = None
+    # Ignore fields which are missing from a short frame or are not hex
+    try:
+        if node_pos is not None and len(packet) > node_pos[1]:
+            node = int(packet[node_pos[0]:node_pos[1]], 16)
+        if event_pos is not None and len(packet) > event_pos[1]:
+            event = int(packet[event_pos[0]:event_pos[1]], 16)
+    except ValueError:
+        node = event = None
+    return (priority, can_id, opcode, node, event)
+
+
+class StoredFrame (NamedTuple):
+    """A frame returned by TrafficStore.query"""
+    id: int
+    timestamp: float
+    direction: str
+    packet: str
+
+
+class TrafficStore:
+    """Store bus traffic in an SQLite database
+
+    Can be used as a CanUSB4 listener: usb.add_listener(store.record)
+    Waiting frames are only written when a frame is added, so when the bus
+    is idle call poll regularly (or use start to poll from a background
+    thread) to write them once flush_interval has passed. Call flush (or
+    close) to make sure all frames are written.
+
+    Attributes:
+        filename: Database file (":memory:" for an in memory database)
+        batch_size: Number of frames written in each transaction
+        flush_interval: Maximum time in seconds before waiting frames are written
+    """
+    def __init__ (self, filename: str, batch_size: int = 1000, flush_interval: float = 1.0, clock: Callable[[], float] = time.time) -> None:
+        """Inits TrafficStore and creates the table and indexes if required
+
+        Args:
+            filename: Database file
+            batch_size: Number of frames written in each transaction
+            flush_interval: Maximum time before waiting frames are written
+            clock: Function returning the current time
+        """
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pending: List[Tuple] = []
+        self._last_flush = clock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        if filename != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_schema)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def add (self, direction: str, packet: Union[str, bytes], timestamp: Optional[float] = None) -> None:
+        """Add a frame
+
+        Args:
+            direction: DIRECTION_RX or DIRECTION_TX
+            packet: Packet eg. ':SB020N9001000002;'
+            timestamp: Time of the frame (default is current time)
+        """
+        if not isinstance(packet, str):
+            packet = packet.decode('ascii', 'replace')
+        now = self.clock()
+        if timestamp is None:
+            timestamp = now
+        row = (timestamp, direction) + frame_columns(packet) + (packet,)
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) < self.batch_size and now - self._last_flush < self.flush_interval:
+                return
+            self._write()
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Add a frame with the current time (signature matches CanUSB4.add_listener)"""
+        self.add(direction, packet)
+
+    # Must be called with the lock held
+    def _write (self) -> None:
+        pending = self._pending
+        self._pending = []
+        self._last_flush = self.clock()
+        if not pending:
+            return
+        with self._connection:
+            self._connection.executemany(_insert, pending)
+        logger.debug("Stored %s frames", len(pending))
+
+    def flush (self) -> None:
+        """Write all waiting frames to the database"""
+        with self._lock:
+            self._write()
+
+    def poll (self) -> bool:
+        """Write waiting frames if flush_interval has passed (eg. when the bus is idle)
+
+        Returns:
+            Bool: True if frames were written
+        """
+        with self._lock:
+            if not self._pending or self.clock() - self._last_flush < self.flush_interval:
+                return False
+            self._write()
+            return True
+
+    def start (self) -> None:
+        """Poll from a background thread every flush_interval"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="TrafficStore", daemon=True)
+        self._thread.start()
+
+    def _run (self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Error writing frames")
+
+    def stop (self) -> None:
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __len__ (self) -> int:
+        with self._lock:
+            self._write()
+            return self._connection.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+    def query (self,
+               start: Optional[float] = None,
+               end: Optional[float] = None,
+               opcode: Optional[Union[int, str]] = None,
+               can_id: Optional[int] = None,
+               node: Optional[int] = None,
+               event: Optional[int] = None,
+               direction: Optional[str] = None,
+               match: Optional[Callable[[str], bool]] = None,
+               limit: Optional[int] = None) -> List[StoredFrame]:
+        """Find frames
+
+        All arguments are optional and are combined so only frames which
+        match all of them are returned (in time order). Waiting frames are
+        written first so they are included.
+        eg. store.query(start, end, node=512)
+        eg. store.query(opcode='ERR', match=VLCBFilter("ErrCode == 2"))
+
+        Args:
+            start: Earliest timestamp
+            end: Latest timestamp
+            opcode: Opcode as int, hex string or mnemonic
+            can_id: CAN ID
+            node: Node number
+            event: Event number
+            direction: DIRECTION_RX or DIRECTION_TX
+            match: Function called with each packet string (eg. VLCBFilter).
+                Only frames where it returns True are included.
+            limit: Maximum number of frames
+
+        Returns:
+            List of StoredFrame
+
+        Raises:
+            ValueError: If opcode not found
+        """
+        return list(self.iter_query(start, end, opcode, can_id, node, event, direction, match, limit))
+
+    def iter_query (self,
+                    start: Optional[float] = None,
+                    end: Optional[float] = None,
+                    opcode: Optional[Union[int, str]] = None,
+                    can_id: Optional[int] = None,
+                    node: Optional[int] = None,
+                    event: Optional[int] = None,
+                    direction: Optional[str] = None,
+                    match: Optional[Callable[[str], bool]] = None,
+                    limit: Optional[int] = None) -> Iterator[StoredFrame]:
+        """Iterator version of query (for results which are too large for a list)"""
+        conditions = []
+        values = []
+        if start is not None:
+            conditions.append("ts >= ?")
+            values.append(start)
+        if end is not None:
+            conditions.append("ts <= ?")
+            values.append(end)
+        if opcode is not None:
+            conditions.append("opcode = ?")
+            values.append(opcode_to_int(opcode))
+        for column, value in (("can_id", can_id), ("node", node), ("event", event), ("direction", direction)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        sql = "SELECT id, ts, direction, packet FROM frames"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY ts, id"
+        # Limit can only be applied by SQLite if there is no match function
+        if limit is not None and match is None:
+            sql += " LIMIT ?"
+            values.append(limit)
+        self.flush()
+        rows = self._locked_rows(sql, values) if self.filename == ":memory:" else self._reader_rows(sql, values)
+        count = 0
+        for row in rows:
+            if match is not None:
+                if not match(row[3]):
+                    continue
+                if limit is not None and count >= limit:
+                    return
+            count += 1
+            yield StoredFrame(*row)
+
+    # Query using a separate read only connection (closed when the query finishes)
+    def _reader_rows (self, sql: str, values: List) -> Iterator[Tuple]:
+        connection = sqlite3.connect(Path(self.filename).resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            yield from connection.execute(sql, values)
+        finally:
+            connection.close()
+
+    # Query using the shared connection - only uses it with the lock held
+    def _locked_rows (self, sql: str, values: List) -> Iterator[Tuple]:
+        with self._lock:
+            cursor = self._connection.execute(sql, values)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(QUERY_BLOCK)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            with self._lock:
+                cursor.close()
+
+    def delete_before (self, timestamp: float) -> int:
+        """Delete frames older than timestamp
+
+        Returns:
+            Int: Number of frames deleted
+        """
+        with self._lock:
+            self._write()
+            with self._connection:
+                cursor = self._connection.execute("DELETE FROM frames WHERE ts < ?", (timestamp,))
+        return cursor.rowcount
+
+    def close (self) -> None:
+        """Write waiting frames and close the database"""
+        self.stop()
+        self.flush()
+        self._connection.close()
+
+    def __enter__ (self) -> "TrafficStore":
+        return self
+
+    def __exit__ (self, *args) -> None:
+        self.close()
@@ -0,0 +1,255 @@
+""" Loco telemetry extracted from capture files using numpy
+
+Rebuilds a timeline of speed, direction and functions for each loco from
+DSPD, DFUN, DKEEP, PLOC and KLOC frames in a capture file. The whole
+capture is processed as numpy arrays (the capture records are read
+directly with np.memmap) so there is no Python code run for each frame.
+
+Sessions are mapped to locos using PLOC (which allocates a session to a
+loco) and KLOC (which releases it). The loco address is the PLOC
+AddrHigh_AddrLow & 0x3FFF, the same as VLCBFormat.get_loco_id.
+
+numpy is an optional dependency: pip install pyvlcb[telemetry]
+"""
+
+from typing import Dict, Union
+from .capture import CaptureReader, FLAG_EXTENDED, FLAG_LENGTH, HEADER_SIZE, RECORD_SIZE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Opcodes used (and minimum frame length including the opcode)
+OPCODE_KLOC = 0x21
+OPCODE_DKEEP = 0x23
+OPCODE_DSPD = 0x47
+OPCODE_DFUN = 0x60
+OPCODE_PLOC = 0xE1
+_min_length = {OPCODE_KLOC: 2, OPCODE_DKEEP: 2, OPCODE_DSPD: 3, OPCODE_DFUN: 4, OPCODE_PLOC: 8}
+
+
+def _require_numpy () -> None:
+    if np is None:
+        raise ImportError("numpy is required for telemetry - install with pip install numpy")
+
+
+def record_dtype ():
+    """numpy dtype for a capture record"""
+    _require_numpy()
+    dtype = np.dtype([
+        ('timestamp', '<f8'),
+        ('header', '<u4'),
+        ('direction', 'u1'),
+        ('flags', 'u1'),
+        ('data', 'u1', (8,)),
+        ('padding', 'V2')
+    ])
+    assert dtype.itemsize == RECORD_SIZE
+    return dtype
+
+
+def load_records (source: Union[str, CaptureReader]):
+    """Load capture records as a numpy structured array
+
+    Args:
+        source: Capture filename or CaptureReader
+
+    Returns:
+        numpy.ndarray: Read only array using record_dtype (memory mapped)
+
+    Raises:
+        ProtocolError: If the file is not a supported capture file
+    """
+    _require_numpy()
+    if isinstance(source, CaptureReader):
+        filename, count = source.filename, len(source)
+    else:
+        # Opening a reader checks the file header
+        with CaptureReader(source) as reader:
+            filename, count = reader.filename, len(reader)
+    if count == 0:
+        return np.zeros(0, dtype=record_dtype())
+    return np.memmap(filename, dtype=record_dtype(), mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+# Convert DFUN group bytes to function bits (as LocoFunctions.mask)
+def _group_mask (group: int, values):
+    values = values.astype(np.uint32)
+    if group == 1:
+        # F0 is bit 4, F1 to F4 bits 0 to 3
+        return ((values & 0xF) << 1) | ((values >> 4) & 1)
+    if group == 2:
+        return (values & 0xF) << 5
+    if group == 3:
+        return (values & 0xF) << 9
+    if group == 4:
+        return values << 13
+    return values << 21
+
+
+class LocoTimeline:
+    """Speed, direction and function history for a loco
+
+    All times are timestamps from the capture. Arrays are in time order.
+
+    Attributes:
+        address: Loco address
+        speed_time: Time of each DSPD or PLOC
+        speed: Speed step (0 to 127, 1 is emergency stop)
+        direction: Direction (1 forward, 0 reverse)
+        function_time: Time of each DFUN or PLOC
+        function_mask: Functions on after each change (bit 0 = F0 as LocoFunctions.mask)
+        keepalive_time: Time of each DKEEP
+        activity_time: Time of every DSPD, DFUN and DKEEP (each resets the session timeout)
+    """
+    def __init__ (self, address: int, speed_time, speed, direction, function_time, function_mask,
+                  keepalive_time, activity_time) -> None:
+        self.address = address
+        self.speed_time = speed_time
+        self.speed = speed
+        self.direction = direction
+        self.function_time = function_time
+        self.function_mask = function_mask
+        self.keepalive_time = keepalive_time
+        self.activity_time = activity_time
+
+    def __repr__ (self) -> str:
+        return f"LocoTimeline({self.address}, {len(self.speed_time)} speed, {len(self.function_time)} function, {len(self.keepalive_time)} keep alive)"
+
+    def duration (self) -> float:
+        """Time between the first and last frame for the loco"""
+        times = [t for t in (self.speed_time, self.function_time, self.activity_time) if len(t)]
+        if not times:
+            return 0.0
+        return float(max(t[-1] for t in times) - min(t[0] for t in times))
+
+    def keepalive_gaps (self):
+        """Time between each frame which keeps the session alive"""
+        return np.diff(self.activity_time)
+
+    def max_keepalive_gap (self) -> float:
+        """Longest time without a frame to keep the session alive"""
+        gaps = self.keepalive_gaps()
+        return float(gaps.max()) if len(gaps) else 0.0
+
+    def speed_changes (self) -> int:
+        """Number of times the speed or direction changed"""
+        if len(self.speed) < 2:
+            return 0
+        speed_dir = self.speed.astype(np.int16) | (self.direction.astype(np.int16) << 7)
+        return int(np.count_nonzero(np.diff(speed_dir)))
+
+    def speed_change_rate (self) -> float:
+        """Speed or direction changes per second"""
+        duration = self.duration()
+        return self.speed_changes() / duration if duration > 0 else 0.0
+
+
+def extract_telemetry (source) -> Dict[int, LocoTimeline]:
+    """Build a timeline for each loco in a capture
+
+    Args:
+        source: Capture filename, CaptureReader or array from load_records
+
+    Returns:
+        Dict of LocoTimeline indexed by loco address
+
+    Raises:
+        ImportError: If numpy is not installed
+    """
+    _require_numpy()
+    records = source if isinstance(source, np.ndarray) else load_records(source)
+    count = len(records)
+    flags = records['flags']
+    data = records['data']
+    timestamps = records['timestamp']
+    opcodes = data[:, 0]
+    length = flags & FLAG_LENGTH
+    standard = (flags & FLAG_EXTENDED) == 0
+
+    # Index of the loco frames with enough data
+    selected = np.zeros(count, dtype=bool)
+    for opcode, min_length in _min_length.items():
+        selected |= (opcodes == opcode) & (length >= min_length)
+    selected &= standard
+    index = np.nonzero(selected)[0]
+    if len(index) == 0:
+        return {}
+    frame_op = opcodes[index]
+    frame_data = data[index]
+    sessions = frame_data[:, 1].astype(np.int64)
+
+    # Session allocations - PLOC allocates, KLOC releases (address -1)
+    is_ploc = frame_op == OPCODE_PLOC
+    is_kloc = frame_op == OPCODE_KLOC
+    allocate = is_ploc | is_kloc
+    addresses = ((frame_data[:, 2].astype(np.int64) << 8) | frame_data[:, 3]) & 0x3FFF
+    allocate_address = np.where(is_ploc, addresses, -1)[allocate]
+    # Sort key is session then position in the capture
+    keys = sessions * (count + 1) + index
+    allocate_keys = keys[allocate]
+    allocate_sessions = sessions[allocate]
+    order = np.argsort(allocate_keys, kind='stable')
+    allocate_keys = allocate_keys[order]
+    allocate_sessions = allocate_sessions[order]
+    allocate_address = allocate_address[order]
+
+    # Latest allocation of the session at or before each frame
+    # KLOC uses the allocation before it (the loco being released)
+    position = np.searchsorted(allocate_keys, keys - is_kloc, side='right') - 1
+    valid = position >= 0
+    position = np.where(valid, position, 0)
+    if len(allocate_keys):
+        frame_address = np.where(valid & (allocate_sessions[position] == sessions), allocate_address[position], -1)
+    else:
+        frame_address = np.full(len(index), -1)
+
+    timelines = {}
+    for address in np.unique(frame_address):
+        if address < 0:
+            continue
+        loco = frame_address == address
+        loco_op = frame_op[loco]
+        loco_data = frame_data[loco]
+        loco_time = timestamps[index[loco]]
+
+        # Speed from DSPD (SpeedDir is byte 2) and PLOC (byte 4)
+        is_dspd = loco_op == OPCODE_DSPD
+        loco_ploc = loco_op == OPCODE_PLOC
+        speed_frames = is_dspd | loco_ploc
+        speed_dir = np.where(is_dspd, loco_data[:, 2], loco_data[:, 4])[speed_frames]
+
+        # Functions from DFUN (group, byte) and PLOC (groups 1 to 3)
+        is_dfun = loco_op == OPCODE_DFUN
+        ploc_count = int(np.count_nonzero(loco_ploc))
+        ploc_rows = np.nonzero(loco_ploc)[0]
+        dfun_rows = np.nonzero(is_dfun)[0]
+        function_rows = np.concatenate((dfun_rows, np.repeat(ploc_rows, 3)))
+        groups = np.concatenate((loco_data[dfun_rows, 2], np.tile(np.array([1, 2, 3], dtype=np.uint8), ploc_count)))
+        values = np.concatenate((loco_data[dfun_rows, 3],
+                                 loco_data[ploc_rows][:, 5:8].reshape(-1)))
+        order = np.argsort(function_rows, kind='stable')
+        function_rows = function_rows[order]
+        groups = groups[order]
+        values = values[order]
+        function_mask = np.zeros(len(function_rows), dtype=np.uint32)
+        positions = np.arange(len(function_rows))
+        for group in range(1, 6):
+            # Most recent value for this group at each change
+            last = np.maximum.accumulate(np.where(groups == group, positions, -1)) if len(positions) else positions
+            group_values = np.where(last >= 0, values[np.maximum(last, 0)], 0)
+            function_mask |= _group_mask(group, group_values)
+
+        is_dkeep = loco_op == OPCODE_DKEEP
+        timelines[int(address)] = LocoTimeline(
+            int(address),
+            speed_time=loco_time[speed_frames],
+            speed=(speed_dir & 0x7F).astype(np.uint8),
+            direction=(speed_dir >> 7).astype(np.uint8),
+            function_time=loco_time[function_rows],
+            function_mask=function_mask,
+            keepalive_time=loco_time[is_dkeep],
+            activity_time=loco_time[is_dspd | is_dfun | is_dkeep]
+        )
+    return timelines
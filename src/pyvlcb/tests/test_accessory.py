@@ -0,0 +1,87 @@
+import unittest
+from pyvlcb import AccessoryStateTable
+from pyvlcb.encoder import frame
+
+class TestAccessoryStateTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = AccessoryStateTable()
+        self.changes = []
+        self.table.add_listener(lambda node, event, state: self.changes.append((node, event, state)))
+
+    def test_long_events(self):
+        """Test ACON / ACOF and the data variants update the node and event."""
+        self.assertIsNone(self.table.state(256, 5))
+        self.assertTrue(self.table.update(frame(10, '90', 1, 0, 0, 5)))
+        self.assertTrue(self.table.state(256, 5))
+        self.assertIsNone(self.table.state(256, 6))
+        self.assertIsNone(self.table.state(257, 5))
+        self.table.update(frame(10, 'D1', 1, 0, 0, 5, 1, 2))
+        self.assertFalse(self.table.state(256, 5))
+        self.table.record("RX", frame(10, 'F0', 1, 0, 0xFF, 0xFF, 1, 2, 3).encode('ascii'))
+        self.assertTrue(self.table.state(256, 0xFFFF))
+        self.assertEqual(self.changes, [(256, 5, True), (256, 5, False), (256, 0xFFFF, True)])
+        self.assertEqual(self.table.node_states(256), {5: False, 0xFFFF: True})
+
+    def test_short_events(self):
+        """Test short events are indexed by device number whichever node sends them."""
+        self.table.update(frame(10, '98', 1, 0, 0, 20))
+        self.assertTrue(self.table.short_state(20))
+        self.table.update(frame(11, 'B9', 2, 0, 0, 20, 7))
+        self.assertFalse(self.table.short_state(20))
+        self.assertIsNone(self.table.state(256, 20))
+        self.table.update(frame(11, 'D8', 2, 0, 0, 21, 7, 8))
+        self.table.update(frame(11, 'D9', 2, 0, 0, 21, 7, 8))
+        self.assertFalse(self.table.short_state(21))
+        self.assertEqual(self.changes, [(None, 20, True), (None, 20, False), (None, 21, True), (None, 21, False)])
+
+    def test_no_change(self):
+        """Test listeners are only called when the state changes."""
+        self.assertTrue(self.table.set(1, 1, False))
+        self.assertFalse(self.table.set(1, 1, False))
+        self.assertFalse(self.table.update(frame(10, '91', 0, 1, 0, 1)))
+        self.assertEqual(len(self.changes), 1)
+        self.assertEqual(self.table.updates, 3)
+
+    def test_other_frames(self):
+        """Test other opcodes and invalid frames are ignored."""
+        self.assertFalse(self.table.update(frame(10, '0D')))
+        self.assertFalse(self.table.update(frame(10, 'B6', 1, 0, 0xA5, 1, 2)))
+        self.assertFalse(self.table.update(":SB020N90ZZ000001;"))
+        self.assertEqual(len(self.table), 0)
+        with self.assertRaises(ValueError):
+            self.table.set_short(0x10000, True)
+
+    def test_snapshot(self):
+        """Test snapshot and load give the same states."""
+        for event in range(0, 3000, 3):
+            self.table.set(event % 50, event, event % 2 == 0)
+            self.table.set_short(event, event % 5 == 0)
+        snapshot = self.table.snapshot()
+        self.assertEqual(len(snapshot['long']), 1000)
+        self.assertEqual(len(snapshot['short']), 1000)
+        self.assertEqual(len(self.table), 2000)
+        self.assertTrue(snapshot['long'][(0, 300)])
+        self.assertFalse(snapshot['short'][3])
+        other = AccessoryStateTable()
+        other.load(snapshot)
+        self.assertEqual(other.snapshot(), snapshot)
+        self.assertEqual(other.updates, 0)
+        self.assertEqual(other.nodes(), list(range(50)))
+        self.table.clear()
+        self.assertEqual(len(self.table), 0)
+
+    def test_flood(self):
+        """Test a flood of sensor events across many nodes is all stored."""
+        packets = [frame(10, '90' if number % 2 else '91', 1, number % 200, number >> 8, number & 0xFF) for number in range(20000)]
+        table = AccessoryStateTable()
+        for packet in packets:
+            table.update(packet)
+        self.assertEqual(len(table), 20000)
+        self.assertEqual(table.updates, 20000)
+        self.assertTrue(table.state(256 + 1, 1))
+        self.assertFalse(table.state(256 + 2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
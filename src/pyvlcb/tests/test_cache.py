@@ -0,0 +1,54 @@
+import unittest
+from pyvlcb import VLCB, DecodeCache, FrozenVLCBFormat
+
+class TestDecodeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60, cache_size=2)
+
+    def test_repeated_packets(self):
+        """Test that repeated packets are returned from the cache."""
+        first = self.vlcb.parse_input(":SB780N2301;")
+        second = self.vlcb.parse_input(":SB780N2301;")
+        self.assertIs(first, second)
+        self.assertIsInstance(first, FrozenVLCBFormat)
+        self.assertEqual(self.vlcb.cache.hits, 1)
+        self.assertEqual(self.vlcb.cache.misses, 1)
+        # Decoded data is also reused
+        self.assertIs(first.get_data(), second.get_data())
+        self.assertEqual(first.get_data()['Session'], 1)
+
+    def test_results_are_read_only(self):
+        """Test that cached results cannot be changed."""
+        packet = self.vlcb.parse_input(":SB780N9001000002;")
+        with self.assertRaises(AttributeError):
+            packet.data = "9101000002"
+        with self.assertRaises(TypeError):
+            packet.get_data()['NN'] = 1
+        with self.assertRaises(TypeError):
+            self.vlcb.cache.parse_data("9001000002")['NN'] = 1
+
+    def test_bounded_size(self):
+        """Test that least recently used entries are removed."""
+        self.vlcb.parse_input(":SB780N2301;")
+        self.vlcb.parse_input(":SB780N2302;")
+        self.vlcb.parse_input(":SB780N2301;")
+        self.vlcb.parse_input(":SB780N2303;")
+        self.assertEqual(len(self.vlcb.cache), 2)
+        # 2302 was least recently used so needs to be decoded again
+        self.vlcb.parse_input(":SB780N2302;")
+        self.assertEqual(self.vlcb.cache.misses, 4)
+        self.vlcb.cache.clear()
+        self.assertEqual(len(self.vlcb.cache), 0)
+        self.assertEqual(self.vlcb.cache.hits, 0)
+
+    def test_invalid_packets(self):
+        """Test that invalid packets still raise ValueError."""
+        with self.assertRaises(ValueError):
+            self.vlcb.parse_input(":S;")
+        with self.assertRaises(ValueError):
+            DecodeCache(VLCB().parse_input, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
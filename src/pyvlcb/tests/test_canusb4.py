@@ -124,5 +124,36 @@ class TestCanUSB4(unittest.TestCase):
         # Should only capture the :VALID; part
         self.assertEqual(data, [':VALID;'])
 
+    def test_listeners(self):
+        """Test that listeners are called for packets sent and received."""
+        from pyvlcb.canusb import DIRECTION_RX, DIRECTION_TX
+        packets = []
+        listener = lambda direction, packet: packets.append((direction, packet))
+        self.canusb.add_listener(listener)
+        self.canusb.send_data(b":SB780N0D;")
+        payload = b':ONE;:TWO;'
+        self.mock_serial_instance.in_waiting = len(payload)
+        self.mock_serial_instance.read.return_value = payload
+        self.canusb.read_data()
+        self.assertEqual(packets, [(DIRECTION_TX, ":SB780N0D;"), (DIRECTION_RX, ":ONE;"), (DIRECTION_RX, ":TWO;")])
+        self.canusb.remove_listener(listener)
+        self.canusb.send_data("test")
+        self.assertEqual(len(packets), 3)
+
+    def test_failing_listener(self):
+        """Test that a listener which raises does not stop the others or lose packets."""
+        packets = []
+        def failing(direction, packet):
+            raise RuntimeError("listener error")
+        self.canusb.add_listener(failing)
+        self.canusb.add_listener(lambda direction, packet: packets.append(packet))
+        payload = b':ONE;:TWO;'
+        self.mock_serial_instance.in_waiting = len(payload)
+        self.mock_serial_instance.read.return_value = payload
+        with self.assertLogs("pyvlcb.canusb", level="ERROR"):
+            self.assertEqual(self.canusb.read_data(), [":ONE;", ":TWO;"])
+            self.canusb.send_data(":SB780N0D;")
+        self.assertEqual(packets, [":ONE;", ":TWO;", ":SB780N0D;"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
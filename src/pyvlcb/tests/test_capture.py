@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+from pyvlcb import VLCB, CaptureReader, CaptureWriter, ProtocolError
+from pyvlcb.capture import log_to_capture, capture_to_log, packet_to_record, record_to_packet, RECORD_SIZE, HEADER_SIZE
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        self.messages = [":SB780N2301;", ":SB020N9001000002;", ":SB020NE101C00380110208;", ":S8780N470582;", ":X00080004N0D;"]
+        fd, self.filename = tempfile.mkstemp(suffix=".cap")
+        os.close(fd)
+        with CaptureWriter(self.filename) as writer:
+            for num in range(100):
+                writer.write(1000.0 + num, "TX" if num % 2 else "RX", self.messages[num % 5])
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_record_size(self):
+        """Test records are fixed size after the file header."""
+        self.assertEqual(RECORD_SIZE, 24)
+        self.assertEqual(os.path.getsize(self.filename), HEADER_SIZE + 100 * RECORD_SIZE)
+
+    def test_packet_round_trip(self):
+        """Test packets are unchanged after conversion to a record."""
+        for message in self.messages + [":S0000R;"]:
+            self.assertEqual(record_to_packet(*packet_to_record(message)), message)
+        with self.assertRaises(ValueError):
+            packet_to_record(":SB780N000102030405060708;")
+
+    def test_random_access(self):
+        """Test records can be read by index."""
+        with CaptureReader(self.filename) as reader:
+            self.assertEqual(len(reader), 100)
+            self.assertEqual(reader[7].packet, self.messages[2])
+            self.assertEqual(reader[7].direction, "TX")
+            self.assertEqual(reader[7].timestamp, 1007.0)
+            self.assertEqual(reader[-1].packet, self.messages[4])
+            with self.assertRaises(IndexError):
+                reader[100]
+            self.assertEqual(reader.find_time(1050.5), 51)
+
+    def test_iterate_and_decode(self):
+        """Test packets from the reader can be decoded by VLCB.parse_input."""
+        with CaptureReader(self.filename) as reader:
+            packets = [packet for timestamp, direction, packet in reader.iter_packets(0, 5)]
+            self.assertEqual(packets, self.messages)
+            decoded = list(reader.iter_decoded(self.vlcb, 0, 4))
+            self.assertEqual(decoded[1][2].opcode(), "ACON")
+            self.assertEqual(decoded[3][2].data, "470582")
+
+    def test_close_with_views(self):
+        """Test the reader can be closed with an unfinished iterator or a buffer view."""
+        reader = CaptureReader(self.filename)
+        records = reader.iter_records()
+        self.assertEqual(next(records).packet, self.messages[0])
+        view = reader.buffer
+        self.assertEqual(len(view), 100 * RECORD_SIZE)
+        reader.close()
+        with self.assertRaises(ValueError):
+            view[0]
+
+    def test_append(self):
+        """Test records can be added to an existing capture."""
+        with CaptureWriter(self.filename, append=True) as writer:
+            writer.write(2000.0, "RX", ":SB780N0D;")
+        with CaptureReader(self.filename) as reader:
+            self.assertEqual(len(reader), 101)
+            self.assertEqual(reader[100].packet, ":SB780N0D;")
+
+    def test_invalid_file(self):
+        """Test a file which is not a capture is rejected."""
+        with open(self.filename, "wb") as f:
+            f.write(b"0,2026-10-19 14:00:00.000,RX,:SB780N0D;\n")
+        with self.assertRaises(ProtocolError):
+            CaptureReader(self.filename)
+
+    def test_log_conversion(self):
+        """Test conversion between text logs and captures."""
+        fd, log_filename = tempfile.mkstemp(suffix=".log")
+        os.close(fd)
+        fd, capture_filename = tempfile.mkstemp(suffix=".cap")
+        os.close(fd)
+        try:
+            self.assertEqual(capture_to_log(self.filename, log_filename), 100)
+            with open(log_filename, "a") as f:
+                f.write("100,2026-10-19 14:03:00.000,RX,:XINVALID;\n")
+            self.assertEqual(log_to_capture(log_filename, capture_filename), 100)
+            with CaptureReader(self.filename) as original, CaptureReader(capture_filename) as converted:
+                self.assertEqual([r.packet for r in original], [r.packet for r in converted])
+                self.assertAlmostEqual(converted[10].timestamp, 1010.0, places=3)
+            with open(log_filename) as f:
+                first = f.readline().strip()
+            self.assertEqual(self.vlcb.log_entry(first)[4], "23 - DKEEP")
+        finally:
+            os.remove(log_filename)
+            os.remove(capture_filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import threading
+import time
+import unittest
+from pyvlcb import VLCB, SpeedCoalescer
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+        self.received = threading.Event()
+
+    def send_data(self, data):
+        self.sent.append(data)
+        self.received.set()
+
+
+class TestSpeedCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.vlcb = VLCB(can_id=60)
+        self.transport = FakeTransport()
+        self.coalescer = SpeedCoalescer(self.vlcb, self.transport, clock=lambda: self.now)
+
+    def test_first_sent_immediately(self):
+        """Test the first value and values after the window are sent straight away."""
+        self.assertTrue(self.coalescer.set_speed(1, 20, 1))
+        self.now += 0.05
+        self.assertTrue(self.coalescer.set_speeddir(1, 0x95))
+        self.assertEqual(self.transport.sent, [self.vlcb.loco_speeddir(1, 0x94), self.vlcb.loco_speeddir(1, 0x95)])
+
+    def test_latest_value_wins(self):
+        """Test only the newest value in the window is sent."""
+        self.coalescer.set_speed(1, 10, 1)
+        for speed in range(11, 60):
+            self.now += 0.0005
+            self.assertFalse(self.coalescer.set_speed(1, speed, 1))
+        # Other sessions are independent
+        self.assertTrue(self.coalescer.set_speed(2, 5, 0))
+        self.assertEqual(self.coalescer.poll(), 0)
+        self.now = 100.033
+        self.assertEqual(self.coalescer.poll(), 1)
+        self.assertEqual(self.transport.sent, [self.vlcb.loco_speeddir(1, 0x8A), self.vlcb.loco_speeddir(2, 5),
+                                               self.vlcb.loco_speeddir(1, 0x80 + 59)])
+        self.assertEqual(self.coalescer.coalesced, 48)
+        self.assertEqual(self.coalescer.pending(), {})
+
+    def test_emergency_stop_bypasses_window(self):
+        """Test emergency stop is sent immediately and replaces a waiting value."""
+        self.coalescer.set_speed(1, 10, 1)
+        self.coalescer.set_speed(1, 50, 1)
+        self.coalescer.emergency_stop(1)
+        self.assertEqual(self.transport.sent[-1], self.vlcb.loco_speeddir(1, 0x81))
+        self.now += 1
+        self.assertEqual(self.coalescer.poll(), 0)
+        with self.assertRaises(ValueError):
+            self.coalescer.set_speed(1, 128, 1)
+
+    def test_speed_one(self):
+        """Test speed 1 is sent as 2 rather than emergency stop."""
+        self.coalescer.set_speed(1, 1, 1)
+        self.now += 0.001
+        self.coalescer.set_speed(1, 1, 0)
+        self.now += 0.05
+        self.coalescer.poll()
+        self.assertEqual(self.transport.sent, [self.vlcb.loco_speeddir(1, 0x82), self.vlcb.loco_speeddir(1, 0x02)])
+
+    def test_emergency_stop_not_overtaken(self):
+        """Test a waiting speed being sent cannot be sent after an emergency stop from another thread."""
+        entered = threading.Event()
+        release = threading.Event()
+
+        class SlowTransport(FakeTransport):
+            def send_data(self, data):
+                if data == first and not entered.is_set():
+                    entered.set()
+                    release.wait(2)
+                super().send_data(data)
+
+        transport = SlowTransport()
+        first = self.vlcb.loco_speeddir(1, 0xA0)
+        coalescer = SpeedCoalescer(self.vlcb, transport, clock=lambda: self.now)
+        coalescer.set_speed(1, 10, 1)
+        coalescer.set_speed(1, 32, 1)
+        self.now += 0.05
+        poller = threading.Thread(target=coalescer.poll)
+        poller.start()
+        self.assertTrue(entered.wait(2))
+        stopper = threading.Thread(target=coalescer.emergency_stop, args=(1,))
+        stopper.start()
+        time.sleep(0.05)
+        release.set()
+        poller.join(2)
+        stopper.join(2)
+        self.assertEqual(transport.sent[1:], [first, self.vlcb.loco_speeddir(1, 0x81)])
+
+    def test_background_thread(self):
+        """Test waiting values are sent by the background thread."""
+        coalescer = SpeedCoalescer(self.vlcb, self.transport)
+        coalescer.start()
+        try:
+            coalescer.set_speed(1, 10, 1)
+            coalescer.set_speed(1, 20, 1)
+            self.transport.received.clear()
+            self.assertTrue(self.transport.received.wait(1))
+            self.assertEqual(self.transport.sent[-1], self.vlcb.loco_speeddir(1, 0x94))
+        finally:
+            coalescer.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
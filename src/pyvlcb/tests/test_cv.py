@@ -0,0 +1,164 @@
+import os
+import tempfile
+import unittest
+from pyvlcb import VLCB, CVProgrammer
+from pyvlcb.cv import CVCache, decoder_address
+from pyvlcb.encoder import frame
+
+class FakeProgrammer:
+    """Command station with a decoder on the programming track"""
+    def __init__(self, cvs, busy=0, no_ack=()):
+        self.cvs = dict(cvs)
+        self.busy = busy
+        self.no_ack = set(no_ack)
+        self.waiting = []
+        self.sent = []
+        self.overload = False
+
+    def send_data(self, data):
+        self.sent.append(data)
+        opcode = int(data[7:9], 16)
+        session = int(data[9:11], 16)
+        cv = int(data[11:15], 16)
+        if self.overload:
+            self.waiting.append(frame(1, '4C', session, 2))
+        elif self.busy:
+            self.busy -= 1
+            self.waiting.append(frame(1, '4C', session, 4))
+        elif cv in self.no_ack:
+            self.no_ack.discard(cv)
+            self.waiting.append(frame(1, '4C', session, 1))
+        elif cv > 1024:
+            self.waiting.append(frame(1, '4C', session, 5))
+        elif opcode == 0x84:
+            self.waiting.append(frame(1, '85', session, cv >> 8, cv & 0xFF, self.cvs.get(cv, 0)))
+        elif opcode == 0xA2:
+            self.cvs[cv] = int(data[17:19], 16)
+            self.waiting.append(frame(1, '4C', session, 3))
+
+    def read_data(self):
+        packets, self.waiting = self.waiting, []
+        return packets
+
+
+class TestCVProgrammer(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        self.decoder = {cv: (cv * 7) & 0xFF for cv in range(1, 257)}
+        self.decoder[29] = 0x22
+        self.decoder[17] = 0xC4
+        self.decoder[18] = 0xD2
+
+    def test_builders(self):
+        """Test the QCVS and WCVS requests (CV number is 16 bit)."""
+        self.assertEqual(self.vlcb.read_cv(1, 300), ":SA780N8401012C00;")
+        self.assertEqual(self.vlcb.write_cv(1, 8, 8, 1), ":S8780NA20100080108;")
+        with self.assertRaises(ValueError):
+            self.vlcb.write_cv(1, 8, 256)
+
+    def test_read_range(self):
+        """Test a range of CVs is read and cached."""
+        cache = CVCache()
+        bus = FakeProgrammer(self.decoder)
+        progress = []
+        programmer = CVProgrammer(self.vlcb, bus, 1, address=1234, cache=cache,
+                                  progress=lambda prog: progress.append(prog.completed))
+        programmer.read_range(1, 256)
+        results = programmer.run(timeout=10)
+        self.assertTrue(all(operation.ok for operation in results))
+        self.assertEqual(programmer.values(), self.decoder)
+        self.assertEqual(cache.values(1234), self.decoder)
+        self.assertEqual(progress, list(range(1, 257)))
+        self.assertEqual(decoder_address(programmer.values()), 0xC000 + 1234)
+        stats = programmer.stats()
+        self.assertEqual((stats['total'], stats['completed'], stats['failed']), (256, 256, 0))
+        self.assertGreater(stats['throughput'], 0)
+
+    def test_write_profile(self):
+        """Test only CVs which are different from the profile are written."""
+        bus = FakeProgrammer(self.decoder)
+        profile = {1: 3, 2: self.decoder[2], 3: 99, 4: self.decoder[4]}
+        programmer = CVProgrammer(self.vlcb, bus, 1, address=3)
+        programmer.write_profile(profile)
+        results = programmer.run(timeout=10)
+        writes = [(operation.cv, operation.value) for operation in results if operation.kind == "write"]
+        self.assertEqual(writes, [(1, 3), (3, 99)])
+        self.assertTrue(all(operation.ok for operation in results))
+        self.assertEqual(programmer.skipped, 2)
+        self.assertEqual(bus.cvs[3], 99)
+        # Second time all values are in the cache so nothing is sent
+        bus.sent = []
+        again = CVProgrammer(self.vlcb, bus, 1, address=3, cache=programmer.cache)
+        again.write_profile(profile)
+        again.run(timeout=10)
+        self.assertEqual(bus.sent, [])
+        self.assertEqual(again.skipped, 4)
+
+    def test_write_profile_invalid(self):
+        """Test an out of range profile value is rejected before anything is queued."""
+        programmer = CVProgrammer(self.vlcb, FakeProgrammer(self.decoder), 1, address=3)
+        with self.assertRaises(ValueError):
+            programmer.write_profile({1: 3, 3: 300})
+        self.assertEqual(programmer.total, 0)
+
+    def test_retry(self):
+        """Test busy and no acknowledge are sent again."""
+        bus = FakeProgrammer(self.decoder, busy=1, no_ack=[5])
+        programmer = CVProgrammer(self.vlcb, bus, 1, busy_delay=0.01)
+        read = programmer.add_read(5)
+        write = programmer.add_write(6, 1)
+        programmer.run(timeout=10)
+        self.assertEqual((read.status, read.attempts, read.value), ("ok", 3, self.decoder[5]))
+        self.assertEqual((write.status, write.attempts), ("ok", 1))
+
+    def test_errors(self):
+        """Test out of range, overload and session errors."""
+        bus = FakeProgrammer(self.decoder)
+        programmer = CVProgrammer(self.vlcb, bus, 1)
+        out_of_range = programmer.add_read(2000)
+        programmer.run(timeout=10)
+        self.assertEqual((out_of_range.status, out_of_range.error), ("failed", "CV out of range"))
+        bus.overload = True
+        operations = programmer.read_range(1, 3)
+        programmer.run(timeout=10)
+        self.assertEqual([operation.error for operation in operations], ["Overload on programming track"] * 3)
+        self.assertEqual(len(bus.sent), 2)
+        bus.overload = False
+        operations = programmer.read_range(1, 2)
+        programmer.poll()
+        programmer.receive(frame(1, '63', 1, 0, 3))
+        self.assertTrue(programmer.poll())
+        self.assertEqual([operation.error for operation in operations], ["Session not present"] * 2)
+
+    def test_timeout(self):
+        """Test an operation without a reply times out after the retries."""
+        now = [0.0]
+        programmer = CVProgrammer(self.vlcb, FakeProgrammer({}), 1, timeout=1, retries=1, clock=lambda: now[0])
+        operation = programmer.add_read(1)
+        programmer.poll()
+        for count in range(2):
+            now[0] += 1
+            programmer.poll()
+        self.assertEqual((operation.status, operation.attempts), ("timeout", 2))
+
+    def test_cache_file(self):
+        """Test the cache is saved and loaded."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "cvs.json")
+            cache = CVCache(filename)
+            cache.set(3, 1, 3)
+            cache.set(0xC000 + 1234, 29, 0x22)
+            cache.save()
+            loaded = CVCache(filename)
+            self.assertEqual(loaded.addresses(), [3, 0xC000 + 1234])
+            self.assertEqual(loaded.get(3, 1), 3)
+            self.assertIsNone(loaded.get(3, 2))
+            with open(filename, "w") as f:
+                f.write('{"3": 5}')
+            with self.assertRaises(ValueError):
+                CVCache(filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+import os
+import tempfile
+import unittest
+from pyvlcb import VLCB, DiscoveryEngine
+from pyvlcb.snapshot import load_snapshot, save_snapshot
+from pyvlcb.encoder import frame
+
+class SimulatedBus:
+    """Nodes which reply to discovery requests when read_data is called"""
+    def __init__(self, nodes, drop_first=()):
+        # nodes is {node_number: (can_id, parameters, events)}
+        self.nodes = nodes
+        self.drop_first = set(drop_first)
+        self.waiting = []
+        self.sent = []
+        self.max_waiting = 0
+
+    def send_data(self, data):
+        self.sent.append(data)
+        opcode = int(data[7:9], 16)
+        if opcode == 0x0D:
+            for nn, (can_id, parameters, events) in self.nodes.items():
+                self.waiting.append(frame(can_id, 'B6', nn >> 8, nn & 0xFF, 0xA5, parameters[3], 0x07))
+            return
+        nn = int(data[9:13], 16)
+        if nn not in self.nodes:
+            return
+        if (nn, opcode) in self.drop_first:
+            self.drop_first.discard((nn, opcode))
+            return
+        can_id, parameters, events = self.nodes[nn]
+        node_bytes = (nn >> 8, nn & 0xFF)
+        if opcode == 0x73:
+            index = int(data[13:15], 16)
+            value = len(parameters) if index == 0 else parameters[index]
+            self.waiting.append(frame(can_id, '9B', *node_bytes, index, value))
+        elif opcode == 0x58:
+            self.waiting.append(frame(can_id, '74', *node_bytes, len(events)))
+        elif opcode == 0x56:
+            self.waiting.append(frame(can_id, '70', *node_bytes, 64 - len(events)))
+        elif opcode == 0x71:
+            index = int(data[13:15], 16)
+            self.waiting.append(frame(can_id, '97', *node_bytes, index, index * 3))
+        elif opcode == 0x57:
+            for index, event in enumerate(events, 1):
+                self.waiting.append(frame(can_id, 'F2', *node_bytes, *event.to_bytes(4, 'big'), index))
+        self.max_waiting = max(self.max_waiting, len({packet[9:13] for packet in self.waiting}))
+
+    def read_data(self):
+        packets, self.waiting = self.waiting, []
+        return packets
+
+
+def make_nodes(count):
+    nodes = {}
+    for number in range(count):
+        nn = 256 + number
+        parameters = {index: index + number % 7 for index in range(1, 9)}
+        parameters[6] = number % 3
+        events = [(nn << 16) + event for event in range(number % 4)]
+        nodes[nn] = (1 + number % 100, parameters, events)
+    return nodes
+
+
+class TestDiscoveryEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+
+    def test_discover_layout(self):
+        """Test parameters, event counts and events are read for every node."""
+        nodes = make_nodes(100)
+        bus = SimulatedBus(nodes)
+        engine = DiscoveryEngine(self.vlcb, bus, window=8, qnn_wait=0.01)
+        found = engine.run(timeout=10)
+        # Every reply arrived so no request was sent again
+        self.assertEqual(len(bus.sent), len(set(bus.sent)))
+        self.assertEqual(sorted(found), sorted(nodes))
+        for nn, (can_id, parameters, events) in nodes.items():
+            info = found[nn]
+            self.assertTrue(info.complete)
+            self.assertEqual(info.can_id, can_id)
+            self.assertEqual(info.parameters, {**parameters, 0: 8})
+            self.assertEqual(info.num_events, len(events))
+            self.assertEqual(info.event_space, 64 - len(events))
+            self.assertEqual(sorted(info.events.values()), events)
+            self.assertEqual(info.errors, [])
+        self.assertLessEqual(bus.max_waiting, 8)
+
+    def test_retry(self):
+        """Test a request without a reply is sent again."""
+        nodes = make_nodes(2)
+        bus = SimulatedBus(nodes, drop_first=[(256, 0x58)])
+        engine = DiscoveryEngine(self.vlcb, bus, timeout=0.02, qnn_wait=0.01)
+        found = engine.run(timeout=5)
+        self.assertTrue(found[256].complete)
+        self.assertEqual(found[256].num_events, 0)
+        self.assertEqual(found[256].errors, [])
+
+    def test_no_reply(self):
+        """Test a node which stops replying is reported after the retries."""
+        now = [0.0]
+        bus = SimulatedBus({})
+        engine = DiscoveryEngine(self.vlcb, bus, timeout=1, retries=1, read_parameters=False, clock=lambda: now[0])
+        info = engine.discover_node(300)
+        self.assertFalse(engine.poll())
+        self.assertEqual(len(bus.sent), 1)
+        now[0] += 1
+        engine.poll()
+        self.assertEqual(len(bus.sent), 2)
+        now[0] += 1
+        engine.poll()
+        now[0] += 1
+        engine.poll()
+        now[0] += 1
+        self.assertTrue(engine.poll())
+        self.assertEqual(info.errors, ["58 no reply", "56 no reply"])
+        self.assertTrue(info.complete)
+
+    def test_error_response(self):
+        """Test an error from the node ends the request without retrying."""
+        now = [0.0]
+        bus = SimulatedBus({})
+        engine = DiscoveryEngine(self.vlcb, bus, read_events=False, clock=lambda: now[0])
+        info = engine.discover_node(300)
+        engine.poll()
+        engine.receive(frame(5, '6F', 1, 44, 1))
+        self.assertTrue(engine.poll())
+        self.assertEqual(info.errors, ["73 error 1"])
+
+    def test_read_nvs(self):
+        """Test node variables are read when enabled."""
+        nodes = make_nodes(5)
+        engine = DiscoveryEngine(self.vlcb, SimulatedBus(nodes), read_nvs=True, qnn_wait=0.01)
+        found = engine.run(timeout=5)
+        for nn, (can_id, parameters, events) in nodes.items():
+            self.assertEqual(found[nn].nvs, {index: index * 3 for index in range(1, parameters[6] + 1)})
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, "nodes.json")
+        self.nodes = make_nodes(20)
+        engine = DiscoveryEngine(self.vlcb, SimulatedBus(self.nodes), read_nvs=True, qnn_wait=0.01)
+        self.found = engine.run(timeout=5)
+        self.found[256].name = "Signals"
+        save_snapshot(self.filename, self.found)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_save_load(self):
+        """Test a snapshot is loaded with the same details."""
+        known = load_snapshot(self.filename)
+        self.assertEqual(sorted(known), sorted(self.found))
+        for nn, info in known.items():
+            original = self.found[nn]
+            self.assertTrue(info.complete)
+            for name in ('can_id', 'manufacturer', 'module', 'flags', 'name', 'parameters',
+                         'num_events', 'event_space', 'events', 'nvs'):
+                self.assertEqual(getattr(info, name), getattr(original, name))
+
+    def test_invalid(self):
+        """Test an invalid snapshot raises ValueError."""
+        with open(self.filename, "w") as f:
+            f.write('{"version": 99, "nodes": []}')
+        with self.assertRaises(ValueError):
+            load_snapshot(self.filename)
+        with open(self.filename, "w") as f:
+            f.write('{"version": 1, "nodes": [{"can_id": 1}]}')
+        with self.assertRaises(ValueError):
+            load_snapshot(self.filename)
+
+    def test_validate(self):
+        """Test unchanged nodes are only validated and changed nodes are read again."""
+        known = load_snapshot(self.filename)
+        # 257 has a new event, 258 has new firmware, 300 is new and 275 has been removed
+        self.nodes[257][2].append((257 << 16) + 99)
+        self.nodes[258][1][7] = 99
+        self.nodes[300] = (50, {index: index for index in range(1, 9)}, [])
+        del self.nodes[275]
+        bus = SimulatedBus(self.nodes)
+        engine = DiscoveryEngine(self.vlcb, bus, read_nvs=True, known=known, qnn_wait=0.01)
+        found = engine.run(timeout=5)
+        self.assertEqual(sorted(found), sorted(self.nodes))
+        self.assertEqual(engine.changed, {257, 258})
+        self.assertEqual(engine.validated, set(self.nodes) - {257, 258, 300})
+        self.assertEqual(found[257].num_events, len(self.nodes[257][2]))
+        self.assertEqual(found[258].parameters[7], 99)
+        self.assertEqual(found[256].name, "Signals")
+        self.assertEqual(found[256].nvs, self.found[256].nvs)
+        self.assertTrue(all(info.complete for info in found.values()))
+        # Validation is 1 QNN + 3 requests for each unchanged node
+        full_requests = sum(1 for packet in bus.sent if packet[13:15] == "00" and packet[7:9] == "73")
+        self.assertEqual(full_requests, 3)
+        self.assertLess(len(bus.sent), 200)
+
+
+    def test_validate_no_reply(self):
+        """Test a node which does not reply to validation is read again."""
+        known = load_snapshot(self.filename)
+        nodes = {nn: self.nodes[nn] for nn in (256, 257, 258)}
+        bus = SimulatedBus(nodes, drop_first=[(257, 0x58)])
+        engine = DiscoveryEngine(self.vlcb, bus, timeout=0.02, retries=0, read_nvs=True,
+                                 known={nn: known[nn] for nn in nodes}, qnn_wait=0.01)
+        found = engine.run(timeout=5)
+        self.assertEqual(engine.validated, {256, 258})
+        self.assertEqual(engine.changed, {257})
+        self.assertTrue(found[257].complete)
+        self.assertEqual(found[257].num_events, len(nodes[257][2]))
+        self.assertEqual(found[257].nvs, self.found[257].nvs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from pyvlcb import VLCB, VLCBDispatcher
+
+class TestVLCBDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        self.dispatcher = VLCBDispatcher()
+        self.received = []
+
+    def handler(self, packet):
+        self.received.append(packet.data)
+
+    def test_dispatch_by_opcode(self):
+        """Test handlers registered by mnemonic, hex string and int."""
+        self.dispatcher.register("PLOC", self.handler)
+        self.dispatcher.register("63", self.handler)
+        self.dispatcher.register(0x90, self.handler)
+        self.assertEqual(self.dispatcher.dispatch(self.vlcb.parse_input(":SB020NE101C0038000000;")), 1)
+        self.assertEqual(self.dispatcher.dispatch(self.vlcb.parse_input(":SB020N63C00302;")), 1)
+        self.assertEqual(self.dispatcher.dispatch(self.vlcb.parse_input(":SB780N9001000002;")), 1)
+        # No handler for ACOF
+        self.assertEqual(self.dispatcher.dispatch(self.vlcb.parse_input(":SB780N9101000002;")), 0)
+        self.assertEqual(self.received, ["E101C0038000000", "63C00302", "9001000002"])
+
+    def test_dispatch_by_node_and_event(self):
+        """Test that node and event handlers only receive matching packets."""
+        node_events = []
+        self.dispatcher.register("ACON", self.handler, node=256, event=2)
+        self.dispatcher.register("ACON", node_events.append, node=256)
+        self.dispatcher.dispatch(self.vlcb.parse_input(":SB780N9001000002;"))
+        self.dispatcher.dispatch(self.vlcb.parse_input(":SB780N9001000003;"))
+        self.dispatcher.dispatch(self.vlcb.parse_input(":SB780N9001010002;"))
+        self.assertEqual(self.received, ["9001000002"])
+        self.assertEqual(len(node_events), 2)
+
+    def test_invalid_registration(self):
+        """Test that node / event handlers are rejected for opcodes without them."""
+        with self.assertRaises(ValueError):
+            self.dispatcher.register("DSPD", self.handler, node=1)
+        with self.assertRaises(ValueError):
+            self.dispatcher.register("PNN", self.handler, node=1, event=1)
+        with self.assertRaises(ValueError):
+            self.dispatcher.register("NOTANOPCODE", self.handler)
+
+    def test_unregister_during_dispatch(self):
+        """Test a handler can remove itself while being dispatched."""
+        def once(packet):
+            self.received.append(packet.data)
+            self.dispatcher.unregister("ACON", once)
+        self.dispatcher.register("ACON", once)
+        self.dispatcher.register("ACON", self.handler)
+        packet = self.vlcb.parse_input(":SB780N9001000002;")
+        self.assertEqual(self.dispatcher.dispatch(packet), 2)
+        self.assertEqual(self.dispatcher.dispatch(packet), 1)
+        self.assertFalse(self.dispatcher.unregister("ACON", once))
+
+
+if __name__ == "__main__":
+    unittest.main()
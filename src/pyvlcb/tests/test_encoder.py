@@ -0,0 +1,87 @@
+import unittest
+from pyvlcb import VLCB, VLCBOpcode
+from pyvlcb.encoder import header_string, command_prefix, frame, frame_bytes
+
+class TestEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+
+    def test_header_string(self):
+        """Test cached headers match the values from make_header."""
+        self.assertEqual(header_string(0b10, 0b11, 60), ":SB780N")
+        self.assertEqual(header_string(0b10, 0b11, 60), self.vlcb.make_header())
+        self.assertEqual(self.vlcb.make_header(opcode='47'), ":S8780N")
+        # Opcode including the mnemonic is still supported
+        self.assertEqual(self.vlcb.make_header(opcode='47 - DSPD'), ":S8780N")
+        self.assertEqual(command_prefix(60, '23'), ":SA780N23")
+        with self.assertRaises(ValueError):
+            command_prefix(60, 'ZZ')
+
+    def test_frames(self):
+        """Test string and bytes frames match the VLCB methods."""
+        self.assertEqual(frame(60, '47', 5, 130), self.vlcb.loco_speeddir(5, 130))
+        self.assertEqual(frame(60, '47', 5, 130), ":S8780N470582;")
+        self.assertEqual(frame_bytes(60, '23', 1), b":SA780N2301;")
+        self.assertEqual(frame_bytes(60, '0D'), self.vlcb.discover().encode('ascii'))
+        with self.assertRaises(ValueError):
+            frame(60, '23', 256)
+        with self.assertRaises(ValueError):
+            frame_bytes(60, '23', -1)
+
+    def test_builders_unchanged(self):
+        """Test command strings are the same as before the encoder was added."""
+        self.assertEqual(self.vlcb.keep_alive(5), ":SA780N2305;")
+        self.assertEqual(self.vlcb.accessory_short_command(256, 2, True), ":SB780N9801000002;")
+        self.assertEqual(self.vlcb.accessory_command(256, "0x10002", "off"), ":SB780N9100010002;")
+        self.assertEqual(self.vlcb.allocate_loco(3), ":SA780N40C003;")
+        self.assertEqual(self.vlcb.discover_nerd(256), ":SB780N570100;")
+
+
+class TestEncodeAllOpcodes(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+
+    def test_round_trip_all_opcodes(self):
+        """Test that every opcode can be encoded and parsed back to the same values."""
+        for code in VLCBOpcode.opcodes:
+            if code == '':
+                continue
+            with self.subTest(opcode=code):
+                fields = {}
+                for index, (name, start, end, field_type) in enumerate(VLCBOpcode.field_layout(code)):
+                    if field_type == 'char':
+                        fields[name] = "A5"
+                    else:
+                        fields[name] = (index * 37 + end * 11 + 1) % (1 << ((end - start) * 4))
+                packet = self.vlcb.encode(VLCBOpcode.opcodes[code]['opc'], **fields)
+                self.assertEqual(self.vlcb.encode_bytes(code, **fields), packet.encode('ascii'))
+                parsed = self.vlcb.parse_input(packet)
+                self.assertEqual(parsed.opcode(), VLCBOpcode.opcodes[code]['opc'])
+                data = VLCBOpcode.parse_data(parsed.data)
+                self.assertNotIn("ExtraData", data)
+                for name, value in fields.items():
+                    self.assertEqual(data[name], value)
+
+    def test_matches_builders(self):
+        """Test the generic encoder creates the same packets as the specific methods."""
+        self.assertEqual(self.vlcb.encode('DSPD', Session=5, SpeedDir=130), self.vlcb.loco_speeddir(5, 130))
+        self.assertEqual(self.vlcb.encode('ASON', NN=256, DNHigh_DNLow=2), self.vlcb.accessory_short_command(256, 2, True))
+        self.assertEqual(self.vlcb.encode(0x0D), self.vlcb.discover())
+        self.assertEqual(self.vlcb.encode('NAME', Char1_7="CANPAN"), ":SB780NE243414E50414E20;")
+
+    def test_invalid_fields(self):
+        """Test missing, extra and out of range fields."""
+        with self.assertRaises(ValueError):
+            self.vlcb.encode('DSPD', Session=256, SpeedDir=0)
+        with self.assertRaises(ValueError):
+            self.vlcb.encode('NOTANOPCODE')
+        with self.assertRaises(TypeError):
+            self.vlcb.encode('DSPD', Session=1)
+        with self.assertRaises(TypeError):
+            self.vlcb.encode('DSPD', Session=1, SpeedDir=0, NN=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
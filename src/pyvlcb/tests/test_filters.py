@@ -0,0 +1,57 @@
+import unittest
+from pyvlcb import VLCB, VLCBOpcode, compile_filter
+
+class TestVLCBFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+
+    def test_accessory_filter(self):
+        """Test a filter using opcode mnemonics, node and event numbers."""
+        accessory = compile_filter("opc in (ACON, ACOF) and NN == 256 and EN > 100")
+        self.assertTrue(accessory(":SB780N9001000065;"))
+        self.assertTrue(accessory(":SB780N9101000FFF;"))
+        # Event number too low
+        self.assertFalse(accessory(":SB780N9001000064;"))
+        # Different node
+        self.assertFalse(accessory(":SB780N9001010065;"))
+        # ASON has no EnHigh_EnLow field
+        self.assertFalse(accessory(":SB780N9801000065;"))
+
+    def test_packet_and_record(self):
+        """Test that packets and decoded records give the same result as raw frames."""
+        can_filter = compile_filter("can_id == 60 and not opc == DKEEP")
+        packet = self.vlcb.parse_input(":SB780N9001000002;")
+        self.assertTrue(can_filter(packet))
+        self.assertFalse(can_filter(self.vlcb.parse_input(":SB780N2301;")))
+        self.assertFalse(can_filter(self.vlcb.parse_input(":SB020N9001000002;")))
+        # Records from parse_data only have can_id if it is added
+        record = VLCBOpcode.parse_data("9001000002")
+        self.assertFalse(can_filter(record))
+        record['can_id'] = 60
+        self.assertTrue(can_filter(record))
+
+    def test_cached_record(self):
+        """Test that read only records from the decode cache can be filtered."""
+        accessory = compile_filter("opc == ACON and NN == 256")
+        cached = VLCB(can_id=60, cache_size=16)
+        self.assertTrue(accessory(cached.cache.parse_data("9001000002")))
+        self.assertFalse(accessory(cached.cache.parse_data("9101000002")))
+
+    def test_missing_and_insufficient_data(self):
+        """Test that comparisons against fields which are not present are False."""
+        err_filter = compile_filter("opc == ERR and ErrCode != 2")
+        self.assertTrue(err_filter(":SB020N63C00301;"))
+        self.assertFalse(err_filter(":SB020N63C00302;"))
+        self.assertFalse(err_filter(":SB020N63C003;"))
+        self.assertFalse(err_filter(VLCBOpcode.parse_data("63C003")))
+
+    def test_invalid_expressions(self):
+        """Test that invalid expressions raise ValueError."""
+        for expression in ["NN ==", "opc == NOTANOPCODE", "NN = 1", "256 == 256", "(NN == 1", "NN in (Session)"]:
+            with self.assertRaises(ValueError):
+                compile_filter(expression)
+
+
+if __name__ == "__main__":
+    unittest.main()
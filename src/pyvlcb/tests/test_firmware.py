@@ -0,0 +1,225 @@
+import unittest
+from pyvlcb import VLCB, FirmwareImage, FirmwareUploader, FirmwareUploadGroup
+from pyvlcb.exceptions import InvalidConfigurationError
+from pyvlcb.extended import encode_extended, parse_extended
+from pyvlcb.firmware import (read_intel_hex, ID_CONTROL, ID_DATA, ID_RESPONSE, CMD_RESET,
+                             CMD_RST_CHKSM, CMD_CHK_RUN, STATUS_OK, STATUS_FAILED)
+
+
+def hex_line(address, record_type, data):
+    record = bytes([len(data), address >> 8, address & 0xFF, record_type]) + bytes(data)
+    return ":" + (record + bytes([-sum(record) & 0xFF])).hex().upper()
+
+
+def make_hex(memory, base=0):
+    lines = [hex_line(0, 4, [base >> 24 & 0xFF, base >> 16 & 0xFF])]
+    for address in range(0, len(memory), 16):
+        lines.append(hex_line(address, 0, memory[address:address + 16]))
+    lines.append(hex_line(0, 1, []))
+    return "\n".join(lines)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeBootloader:
+    """Node running the CBUS bootloader (acknowledge mode)"""
+    def __init__(self, nak=(), drop=(), clock=None):
+        self.flash = {}
+        self.address = 0
+        self.checksum = 0
+        self.nak = set(nak)
+        self.drop = set(drop)
+        self.clock = clock
+        self.booted = False
+        self.reset = False
+        self.sent = []
+        self.waiting = []
+
+    def send_data(self, data):
+        self.sent.append(data)
+        if data.startswith(":S"):
+            self.booted = int(data[7:9], 16) == 0x5C
+            return
+        frame = parse_extended(data)
+        if frame.identifier == ID_CONTROL:
+            self.address = frame.data[0] | frame.data[1] << 8 | frame.data[2] << 16
+            command = frame.data[5]
+            if command == CMD_RST_CHKSM:
+                self.checksum = 0
+            elif command == CMD_CHK_RUN:
+                ok = (self.checksum + frame.data[6] + (frame.data[7] << 8)) & 0xFFFF == 0
+                self.respond(1 if ok else 0)
+            elif command == CMD_RESET:
+                self.reset = True
+        elif frame.identifier == ID_DATA:
+            if self.address in self.drop:
+                self.drop.discard(self.address)
+                return
+            self.checksum += sum(frame.data)
+            if self.address in self.nak:
+                self.nak.discard(self.address)
+                self.respond(0)
+            else:
+                for offset, value in enumerate(frame.data):
+                    self.flash[self.address + offset] = value
+                self.respond(1)
+            self.address += 8
+
+    def respond(self, value):
+        self.waiting.append(encode_extended(ID_RESPONSE, [value]))
+
+    def read_data(self):
+        packets, self.waiting = self.waiting, []
+        if self.clock is not None:
+            self.clock.now += 0.001
+        return packets
+
+
+class TestExtendedFrames(unittest.TestCase):
+
+    def test_encode_parse(self):
+        """Test the CANUSB4 header registers for extended identifiers."""
+        self.assertEqual(encode_extended(ID_CONTROL, [0x0D]), ":X00080004N0D;")
+        self.assertEqual(encode_extended(ID_RESPONSE, [1]), ":X80080004N01;")
+        for identifier in (0, 5, 0x3FFFF, 0x40000, 0x10000004, 0x1FFFFFFF):
+            frame = parse_extended(encode_extended(identifier, b"\x01\x02"))
+            self.assertEqual((frame.identifier, frame.data, frame.rtr), (identifier, b"\x01\x02", False))
+        self.assertEqual(VLCB().parse_extended(b":X00080005N0102030405060708;").data, bytes(range(1, 9)))
+        for invalid in (":XINVALID;", ":X00080004N0;", ":S0080N01;", ":X00080004N" + "00" * 9 + ";"):
+            with self.assertRaises(ValueError):
+                parse_extended(invalid)
+        with self.assertRaises(ValueError):
+            encode_extended(0x20000000)
+        with self.assertRaises(ValueError):
+            VLCB().parse_input(":X00080004N0D;")
+
+    def test_bootm(self):
+        """Test the BOOTM request."""
+        self.assertEqual(VLCB(can_id=60).bootloader_mode(256), ":SB780N5C0100;")
+
+
+class TestIntelHex(unittest.TestCase):
+
+    def test_read(self):
+        """Test data, extended address and end of file records."""
+        memory = read_intel_hex(make_hex(list(range(40)), base=0x10000))
+        self.assertEqual(memory, {0x10000 + address: address for address in range(40)})
+        self.assertEqual(read_intel_hex([hex_line(0x100, 2, [0x10, 0x00]), hex_line(4, 0, [7])]), {0x10004: 7})
+
+    def test_invalid(self):
+        """Test checksum and format errors."""
+        line = hex_line(0, 0, [1, 2, 3])
+        for invalid in (line[:-2] + "00", line[1:], line + "00", ":0G"):
+            with self.assertRaises(ValueError):
+                read_intel_hex(invalid)
+
+    def test_image(self):
+        """Test the bootloader is excluded and whole rows are sent."""
+        memory = {0x10: 1, 0x800: 2, 0x841: 3, 0x300000: 4}
+        image = FirmwareImage(memory)
+        self.assertEqual([address for address, data in image.frames], list(range(0x800, 0x880, 8)))
+        self.assertEqual(image.frames[0][1], b"\x02" + b"\xff" * 7)
+        self.assertEqual(image.frames[8][1], b"\xff\x03" + b"\xff" * 6)
+        self.assertEqual(image.size, 128)
+
+
+class TestFirmwareUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        self.memory = {0x800 + offset: (offset * 13) & 0xFF for offset in range(1000)}
+        self.image = FirmwareImage(self.memory)
+        self.clock = FakeClock()
+
+    def upload(self, bus, **kwargs):
+        uploader = FirmwareUploader(self.vlcb, bus, 256, self.image, clock=self.clock, **kwargs)
+        self.assertTrue(uploader.run(timeout=60, interval=0) or uploader.status == STATUS_FAILED)
+        return uploader
+
+    def check_flash(self, bus):
+        for address, data in self.image.frames:
+            self.assertEqual(bytes(bus.flash[address + offset] for offset in range(8)), data)
+
+    def test_upload(self):
+        """Test the image is written with a window of frames and the checksum checked."""
+        bus = FakeBootloader(clock=self.clock)
+        progress = []
+        uploader = self.upload(bus, progress=lambda up: progress.append(up.acknowledged))
+        self.assertEqual(uploader.status, STATUS_OK)
+        self.assertTrue(bus.booted and bus.reset)
+        self.check_flash(bus)
+        self.assertEqual(uploader.frames_sent, len(self.image.frames))
+        self.assertEqual(uploader.frames_resent, 0)
+        self.assertEqual(progress[:3], [1, 2, 3])
+        # Reset checksum, set the address once, check and reset
+        controls = [packet for packet in bus.sent if packet.startswith(":X00080004")]
+        self.assertEqual(len(controls), 4)
+        stats = uploader.stats()
+        self.assertEqual(stats['acknowledged'], self.image.size)
+        self.assertGreater(stats['throughput'], 0)
+
+    def test_nak(self):
+        """Test data is sent again from the frame with the error."""
+        bus = FakeBootloader(nak=(0x900, 0xA08), clock=self.clock)
+        uploader = self.upload(bus)
+        self.assertEqual(uploader.status, STATUS_OK)
+        self.check_flash(bus)
+        self.assertEqual(uploader.naks, 2)
+        self.assertEqual(uploader.attempts, 1)
+        self.assertGreater(uploader.frames_resent, 0)
+
+    def test_lost_frame(self):
+        """Test a lost frame times out and then fails the checksum so the image is sent again."""
+        bus = FakeBootloader(drop=(0x900,), clock=self.clock)
+        uploader = self.upload(bus)
+        self.assertEqual(uploader.status, STATUS_OK)
+        self.check_flash(bus)
+        self.assertGreaterEqual(uploader.timeouts, 1)
+        self.assertEqual(uploader.attempts, 2)
+
+    def test_no_bootloader(self):
+        """Test the upload fails if the node does not respond."""
+        bus = FakeBootloader(clock=self.clock)
+        bus.respond = lambda value: None
+        uploader = self.upload(bus, retries=1)
+        self.assertEqual(uploader.status, STATUS_FAILED)
+        self.assertIn("No response", uploader.error)
+
+    def test_invalid(self):
+        """Test an empty image or window is rejected."""
+        with self.assertRaises(InvalidConfigurationError):
+            FirmwareUploader(self.vlcb, FakeBootloader(), 256, FirmwareImage({0x10: 1}))
+        with self.assertRaises(InvalidConfigurationError):
+            FirmwareUploader(self.vlcb, FakeBootloader(), 256, self.image, window=0)
+
+    def test_group(self):
+        """Test uploads on different buses run together and on the same bus one after another."""
+        bus1 = FakeBootloader(clock=self.clock)
+        bus2 = FakeBootloader()
+        group = FirmwareUploadGroup(clock=self.clock)
+        first = group.add(FirmwareUploader(self.vlcb, bus1, 256, self.image, clock=self.clock))
+        second = group.add(FirmwareUploader(self.vlcb, bus1, 257, self.image, clock=self.clock))
+        other = group.add(FirmwareUploader(self.vlcb, bus2, 258, self.image, clock=self.clock))
+        with self.assertRaises(InvalidConfigurationError):
+            group.add(FirmwareUploader(self.vlcb, bus1, 257, self.image, clock=self.clock))
+        group.poll()
+        self.assertEqual(group.active(), [first, other])
+        self.assertEqual([packet for packet in bus1.sent if packet.startswith(":S")], [":SB780N5C0100;"])
+        self.assertTrue(group.run(timeout=60, interval=0))
+        self.assertTrue(all(uploader.status == STATUS_OK for uploader in (first, second, other)))
+        bootm = [packet for packet in bus1.sent if packet.startswith(":S")]
+        self.assertEqual(bootm, [":SB780N5C0100;", ":SB780N5C0101;"])
+        self.check_flash(bus2)
+        stats = group.stats()
+        self.assertEqual((stats['total'], stats['completed'], stats['failed']), (3, 3, 0))
+        self.assertEqual(stats['bytes'], 3 * self.image.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
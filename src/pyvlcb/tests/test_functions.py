@@ -0,0 +1,60 @@
+import unittest
+from pyvlcb import VLCB, LocoFunctions
+from pyvlcb.utils import f_to_bytes, bytes_to_functions
+
+class TestLocoFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+
+    def test_set_clear_toggle(self):
+        """Test single function changes."""
+        functions = LocoFunctions()
+        functions.set(0)
+        functions.set(28)
+        functions[3] = 1
+        self.assertEqual(functions.mask, (1 << 0) | (1 << 3) | (1 << 28))
+        functions.clear(28)
+        self.assertEqual(functions.toggle(3), 0)
+        self.assertEqual(functions.toggle(40), 1)
+        self.assertEqual(functions.get(0), 1)
+        self.assertEqual(functions[40], 1)
+        with self.assertRaises(ValueError):
+            functions.set(256)
+
+    def test_dfun_bytes_match_f_to_bytes(self):
+        """Test DFUN bytes are the same as f_to_bytes for all groups."""
+        status = [1, 1, 0, 0, 1, 0, 1, 1, 0, 0, 1, 1, 1, 0, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1]
+        functions = LocoFunctions.from_list(status)
+        for f_num in range(0, 29):
+            group, byte2 = functions.dfun_bytes(f_num)
+            self.assertEqual((f"{group:02x}", f"{byte2:02x}"), f_to_bytes(f_num, status))
+        self.assertEqual(functions.all_dfun_bytes(), [(1, 0x19), (2, 0x06), (3, 0x0E), (4, 0x82), (5, 0x81)])
+        self.assertEqual(functions.to_list(), status)
+
+    def test_ploc(self):
+        """Test decoding a PLOC into the mask."""
+        # Session 1, loco 3 (long), F0 and F1 on, F6 on, F12 on
+        packet = self.vlcb.parse_input(":SB020NE101C00380110208;")
+        functions = packet.get_functions()
+        self.assertEqual(functions.to_list(13), [1, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1])
+        self.assertEqual(functions.to_list(), packet.get_function_list())
+        self.assertEqual(bytes_to_functions(0x10, 0, 0)[0], 1)
+        # Functions above F12 are kept when updated from PLOC
+        functions.set(20)
+        functions.update_from_ploc(0, 0, 0)
+        self.assertEqual(functions, LocoFunctions(1 << 20))
+
+    def test_commands(self):
+        """Test DFUN for F0 to F28 and DFNON / DFNOF above."""
+        functions = LocoFunctions()
+        functions.set(1)
+        functions.set(29)
+        self.assertEqual(functions.command(self.vlcb, 1, 1), self.vlcb.loco_set_dfun(1, 1, 1))
+        self.assertEqual(functions.command(self.vlcb, 1, 29), ":SA780N49011D;")
+        functions.clear(29)
+        self.assertEqual(functions.command(self.vlcb, 1, 29), ":SA780N4A011D;")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+from pyvlcb import LatencyTracker
+from pyvlcb.latency import LatencyHistogram
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        """Test percentiles are within one bucket of the actual value."""
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.add(ms / 1000)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['max'], 0.1)
+        self.assertTrue(0.050 <= summary['p50'] <= 0.050 * 1.19)
+        self.assertTrue(0.099 <= summary['p99'] <= 0.1)
+        self.assertEqual(LatencyHistogram().percentile(50), 0.0)
+
+
+class TestLatencyTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.tracker = LatencyTracker(timeout=5, clock=lambda: self.now)
+
+    def send(self, packet, delay=0.0):
+        self.now += delay
+        self.tracker.record("TX", packet)
+
+    def test_node_requests(self):
+        """Test RQNPN and NVRD are matched to the response from the same node."""
+        self.send(":SB780N7301000A;")
+        self.send(":SB780N71010005;")
+        self.send(":SB780N71020005;")
+        self.send(":SB020N97010005FF;", 0.02)
+        self.send(":SB020N9B01000A03;", 0.01)
+        summary = self.tracker.summary()
+        self.assertAlmostEqual(summary[('NVRD', 'node', 256)]['max'], 0.02)
+        self.assertAlmostEqual(summary[('RQNPN', 'node', 256)]['max'], 0.03)
+        self.assertNotIn(('NVRD', 'node', 512), summary)
+        # Unanswered request becomes a timeout
+        self.send(":SB780N2301;", 10)
+        self.assertEqual(self.tracker.timeouts, {('NVRD', 'node', 512): 1})
+
+    def test_loco_and_qnn(self):
+        """Test RLOC is matched to PLOC or ERR and each PNN is timed from QNN."""
+        self.send(":SA780N40C0C8;")
+        self.send(":SA020NE101C0C8000000;", 0.05)
+        self.send(":SA780N400003;")
+        self.send(":SA020N63000302;", 0.01)
+        self.send(":SB780N0D;")
+        self.send(":SB020NB60100A50A07;", 0.1)
+        self.send(":SB040NB60200A50A07;", 0.1)
+        self.send(":SB040NB60200A50A07;", 0.1)
+        summary = self.tracker.summary()
+        self.assertAlmostEqual(summary[('RLOC', 'address', 200)]['max'], 0.05)
+        self.assertEqual(summary[('RLOC', 'address', 3)]['count'], 1)
+        self.assertAlmostEqual(summary[('QNN', 'node', 256)]['max'], 0.1)
+        self.assertAlmostEqual(summary[('QNN', 'node', 512)]['max'], 0.2)
+        self.assertEqual(summary[('QNN', 'node', 512)]['count'], 1)
+
+    def test_prometheus(self):
+        """Test the export format and writing to a file and HTTP."""
+        self.send(":SB780N71010005;")
+        self.send(":SB020N97010005FF;", 0.02)
+        text = self.tracker.prometheus_text()
+        self.assertIn('# TYPE vlcb_request_latency_seconds histogram', text)
+        self.assertIn('vlcb_request_latency_seconds_bucket{request="NVRD",node="256",le="+Inf"} 1', text)
+        self.assertIn('vlcb_request_latency_seconds_count{request="NVRD",node="256"} 1', text)
+        self.assertIn('vlcb_request_latency_seconds_quantile{request="NVRD",node="256",quantile="1"} 0.02', text)
+        fd, filename = tempfile.mkstemp(suffix=".prom")
+        os.close(fd)
+        try:
+            self.tracker.write_prometheus(filename)
+            with open(filename) as f:
+                self.assertEqual(f.read(), text)
+        finally:
+            os.remove(filename)
+        server = self.tracker.serve_prometheus(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                self.assertEqual(response.read().decode('utf-8'), text)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from pyvlcb import VLCB
+from pyvlcb.logs import iter_log, analyse_log, split_file, OUTPUT_RECORDS
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        messages = [":SB780N2301;", ":SB020N9001000002;", ":SB020NE101C00380110208;", ":S8780N470582;"]
+        self.lines = [f"{num},2026-10-19 14:02:{num % 60:02d}.000,RX,{messages[num % 4]}" for num in range(200)]
+        fd, self.filename = tempfile.mkstemp(suffix=".log")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(self.lines) + "\n")
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_rows_match_log_entry(self):
+        """Test streamed rows are the same as VLCB.log_entry."""
+        rows = list(iter_log(self.filename, chunk_size=100))
+        self.assertEqual(rows, [self.vlcb.log_entry(line) for line in self.lines])
+
+    def test_records(self):
+        """Test structured records include the decoded fields."""
+        records = list(iter_log(self.filename, OUTPUT_RECORDS))
+        self.assertEqual(len(records), 200)
+        self.assertEqual(records[1]['num'], "1")
+        self.assertEqual(records[1]['opcode'], "ACON")
+        self.assertEqual(records[1]['NN'], 256)
+        self.assertEqual(records[1]['can_id'], 1)
+
+    def test_invalid_line(self):
+        """Test that an invalid packet does not stop the analysis."""
+        with open(self.filename, "a") as f:
+            f.write("200,2026-10-19 14:03:00.000,RX,:XINVALID;\n")
+        rows = list(iter_log(self.filename))
+        self.assertEqual(rows[-1][-1], "Invalid data")
+        records = list(iter_log(self.filename, OUTPUT_RECORDS))
+        self.assertIn("error", records[-1])
+
+    def test_split_and_multiple_processes(self):
+        """Test the file is split on line boundaries and results are in order."""
+        segments = split_file(self.filename, 1000)
+        self.assertGreater(len(segments), 2)
+        self.assertEqual(segments[0][0], 0)
+        self.assertEqual(segments[-1][1], os.path.getsize(self.filename))
+        serial = list(iter_log(self.filename))
+        parallel = list(analyse_log(self.filename, processes=2, segment_size=1000))
+        self.assertEqual(parallel, serial)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from pyvlcb import BusMonitor
+from pyvlcb.monitor import frame_bits
+
+class TestBusMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.5
+        self.monitor = BusMonitor(clock=lambda: self.now)
+
+    def test_frame_bits(self):
+        """Test frame lengths including framing and stuff bits."""
+        self.assertEqual(frame_bits(0, stuffing=0), 47)
+        self.assertEqual(frame_bits(8, stuffing=0), 111)
+        self.assertEqual(frame_bits(8), 111 + 24)
+        self.assertEqual(frame_bits(8, extended=True, stuffing=0), 131)
+
+    def test_load(self):
+        """Test load is calculated from the bits used."""
+        monitor = BusMonitor(bit_rate=1000, stuffing=0, clock=lambda: self.now)
+        for _ in range(10):
+            monitor.add(":SB780N2301;")
+        # Only completed seconds are included
+        self.assertEqual(monitor.load(1), 0)
+        self.now += 1
+        # 10 frames of 2 bytes = 63 bits each
+        self.assertAlmostEqual(monitor.load(1), 0.63)
+        self.assertAlmostEqual(monitor.load(10), 0.063)
+
+    def test_saturated_early_in_second(self):
+        """Test load early in a second reflects the previous full second."""
+        monitor = BusMonitor(bit_rate=6300, stuffing=0, clock=lambda: self.now)
+        for second in range(5):
+            for _ in range(100):
+                monitor.add(":SB780N2301;", 1000.0 + second)
+        self.now = 1004.01
+        monitor.add(":SB780N2301;")
+        self.assertAlmostEqual(monitor.load(1), 1.0)
+        self.assertAlmostEqual(monitor.load(4), 1.0)
+
+    def test_windows(self):
+        """Test frames drop out of the window as time passes."""
+        for second in range(100):
+            self.now = 1000.0 + second
+            self.monitor.add(":SB780N2301;")
+            self.monitor.add(":SB020N9002000002;")
+        self.assertEqual(self.monitor.frame_rate(1), 2)
+        self.assertEqual(self.monitor.frame_rate(10), 2)
+        self.assertEqual(self.monitor.opcode_counts(10), {'DKEEP': 10, 'ACON': 10})
+        self.assertEqual(self.monitor.total_frames, 200)
+        self.now += 30
+        self.assertEqual(self.monitor.frame_rate(10), 0)
+        self.assertAlmostEqual(self.monitor.frame_rate(60), 62 / 60)
+        with self.assertRaises(ValueError):
+            self.monitor.load(61)
+
+    def test_top_talkers(self):
+        """Test CAN IDs are listed by frame rate."""
+        for _ in range(5):
+            self.monitor.record("RX", ":SB780N2301;")
+        for _ in range(3):
+            self.monitor.record("RX", b":SB020N9002000002;")
+        self.monitor.record("RX", ":SB040N9002000002;")
+        self.monitor.record("RX", ":XINVALID;")
+        self.now += 1
+        self.assertEqual(self.monitor.top_talkers(1, 2), [(60, 5.0), (1, 3.0)])
+        summary = self.monitor.summary()
+        self.assertEqual(summary[1]['frame_rate'], 9)
+        self.monitor.reset()
+        self.assertEqual(self.monitor.frame_rate(60), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
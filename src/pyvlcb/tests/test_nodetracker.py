@@ -0,0 +1,139 @@
+import unittest
+from pyvlcb import VLCB, NodeChangeTracker
+from pyvlcb.discovery import NodeInfo
+from pyvlcb.encoder import frame
+
+class FakeNodes:
+    """Nodes which reply to the requests sent by the tracker"""
+    def __init__(self):
+        # node : [can_id, parameters, events]
+        self.nodes = {}
+        self.waiting = []
+        self.sent = []
+
+    def send_data(self, data):
+        self.sent.append(data)
+        opcode = int(data[7:9], 16)
+        nn = int(data[9:13], 16)
+        if nn not in self.nodes:
+            return
+        can_id, parameters, events = self.nodes[nn]
+        node_bytes = (nn >> 8, nn & 0xFF)
+        if opcode == 0x73:
+            index = int(data[13:15], 16)
+            value = len(parameters) if index == 0 else parameters[index]
+            self.waiting.append(frame(can_id, '9B', *node_bytes, index, value))
+        elif opcode == 0x58:
+            self.waiting.append(frame(can_id, '74', *node_bytes, len(events)))
+        elif opcode == 0x56:
+            self.waiting.append(frame(can_id, '70', *node_bytes, 32 - len(events)))
+        elif opcode == 0x57:
+            for index, event in enumerate(events, 1):
+                self.waiting.append(frame(can_id, 'F2', *node_bytes, *event.to_bytes(4, 'big'), index))
+
+
+def node_info(nn, can_id, parameters, events):
+    info = NodeInfo(nn, can_id, parameters[1], parameters[3], parameters[8])
+    info.parameters = {**parameters, 0: len(parameters)}
+    info.num_events = len(events)
+    info.event_space = 32 - len(events)
+    info.events = {index: event for index, event in enumerate(events, 1)}
+    info.complete = True
+    return info
+
+
+class TestNodeChangeTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.bus = FakeNodes()
+        for nn in (256, 257, 258):
+            self.bus.nodes[nn] = [nn - 250, {index: index + nn % 5 for index in range(1, 9)}, [(nn << 16) + 1]]
+        nodes = {nn: node_info(nn, *details) for nn, details in self.bus.nodes.items()}
+        self.tracker = NodeChangeTracker(VLCB(), self.bus, nodes=nodes, settle=1, interval=0.5,
+                                         timeout=0.5, retries=1, clock=lambda: self.now)
+        self.updates = []
+        self.tracker.add_listener(lambda nn, info: self.updates.append((nn, info)))
+
+    def run_for(self, seconds):
+        end = self.now + seconds
+        while self.now < end:
+            waiting, self.bus.waiting = self.bus.waiting, []
+            for packet in waiting:
+                self.tracker.record("RX", packet)
+            self.tracker.poll()
+            self.now += 0.05
+
+    def test_no_changes(self):
+        """Test nothing is sent without a change."""
+        self.run_for(5)
+        self.assertEqual(self.bus.sent, [])
+        self.assertEqual(sorted(self.tracker.nodes()), [256, 257, 258])
+
+    def test_write_ack(self):
+        """Test only the node which sent WRACK is read again after the settle time."""
+        self.bus.nodes[257][2].append((257 << 16) + 2)
+        for count in range(5):
+            self.tracker.record("RX", frame(7, '59', 1, 1))
+            self.run_for(0.2)
+        self.assertEqual(self.bus.sent, [])
+        self.assertEqual(self.tracker.dirty(), {257})
+        self.run_for(2)
+        self.assertEqual(self.tracker.dirty(), set())
+        self.assertTrue(all(int(packet[9:13], 16) == 257 for packet in self.bus.sent))
+        self.assertEqual(self.tracker.node(257).num_events, 2)
+        self.assertEqual(self.tracker.node(257).events[2], (257 << 16) + 2)
+        self.assertEqual(self.tracker.node(257).module, self.bus.nodes[257][1][3])
+        self.assertEqual(self.tracker.refreshes, 1)
+        self.assertEqual([nn for nn, info in self.updates], [257])
+
+    def test_learn_mode(self):
+        """Test a node in learn mode is read after it leaves learn mode."""
+        self.tracker.record("TX", frame(60, '53', 1, 2))
+        self.tracker.record("RX", frame(8, '59', 1, 2))
+        self.run_for(3)
+        self.assertEqual(self.bus.sent, [])
+        self.tracker.record("TX", frame(60, '54', 1, 2))
+        self.run_for(3)
+        self.assertEqual(self.tracker.refreshes, 1)
+        self.assertTrue(self.bus.sent)
+
+    def test_new_and_released(self):
+        """Test a new node is added and a released node is removed."""
+        self.bus.nodes[300] = [40, {index: index for index in range(1, 9)}, []]
+        self.tracker.record("RX", frame(40, 'B6', 1, 44, 1, 3, 8))
+        self.tracker.record("RX", frame(6, '51', 1, 0))
+        self.assertIsNone(self.tracker.node(256))
+        self.run_for(3)
+        info = self.tracker.node(300)
+        self.assertEqual(info.can_id, 40)
+        self.assertEqual(info.module, 3)
+        self.assertEqual(info.parameters[5], 5)
+        self.assertEqual(sorted(self.tracker.nodes()), [257, 258, 300])
+        self.assertEqual([nn for nn, info in self.updates], [256, 300])
+        # Same PNN again does not cause another read
+        self.tracker.record("RX", frame(40, 'B6', 1, 44, 1, 3, 8))
+        self.tracker.record("RX", frame(7, 'B6', 1, 1, 3, 5, 10))
+        self.assertEqual(self.tracker.dirty(), set())
+
+    def test_grsp(self):
+        """Test only successful GRSP for a change marks the node dirty."""
+        self.tracker.record("RX", frame(6, 'AF', 1, 0, 0x73, 0, 5))
+        self.tracker.record("RX", frame(6, 'AF', 1, 0, 0x57, 0, 0))
+        self.assertEqual(self.tracker.dirty(), set())
+        self.tracker.record("RX", frame(6, 'AF', 1, 0, 0xD2, 0, 0))
+        self.assertEqual(self.tracker.dirty(), {256})
+
+    def test_no_reply(self):
+        """Test the cached details are kept if the node does not reply."""
+        old = self.tracker.node(258)
+        del self.bus.nodes[258]
+        self.tracker.mark_dirty(258)
+        self.run_for(10)
+        self.assertIs(self.tracker.node(258), old)
+        self.assertEqual(self.tracker.dirty(), set())
+        self.assertEqual(self.updates, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
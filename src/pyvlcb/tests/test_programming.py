@@ -0,0 +1,164 @@
+import unittest
+from pyvlcb import VLCB, ProgrammingEngine
+from pyvlcb.encoder import frame
+
+class FakeModules:
+    """Nodes which store NVs and events and acknowledge the writes
+
+    Replies are returned by read_data so several writes can be in progress.
+    """
+    def __init__(self, nodes, acks=("WRACK",), max_nv=16):
+        self.nodes = {nn: {'nvs': {}, 'events': {}} for nn in nodes}
+        self.acks = acks
+        self.max_nv = max_nv
+        self.learning = set()
+        self.waiting = []
+        self.sent = []
+        self.max_inflight = 0
+        self.drop = set()
+        self.max_waiting = 0
+
+    def reply(self, nn, opcode, error=0):
+        node_bytes = (nn >> 8, nn & 0xFF)
+        if error and "GRSP" not in self.acks:
+            self.waiting.append(frame(5, '6F', *node_bytes, error))
+            return
+        if not error and "WRACK" in self.acks:
+            self.waiting.append(frame(5, '59', *node_bytes))
+        if "GRSP" in self.acks:
+            self.waiting.append(frame(5, 'AF', *node_bytes, opcode, 0, error))
+
+    def send_data(self, data):
+        self.sent.append(data)
+        self.max_waiting = max(self.max_waiting, len(self.waiting))
+        if data in self.drop:
+            self.drop.discard(data)
+            return
+        opcode = int(data[7:9], 16)
+        nn = int(data[9:13], 16)
+        if opcode == 0x53:
+            self.learning.add(nn)
+        elif opcode == 0x54:
+            self.learning.discard(nn)
+        elif opcode == 0x96 and nn in self.nodes:
+            index, value = int(data[13:15], 16), int(data[15:17], 16)
+            if index > self.max_nv:
+                self.reply(nn, opcode, 0x0A)
+            else:
+                self.nodes[nn]['nvs'][index] = value
+                self.reply(nn, opcode)
+        elif opcode == 0xD2:
+            event = int(data[9:17], 16)
+            index, value = int(data[17:19], 16), int(data[19:21], 16)
+            for learn_nn in self.learning:
+                self.nodes[learn_nn]['events'].setdefault(event, {})[index] = value
+                self.reply(learn_nn, opcode)
+
+    def read_data(self):
+        packets, self.waiting = self.waiting, []
+        return packets
+
+
+class TestProgrammingEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+
+    def test_builders(self):
+        """Test the NVSET, EVLRN and learn mode requests."""
+        self.assertEqual(self.vlcb.set_nv(256, 1, 5), ":SB780N9601000105;")
+        self.assertEqual(self.vlcb.learn_event(0x01000005, 1, 2), ":SB780ND2010000050102;")
+        self.assertEqual(self.vlcb.node_learn(256), ":SB780N530100;")
+        self.assertEqual(self.vlcb.node_unlearn(256), ":SB780N540100;")
+        with self.assertRaises(ValueError):
+            self.vlcb.set_nv(256, 1, 256)
+        with self.assertRaises(ValueError):
+            self.vlcb.learn_event(0x100000000, 1, 1)
+
+    def program(self, bus, **kwargs):
+        engine = ProgrammingEngine(self.vlcb, bus, timeout=0.05, **kwargs)
+        engine.add_config(256, nvs={index: index * 2 for index in range(1, 11)},
+                          events={0x01010001: [1, 2], 0x01010002: {1: 3}})
+        engine.add_config(257, nvs={1: 9, 2: 8}, events={0x01010003: [4]})
+        return engine, engine.run(timeout=5)
+
+    def check_programmed(self, bus, results):
+        self.assertTrue(all(result.ok for result in results), results)
+        self.assertEqual(bus.nodes[256]['nvs'], {index: index * 2 for index in range(1, 11)})
+        self.assertEqual(bus.nodes[256]['events'], {0x01010001: {1: 1, 2: 2}, 0x01010002: {1: 3}})
+        self.assertEqual(bus.nodes[257]['nvs'], {1: 9, 2: 8})
+        self.assertEqual(bus.nodes[257]['events'], {0x01010003: {1: 4}})
+        self.assertEqual(bus.learning, set())
+
+    def test_wrack(self):
+        """Test writes to nodes acknowledged with WRACK."""
+        bus = FakeModules([256, 257])
+        engine, results = self.program(bus)
+        self.check_programmed(bus, results)
+        self.assertEqual(len(results), 16)
+        self.assertTrue(all(result.attempts == 1 and result.acknowledged_by == "WRACK" for result in results))
+        # Several writes were in progress at once
+        self.assertGreater(bus.max_waiting, 1)
+        self.assertLessEqual(bus.max_waiting, 8)
+
+    def test_wrack_and_grsp(self):
+        """Test nodes which send both WRACK and GRSP for each write."""
+        for acks in (("GRSP",), ("WRACK", "GRSP")):
+            bus = FakeModules([256, 257], acks=acks)
+            engine, results = self.program(bus)
+            self.check_programmed(bus, results)
+            self.assertTrue(all(result.attempts == 1 for result in results))
+
+    def test_error(self):
+        """Test errors are decoded and not sent again."""
+        for acks in (("WRACK",), ("GRSP",), ("WRACK", "GRSP")):
+            bus = FakeModules([256], acks=acks, max_nv=2)
+            engine = ProgrammingEngine(self.vlcb, bus, timeout=0.05)
+            results = engine.add_config(256, nvs={1: 1, 3: 3, 2: 2})
+            engine.run(timeout=5)
+            self.assertEqual([result.status for result in results], ["ok", "failed", "ok"])
+            self.assertEqual(results[1].error, "Invalid node variable index")
+            self.assertEqual(results[1].error_code, 0x0A)
+            self.assertEqual(results[1].attempts, 1)
+            self.assertEqual(bus.nodes[256]['nvs'], {1: 1, 2: 2})
+
+    def test_retry(self):
+        """Test a lost write is sent again (with the writes which may have had its acknowledgement)."""
+        for acks in (("WRACK",), ("GRSP",), ("WRACK", "GRSP")):
+            bus = FakeModules([256, 257], acks=acks)
+            bus.drop.add(self.vlcb.set_nv(256, 2, 4))
+            bus.drop.add(self.vlcb.learn_event(0x01010002, 1, 3))
+            engine, results = self.program(bus)
+            self.check_programmed(bus, results)
+            self.assertEqual(max(result.attempts for result in results), 2)
+
+    def test_timeout(self):
+        """Test writes to a missing node time out after the retries."""
+        now = [0.0]
+        bus = FakeModules([])
+        engine = ProgrammingEngine(self.vlcb, bus, timeout=1, retries=1, clock=lambda: now[0])
+        result = engine.add_nv(300, 1, 1)
+        self.assertFalse(engine.poll())
+        now[0] += 1
+        self.assertFalse(engine.poll())
+        now[0] += 1
+        self.assertTrue(engine.poll())
+        self.assertEqual(result.status, "timeout")
+        self.assertEqual(result.attempts, 2)
+
+    def test_single_learn_mode(self):
+        """Test only one node is in learn mode at a time."""
+        bus = FakeModules([256, 257, 258])
+        engine = ProgrammingEngine(self.vlcb, bus, timeout=0.05)
+        for nn in (256, 257, 258):
+            engine.add_event(nn, 0x02000000 + nn, 1, nn & 0xFF)
+        results = engine.run(timeout=5)
+        self.assertTrue(all(result.ok for result in results))
+        for nn in (256, 257, 258):
+            self.assertEqual(bus.nodes[nn]['events'], {0x02000000 + nn: {1: nn & 0xFF}})
+        learn = [packet[7:13] for packet in bus.sent if packet[7:9] in ("53", "54")]
+        self.assertEqual(learn, ["530100", "540100", "530101", "540101", "530102", "540102"])
+
+
+if __name__ == '__main__':
+    unittest.main()
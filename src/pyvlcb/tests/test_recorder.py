@@ -0,0 +1,67 @@
+import io
+import os
+import tempfile
+import unittest
+from pyvlcb import VLCB, FlightRecorder, DIRECTION_RX, DIRECTION_TX
+from pyvlcb.exceptions import MyLibraryError, DeviceConnectionError
+
+class TestFlightRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 1000.0
+        self.recorder = FlightRecorder(size=3, clock=lambda: self.time)
+
+    def tearDown(self):
+        self.recorder.auto_dump(None)
+
+    def test_ring_buffer(self):
+        """Test that only the most recent packets are kept, oldest first."""
+        for session in range(1, 6):
+            self.time += 1
+            self.recorder.record(DIRECTION_TX, f":SB780N230{session};")
+        self.assertEqual(len(self.recorder), 3)
+        self.assertEqual(self.recorder.snapshot(), [
+            (2, 1003.0, DIRECTION_TX, ":SB780N2303;"),
+            (3, 1004.0, DIRECTION_TX, ":SB780N2304;"),
+            (4, 1005.0, DIRECTION_TX, ":SB780N2305;")])
+        self.recorder.clear()
+        self.assertEqual(self.recorder.snapshot(), [])
+
+    def test_dump_log_format(self):
+        """Test that the dump can be read back using VLCB.log_entry."""
+        self.recorder.record(DIRECTION_RX, b":SB020N9001000002;")
+        output = io.StringIO()
+        self.assertEqual(self.recorder.dump(output), 1)
+        entry = VLCB().log_entry(output.getvalue().strip())
+        self.assertEqual(entry[1], DIRECTION_RX)
+        self.assertEqual(entry[2], ":SB020N9001000002;")
+        self.assertEqual(entry[4], "90 - ACON")
+
+    def test_auto_dump(self):
+        """Test that raising a library error dumps the recorder."""
+        output = io.StringIO()
+        self.recorder.auto_dump(output)
+        self.recorder.record(DIRECTION_RX, ":SB020N9001000002;")
+        with self.assertRaises(MyLibraryError):
+            raise DeviceConnectionError("Connection lost")
+        self.assertIn(":SB020N9001000002;", output.getvalue())
+        # No longer dumped once disabled
+        self.recorder.auto_dump(None)
+        self.assertEqual(MyLibraryError.error_hooks, ())
+
+    def test_auto_dump_appends(self):
+        """Test that a later error does not overwrite the dump from the first error."""
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "dump.log")
+            self.recorder.auto_dump(filename)
+            self.recorder.record(DIRECTION_RX, ":SB020N9001000001;")
+            DeviceConnectionError("First")
+            self.recorder.record(DIRECTION_RX, ":SB020N9001000002;")
+            DeviceConnectionError("Second")
+            with open(filename) as f:
+                lines = f.read().splitlines()
+        self.assertEqual([line.split(",")[-1] for line in lines], [":SB020N9001000001;", ":SB020N9001000002;"])
+
+
+if __name__ == "__main__":
+    unittest.main()
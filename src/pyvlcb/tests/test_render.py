@@ -0,0 +1,57 @@
+import unittest
+from pyvlcb import VLCB, VLCBOpcode
+from pyvlcb.render import render_data, render_entry, loco_string
+
+class TestRender(unittest.TestCase):
+
+    def test_field_formats(self):
+        """Test fields use their hex, num and ascii formats."""
+        self.assertEqual(render_data("B60100A50A07"),
+                         ("NN = 256 , ManufId = 0xA5 , ModId = 0x0A , Flags = 0x07", "Response to Query Node"))
+        self.assertEqual(render_data("E241424344454620")[0], "Char1_7 = 'ABCDEF'")
+
+    def test_loco(self):
+        """Test loco addresses are shown in the fields and description."""
+        fields, description = render_data("E101C0C881000000")
+        self.assertEqual(fields, "Session = 0x01 , Loco = 200 (long) , SpeedDir = 0x81 , Fn1 = 0 , Fn2 = 0 , Fn3 = 0")
+        self.assertEqual(description, "Engine Report - loco 200 (long)")
+        self.assertEqual(render_data("400003")[1], "Request engine session - loco 3")
+        self.assertEqual(loco_string(0x0003), "3")
+
+    def test_codes(self):
+        """Test accessory state and error codes are resolved."""
+        self.assertEqual(render_data("9101000002")[0], "State = off , NN = 256 , EnHigh_EnLow = 2")
+        self.assertEqual(render_data("63C0C802"),
+                         ("Byte1 = 0xC0 , Byte2 = 0xC8 , ErrCode = 0x02 (Loco address taken)",
+                          "Command station error report - Loco address taken - loco 200 (long)"))
+        self.assertEqual(render_data("63000103")[1], "Command station error report - Session not present")
+        self.assertEqual(render_data("AF0100960002")[1], "Generic response - Not in learn mode")
+        self.assertEqual(render_data("6F01000A")[1], "Error messages from nodes during configuration - Invalid node variable index")
+
+    def test_short_data(self):
+        """Test data which is too short or too long is still rendered."""
+        self.assertEqual(render_data("47050")[0], "Session = 0x05 , SpeedDir = Insufficient data 0")
+        self.assertEqual(render_data("23010203")[0], "Session = 0x01 , ExtraData = 0203")
+
+    def test_all_opcodes(self):
+        """Test every opcode can be rendered."""
+        for code in VLCBOpcode.opcodes:
+            if code == '':
+                continue
+            with self.subTest(code=code):
+                length = (int(code, 16) >> 5) * 2
+                fields, description = render_data(code + "00" * (length // 2))
+                self.assertTrue(description.startswith(VLCBOpcode.opcodes[code]['title']))
+
+    def test_entry(self):
+        """Test rendered rows have the same columns as log_entry."""
+        vlcb = VLCB()
+        line = "1,2026-10-19 14:00:00.000,RX,:SB020N9001000002;"
+        row = vlcb.render_entry(line)
+        self.assertEqual(row[:5], vlcb.log_entry(line)[:5])
+        self.assertEqual(row[5], "State = on , NN = 256 , EnHigh_EnLow = 2")
+        self.assertEqual(render_entry("2,2026-10-19 14:00:00.000,RX,:XINVALID;")[-1], "Invalid data")
+
+
+if __name__ == '__main__':
+    unittest.main()
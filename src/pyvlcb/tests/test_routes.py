@@ -0,0 +1,49 @@
+import unittest
+from unittest.mock import MagicMock
+from pyvlcb import VLCB, Route, RouteCache
+from pyvlcb.exceptions import InvalidConfigurationError
+
+class TestRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        self.transport = MagicMock()
+
+    def test_route_matches_accessory_command(self):
+        """Test route packets are the same as individual accessory commands."""
+        entries = [(256, "2", "on"), (256, "0x10003", False), (257, 4, True)]
+        route = self.vlcb.accessory_route(entries)
+        self.assertEqual(len(route), 3)
+        self.assertEqual(route.packets, (
+            self.vlcb.accessory_command(256, "2", "on"),
+            self.vlcb.accessory_command(256, "0x10003", False),
+            self.vlcb.accessory_short_command(257, 4, True)))
+        route.send(self.transport)
+        self.transport.send_data.assert_called_once_with("".join(route.packets).encode('ascii'))
+
+    def test_invalid_entries(self):
+        """Test that invalid entries are rejected when the route is created."""
+        for entry in [(256, 2, "maybe"), (256, "abc", "on"), (0x10000, 2, "on"), (256, 2), (256, 2.0, "on"), (256, None, "on")]:
+            with self.assertRaises(InvalidConfigurationError):
+                Route([entry])
+
+    def test_route_cache(self):
+        """Test named routes are reused and updated if the can_id changes."""
+        routes = RouteCache(self.vlcb)
+        routes.add("yard", [(256, 1, "on"), (256, 2, "off")])
+        self.assertIn("yard", routes)
+        first = routes.get("yard")
+        self.assertIs(routes.get("yard"), first)
+        self.vlcb.can_id = 61
+        second = routes.get("yard")
+        self.assertIsNot(second, first)
+        self.assertEqual(second.can_id, 61)
+        routes.send("yard", self.transport)
+        self.transport.send_data.assert_called_once_with(second.payload)
+        routes.remove("yard")
+        with self.assertRaises(KeyError):
+            routes.get("yard")
+
+
+if __name__ == "__main__":
+    unittest.main()
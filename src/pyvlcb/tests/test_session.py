@@ -0,0 +1,83 @@
+import unittest
+from pyvlcb import VLCB, SessionManager
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def send_data(self, data):
+        self.sent.append(data)
+
+
+class TestSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.vlcb = VLCB(can_id=60)
+        self.transport = FakeTransport()
+        self.manager = SessionManager(self.vlcb, self.transport, clock=lambda: self.now)
+
+    def allocate(self, loco_id=3, session=1):
+        self.manager.record("TX", self.vlcb.allocate_loco(loco_id))
+        self.manager.record("RX", f":SA020NE1{session:02X}{0xC000 + loco_id:04X}00000000;")
+
+    def run_for(self, seconds, command=None, every=0.1):
+        # Poll every tick, optionally sending a command each time
+        for _ in range(round(seconds / every)):
+            self.now += every
+            if command is not None:
+                self.manager.record("TX", command)
+            self.manager.poll()
+
+    def test_allocated_from_ploc(self):
+        """Test sessions are tracked only for locos requested by this controller."""
+        self.allocate(3, 1)
+        self.manager.record("RX", ":SA020NE102C00400000000;")
+        self.assertEqual(list(self.manager.sessions), [1])
+        self.assertEqual(self.manager.sessions[1].address, 3)
+
+    def test_keep_alive_when_idle(self):
+        """Test a keep alive is sent every interval when no commands are sent."""
+        self.allocate()
+        self.run_for(6.95)
+        self.assertEqual(self.transport.sent, [self.vlcb.keep_alive(1)] * 3)
+
+    def test_no_keep_alive_when_active(self):
+        """Test other commands to the session replace the keep alive."""
+        self.allocate()
+        self.run_for(10, self.vlcb.loco_speeddir(1, 50))
+        self.assertEqual(self.transport.sent, [])
+        self.run_for(2.25)
+        self.assertEqual(self.transport.sent, [self.vlcb.keep_alive(1)])
+
+    def test_release(self):
+        """Test KLOC and ERR remove the session."""
+        self.allocate(3, 1)
+        self.allocate(4, 2)
+        self.manager.record("TX", self.vlcb.release_loco(1))
+        self.manager.record("RX", ":SA020N63020008;")
+        self.assertEqual(self.manager.sessions, {})
+        self.run_for(3)
+        self.assertEqual(self.transport.sent, [])
+
+    def test_near_timeout(self):
+        """Test a late keep alive is reported."""
+        reports = []
+        self.manager.on_near_timeout = lambda session, gap: reports.append((session.session, round(gap, 1)))
+        self.allocate()
+        self.now += 3.5
+        self.assertEqual(self.manager.poll(), 1)
+        self.assertEqual(reports, [(1, 3.5)])
+        self.assertEqual(len(self.manager.near_timeouts), 1)
+
+    def test_many_sessions(self):
+        """Test each session gets its own keep alive."""
+        for session in range(100):
+            self.allocate(session + 10, session)
+        self.run_for(2.25)
+        self.assertEqual(len(self.transport.sent), 100)
+        self.assertEqual(len(set(self.transport.sent)), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import threading
+import unittest
+from pyvlcb import VLCBFilter, TrafficStore
+from pyvlcb.store import frame_columns
+
+class TestTrafficStore(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.store = TrafficStore(":memory:", batch_size=10, clock=lambda: self.now)
+        messages = [":SB780N2301;", ":SB020N9002000002;", ":SB020N9802000007;", ":SA020N63010002;", ":SA020N63010001;"]
+        for num in range(100):
+            self.store.add("RX", messages[num % 5], 1000.0 + num)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_columns(self):
+        """Test node and event numbers are found using the opcode format."""
+        self.assertEqual(frame_columns(":SB020N9002000003;"), (11, 1, 0x90, 512, 3))
+        self.assertEqual(frame_columns(":SB780N2301;"), (11, 60, 0x23, None, None))
+        # Missing data is not stored
+        self.assertEqual(frame_columns(":SB020N9002;"), (11, 1, 0x90, None, None))
+        self.assertEqual(frame_columns(":XINVALID;"), (None, None, None, None, None))
+        # Data which is not hex is not stored
+        self.assertEqual(frame_columns(":SB020N90ZZ000002;"), (11, 1, 0x90, None, None))
+
+    def test_batched(self):
+        """Test frames are written in batches and flushed before a query."""
+        self.store.add("TX", ":SB780N2301;", 2000.0)
+        self.assertEqual(len(self.store._pending), 1)
+        self.assertEqual(len(self.store), 101)
+        self.assertEqual(len(self.store._pending), 0)
+
+    def test_flush_interval(self):
+        """Test waiting frames are written once the flush interval has passed."""
+        self.store.add("TX", ":SB780N2301;")
+        self.now += 2
+        self.store.add("TX", ":SB780N2301;")
+        self.assertEqual(len(self.store._pending), 0)
+
+    def test_idle_flush(self):
+        """Test waiting frames are written by poll when no more frames arrive."""
+        self.store.add("TX", ":SB780N2301;")
+        self.assertFalse(self.store.poll())
+        self.assertEqual(len(self.store._pending), 1)
+        self.now += 2
+        self.assertTrue(self.store.poll())
+        self.assertEqual(len(self.store._pending), 0)
+        self.assertFalse(self.store.poll())
+
+    def test_background_flush(self):
+        """Test the background thread writes waiting frames when the bus is idle."""
+        store = TrafficStore(":memory:", flush_interval=0.01)
+        store.start()
+        try:
+            store.add("RX", ":SB780N2301;")
+            for _ in range(200):
+                if not store._pending:
+                    break
+                threading.Event().wait(0.01)
+            self.assertEqual(store._pending, [])
+        finally:
+            store.close()
+
+    def test_query_node_and_time(self):
+        """Test query by node number and time range."""
+        frames = self.store.query(start=1010, end=1030, node=512)
+        self.assertEqual([frame.timestamp for frame in frames], [1011.0, 1012.0, 1016.0, 1017.0, 1021.0, 1022.0, 1026.0, 1027.0])
+        self.assertEqual(len(self.store.query(opcode='ASON')), 20)
+        self.assertEqual(len(self.store.query(event=7)), 20)
+        self.assertEqual(len(self.store.query(can_id=60, limit=5)), 5)
+
+    def test_query_match(self):
+        """Test query using a filter on the decoded fields."""
+        frames = self.store.query(opcode='ERR', match=VLCBFilter("ErrCode == 2"))
+        self.assertEqual(len(frames), 20)
+        self.assertTrue(all(frame.packet == ":SA020N63010002;" for frame in frames))
+        self.assertEqual(len(self.store.query(opcode=0x63, match=VLCBFilter("ErrCode == 1"), limit=3)), 3)
+
+    def test_delete_before(self):
+        """Test old frames can be removed."""
+        self.assertEqual(self.store.delete_before(1050), 50)
+        self.assertEqual(len(self.store), 50)
+
+    def test_query_while_writing(self):
+        """Test queries while frames are written from another thread."""
+        for filename in (":memory:", "file"):
+            with self.subTest(filename=filename), tempfile.TemporaryDirectory() as directory:
+                if filename == "file":
+                    filename = os.path.join(directory, "traffic.db")
+                store = TrafficStore(filename, batch_size=1)
+                for num in range(2000):
+                    store.add("RX", ":SB020N9002000002;", 1000.0 + num)
+                stop = threading.Event()
+
+                def writer():
+                    num = 0
+                    while not stop.is_set():
+                        store.add("RX", ":SB020N9802000007;", 5000.0 + num)
+                        num += 1
+
+                thread = threading.Thread(target=writer)
+                thread.start()
+                try:
+                    for repeat in range(5):
+                        frames = list(store.iter_query(end=2999.0, node=512))
+                        self.assertEqual(len(frames), 2000)
+                finally:
+                    stop.set()
+                    thread.join()
+                    store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from pyvlcb import CaptureWriter, LocoFunctions
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".cap")
+        os.close(fd)
+        frames = [
+            (0.0, ":SA780N4000C8;"),            # RLOC 200
+            (0.1, ":SA020NE10100C800000000;"), # PLOC session 1 = 200
+            (0.2, ":SA780N470185;"),            # DSPD forward speed 5
+            (0.3, ":SA780N47020A;"),            # DSPD session 2 not allocated
+            (1.0, ":SA780N60010111;"),          # DFUN group 1 F0 and F1
+            (2.0, ":SA780N2301;"),              # DKEEP
+            (3.0, ":SA780N470105;"),            # DSPD reverse speed 5
+            (3.5, ":SA780N470105;"),            # DSPD repeated
+            (6.0, ":SA780N2301;"),              # DKEEP
+            (7.0, ":SA780N2101;"),              # KLOC
+            (7.5, ":SA020NE101C00381;"),        # PLOC short - ignored
+            (8.0, ":SA020NE101C00381080400;"),  # PLOC session 1 = 3
+            (9.0, ":SA780N60010402;"),          # DFUN group 4 F14
+            (9.5, ":SA780N470100;"),            # DSPD stop
+        ]
+        with CaptureWriter(self.filename) as writer:
+            for timestamp, packet in frames:
+                writer.write(timestamp, "RX", packet)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_sessions_mapped_to_locos(self):
+        """Test frames are assigned to the loco allocated to the session."""
+        from pyvlcb.telemetry import extract_telemetry
+        timelines = extract_telemetry(self.filename)
+        self.assertEqual(sorted(timelines), [3, 200])
+        loco = timelines[200]
+        self.assertEqual(loco.speed_time.tolist(), [0.1, 0.2, 3.0, 3.5])
+        self.assertEqual(loco.speed.tolist(), [0, 5, 5, 5])
+        self.assertEqual(loco.direction.tolist(), [0, 1, 0, 0])
+        self.assertEqual(loco.keepalive_time.tolist(), [2.0, 6.0])
+        self.assertEqual(loco.speed_changes(), 2)
+        self.assertAlmostEqual(loco.max_keepalive_gap(), 2.5)
+        self.assertAlmostEqual(loco.speed_change_rate(), 2 / 5.9)
+
+    def test_functions(self):
+        """Test function state matches LocoFunctions."""
+        from pyvlcb.telemetry import extract_telemetry
+        timelines = extract_telemetry(self.filename)
+        loco = timelines[200]
+        self.assertEqual(loco.function_time.tolist(), [0.1, 0.1, 0.1, 1.0])
+        self.assertEqual(LocoFunctions(int(loco.function_mask[-1])), LocoFunctions.from_list([1, 1]))
+        loco = timelines[3]
+        expected = LocoFunctions.from_ploc(0x08, 0x04, 0x00)
+        self.assertEqual(int(loco.function_mask[2]), expected.mask)
+        expected.set(14)
+        self.assertEqual(int(loco.function_mask[-1]), expected.mask)
+        self.assertEqual(loco.speed.tolist(), [1, 0])
+
+    def test_empty(self):
+        """Test a capture without loco frames."""
+        from pyvlcb.telemetry import extract_telemetry
+        with CaptureWriter(self.filename) as writer:
+            writer.write(0.0, "RX", ":SB780N0D;")
+        self.assertEqual(extract_telemetry(self.filename), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
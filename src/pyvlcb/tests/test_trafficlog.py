@@ -0,0 +1,84 @@
+import gzip
+import os
+import tempfile
+import unittest
+from pyvlcb import VLCB, TrafficLogger
+from pyvlcb.exceptions import InvalidConfigurationError
+
+class TestTrafficLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.vlcb = VLCB(can_id=60)
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "traffic.log")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_log_format(self):
+        """Test lines are written in the format read by VLCB.log_entry."""
+        with TrafficLogger(self.filename, clock=lambda: 1760882400.25) as traffic_logger:
+            traffic_logger.record("RX", b":SB780N2301;")
+            traffic_logger.record("TX", ":SB020N9001000002;")
+        self.assertEqual(traffic_logger.written, 2)
+        with open(self.filename) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[0].startswith("0,"))
+        self.assertTrue(lines[1].endswith(".250,TX,:SB020N9001000002;"))
+        self.assertEqual(self.vlcb.log_entry(lines[0])[4], "23 - DKEEP")
+        self.assertEqual(self.vlcb.log_entry(lines[1])[4], "90 - ACON")
+
+    def test_gzip_and_size_rotation(self):
+        """Test compressed files are rotated by size."""
+        gz_filename = self.filename + ".gz"
+        with TrafficLogger(gz_filename, compression="gzip", max_bytes=200, backup_count=2) as traffic_logger:
+            for num in range(50):
+                traffic_logger.record("RX", ":SB780N2301;")
+                if num % 5 == 4:
+                    # Give the writer time so rotation happens between batches
+                    traffic_logger._stop.wait(0.02)
+        self.assertGreater(traffic_logger.rotations, 0)
+        rotated = os.path.join(self.directory.name, "traffic.log.1.gz")
+        self.assertTrue(os.path.exists(rotated))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "traffic.log.3.gz")))
+        with gzip.open(rotated, "rt") as f:
+            self.assertTrue(f.readline().endswith(",RX,:SB780N2301;\n"))
+
+    def test_time_rotation(self):
+        """Test files are rotated after the rotate interval."""
+        now = [1000.0]
+        with TrafficLogger(self.filename, rotate_interval=60, clock=lambda: now[0]) as traffic_logger:
+            traffic_logger.record("RX", ":SB780N2301;")
+            while traffic_logger.written < 1:
+                traffic_logger._stop.wait(0.01)
+            now[0] += 61
+            traffic_logger.record("RX", ":SB780N2301;")
+        self.assertEqual(traffic_logger.rotations, 1)
+        self.assertTrue(os.path.exists(self.filename + ".1"))
+
+    def test_dropped(self):
+        """Test frames are dropped and counted when the queue is full."""
+        with TrafficLogger(self.filename, max_queue=0) as traffic_logger:
+            traffic_logger.record("RX", ":SB780N2301;")
+        self.assertEqual(traffic_logger.dropped, 1)
+        self.assertEqual(traffic_logger.written, 0)
+
+    def test_write_error(self):
+        """Test the writer keeps running after an unexpected error."""
+        with TrafficLogger(self.filename) as traffic_logger:
+            with self.assertLogs("pyvlcb.trafficlog", level="ERROR"):
+                traffic_logger.record("RX", 1234)
+                while traffic_logger.write_errors < 1:
+                    traffic_logger._stop.wait(0.01)
+            traffic_logger.record("RX", ":SB780N2301;")
+        self.assertEqual(traffic_logger.write_errors, 1)
+        self.assertEqual(traffic_logger.written, 1)
+
+    def test_invalid_compression(self):
+        """Test an unknown compression is rejected."""
+        with self.assertRaises(InvalidConfigurationError):
+            TrafficLogger(self.filename, compression="lzma")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+""" Background traffic logger
+
+Frames are added to a deque by the receive path (append is atomic so no
+lock is needed) and written to the log file by a background thread, so a
+slow write does not stall the receive loop. Lines are written in the
+num,date,direction,message format read by VLCB.log_entry.
+
+If the writer falls behind and max_queue frames are waiting then new
+frames are dropped and counted, so memory use is bounded.
+"""
+
+import gzip
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import BinaryIO, Callable, Optional, Union
+from .exceptions import InvalidConfigurationError
+import logging
+
+# Set up a null handler so nothing prints by default unless the user enables it
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+_suffixes = {None: "", COMPRESSION_GZIP: ".gz", COMPRESSION_ZSTD: ".zst"}
+
+
+class TrafficLogger:
+    """Write bus traffic to a log file from a background thread
+
+    Can be used as a CanUSB4 listener: usb.add_listener(traffic_logger.record)
+    Call stop (or use as a context manager) to write any waiting frames
+    and close the file.
+
+    Attributes:
+        filename: Current log file (rotated files have .1, .2 etc. before the compression suffix)
+        dropped: Number of frames dropped because the queue was full
+        written: Number of lines written
+        write_errors: Number of failed writes (the lines in that write are lost)
+        rotations: Number of times the file has been rotated
+    """
+    def __init__ (self,
+                  filename: str,
+                  compression: Optional[str] = None,
+                  max_bytes: Optional[int] = None,
+                  rotate_interval: Optional[float] = None,
+                  backup_count: int = 5,
+                  max_queue: int = 10000,
+                  poll_interval: float = 0.1,
+                  clock: Callable[[], float] = time.time) -> None:
+        """Inits TrafficLogger and starts the writer thread
+
+        Args:
+            filename: Log file
+            compression: None, COMPRESSION_GZIP or COMPRESSION_ZSTD (needs the zstandard package)
+            max_bytes: Rotate when this many bytes (before compression) have been written
+            rotate_interval: Rotate after this many seconds
+            backup_count: Number of rotated files to keep
+            max_queue: Maximum frames waiting to be written
+            poll_interval: Time the writer waits when there are no frames
+            clock: Function returning the current time
+
+        Raises:
+            InvalidConfigurationError: If compression is not supported
+            ImportError: If zstd is requested and zstandard is not installed
+        """
+        if compression not in _suffixes:
+            raise InvalidConfigurationError(f"Invalid compression {compression}")
+        if compression == COMPRESSION_ZSTD:
+            import zstandard
+            self._zstd = zstandard
+        self.filename = filename
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.dropped = 0
+        self.written = 0
+        self.write_errors = 0
+        self.rotations = 0
+        self._queue: deque = deque()
+        self._num = 0
+        self._file: Optional[BinaryIO] = None
+        self._raw_file: Optional[BinaryIO] = None
+        self._file_bytes = 0
+        self._file_opened = 0.0
+        # Date string cached for the current second
+        self._second = None
+        self._second_string = ""
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="TrafficLogger", daemon=True)
+        self._thread.start()
+
+    @property
+    def queued (self) -> int:
+        """Number of frames waiting to be written"""
+        return len(self._queue)
+
+    def record (self, direction: str, packet: Union[str, bytes]) -> None:
+        """Add a frame to be logged (signature matches CanUSB4.add_listener)
+
+        Does not wait for the file. If the queue is full the frame is dropped.
+        """
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append((self.clock(), direction, packet))
+
+    def _rotated_name (self, number: int) -> str:
+        suffix = _suffixes[self.compression]
+        if suffix and self.filename.endswith(suffix):
+            return f"{self.filename[:-len(suffix)]}.{number}{suffix}"
+        return f"{self.filename}.{number}"
+
+    def _open (self) -> None:
+        if self.compression == COMPRESSION_GZIP:
+            self._raw_file = None
+            self._file = gzip.open(self.filename, "ab")
+        elif self.compression == COMPRESSION_ZSTD:
+            self._raw_file = open(self.filename, "ab")
+            self._file = self._zstd.ZstdCompressor().stream_writer(self._raw_file)
+        else:
+            self._raw_file = None
+            self._file = open(self.filename, "ab")
+        self._file_bytes = 0
+        self._file_opened = self.clock()
+
+    def _close (self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._raw_file is not None and not self._raw_file.closed:
+            self._raw_file.close()
+        self._raw_file = None
+
+    def _rotate (self) -> None:
+        self._close()
+        if self.backup_count > 0:
+            for number in range(self.backup_count - 1, 0, -1):
+                source = self._rotated_name(number)
+                if os.path.exists(source):
+                    os.replace(source, self._rotated_name(number + 1))
+            if os.path.exists(self.filename):
+                os.replace(self.filename, self._rotated_name(1))
+        else:
+            os.remove(self.filename)
+        self.rotations += 1
+        self._open()
+
+    def _date_string (self, timestamp: float) -> str:
+        second = int(timestamp)
+        if second != self._second:
+            self._second = second
+            self._second_string = datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+        return f"{self._second_string}.{int((timestamp - second) * 1000):03d}"
+
+    # Write all waiting frames - only called from the writer thread
+    def _write_waiting (self) -> None:
+        queue = self._queue
+        lines = []
+        try:
+            while queue:
+                timestamp, direction, packet = queue.popleft()
+                if not isinstance(packet, str):
+                    packet = packet.decode('ascii', 'replace')
+                lines.append(f"{self._num},{self._date_string(timestamp)},{direction},{packet}\n")
+                self._num += 1
+                if len(lines) >= 1000:
+                    break
+            if not lines:
+                return
+            data = "".join(lines).encode('utf-8')
+            if self._file is None:
+                self._open()
+            self._file.write(data)
+            self._file.flush()
+            self._file_bytes += len(data)
+            self.written += len(lines)
+            if ((self.max_bytes is not None and self._file_bytes >= self.max_bytes) or
+                    (self.rotate_interval is not None and self.clock() - self._file_opened >= self.rotate_interval)):
+                self._rotate()
+        except OSError as e:
+            self.write_errors += 1
+            logger.warning("Error writing traffic log %s: %s", self.filename, e)
+            self._close()
+        except Exception:
+            # Keep the writer thread running so later frames are still logged
+            self.write_errors += 1
+            logger.exception("Error writing traffic log %s", self.filename)
+
+    def _run (self) -> None:
+        while not self._stop.is_set():
+            if self._queue:
+                self._write_waiting()
+            else:
+                self._stop.wait(self.poll_interval)
+        # Write everything still waiting before closing
+        while self._queue:
+            self._write_waiting()
+        self._close()
+
+    def stop (self, timeout: Optional[float] = None) -> None:
+        """Write all waiting frames, close the file and stop the writer thread"""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def __enter__ (self) -> "TrafficLogger":
+        return self
+
+    def __exit__ (self, *args) -> None:
+        self.stop()
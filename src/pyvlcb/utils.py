@@ -2,6 +2,9 @@
 
 from typing import Optional, Union, Tuple, List
 
+# Hex string for every byte value eg. hex_table[10] = '0A'
+hex_table = tuple(f"{value:02X}" for value in range(256))
+
 # Where 1 x bytes (2 chars)
 def num_to_1hexstr (num: int) -> str:
     """Convert number to a byte
@@ -12,6 +15,8 @@ def num_to_1hexstr (num: int) -> str:
     Returns:
         String: A hex representation of the number (2 chars)
     """
+    if 0 <= num <= 0xFF:
+        return hex_table[num]
     return f"{hex(num).upper()[2:]:0>2}"
 
 # Where 2 x bytes (4 chars)
@@ -24,6 +29,8 @@ def num_to_2hexstr (num: int) -> str:
     Returns:
         String: A hex representation of the number (4 chars)
     """
+    if 0 <= num <= 0xFFFF:
+        return hex_table[num >> 8] + hex_table[num & 0xFF]
     return f"{hex(num).upper()[2:]:0>4}"
 
 # Where 4 x bytes (8 chars)
@@ -171,7 +178,7 @@ def bytes_to_functions (fn1: bytes, fn2: bytes, fn3: bytes) -> List[int]:
     mask = [0b0001, 0b0010, 0b0100, 0b1000]
     function_status = [0] * 29
     # Handle 0 separately as it's in the upper nibble
-    function_status[0] = data_in[0] & 0b10000
+    function_status[0] = 1 if (data_in[0] & 0b10000) > 0 else 0
     # Create a list of 12 entries
     for i in range (0, 3):
         for j in range (0, 4):
@@ -1,7 +1,10 @@
 import logging
 import warnings
+from types import MappingProxyType
 from .utils import bytes_to_addr, bytes_to_functions
-from typing import List, Optional, Union, Dict, Any
+from .functions import LocoFunctions
+from .exceptions import InvalidLocoError, InvalidFunctionError
+from typing import List, Optional, Union, Dict, Any, Tuple, Mapping
 
 # Set up a null handler so nothing prints by default unless the user enables it
 logger = logging.getLogger(__name__)
@@ -107,14 +110,14 @@ class VLCBFormat :
         loco_id = None
         if self.opcode() == "PLOC":
             # Get data
-            data_dict = VLCBOpcode.parse_data(self.data)
+            data_dict = self.get_data()
             loco_id = data_dict['AddrHigh_AddrLow'] & 0x3FFF
         elif self.opcode() == "ERR":
             # also check it's one of the Error codes associated with allocate loco etc.
             # 1 = loco stack full 2 = loco taken, 7 = invalid request
             # The following are not supported as data bytes contain session / consist ID and not loco_id
             # 3 = no session, 4 consist empty, 5 loco not found, 6 can bus error
-            data_dict = VLCBOpcode.parse_data(self.data)
+            data_dict = self.get_data()
             if data_dict["ErrCode"] in [1, 2, 7]:
                 loco_id = bytes_to_addr(data_dict['Byte1'],data_dict['Byte2']) & 0x3FFF
             else:
@@ -142,17 +145,74 @@ class VLCBFormat :
         """
         if self.opcode() == "PLOC":
             # Get data
-            data_dict = VLCBOpcode.parse_data(self.data)
+            data_dict = self.get_data()
             return bytes_to_functions (data_dict['Fn1'], data_dict['Fn2'], data_dict['Fn3'])
         else:
             raise InvalidLocoError(f"Opcode {self.opcode()} does not contain a loco_id")
 
+    def get_functions (self) -> LocoFunctions:
+        """Where packet contains Fn1, Fn2, Fn3 (eg. PLOC) returns the
+        function state as a LocoFunctions bitmask (F0 to F12)
+
+        Returns:
+            LocoFunctions: Function state
+            
+        Raises:
+            InvalidFunctionError: If Function Bytes are not in the packet
+        """
+        if self.opcode() == "PLOC":
+            data_dict = self.get_data()
+            return LocoFunctions.from_ploc(data_dict['Fn1'], data_dict['Fn2'], data_dict['Fn3'])
+        else:
+            raise InvalidFunctionError(f"Opcode {self.opcode()} does not contain function information")
+
 
 
 
     def __str__ (self):
         return f'{self.priority} : {self.can_id} : {self.opcode()} ({self.data[0:2]}) : {self.data} / {self.format_data()}'
 
+
+# Read only packet - used where the same packet is shared (eg. DecodeCache)
+class FrozenVLCBFormat (VLCBFormat):
+    """ A VLCBFormat packet which cannot be changed
+
+    The decoded data is created on first use and then reused, and is
+    returned as a read only mapping.
+    """
+
+    def __init__ (self, priority: int, can_id: int, data: str) -> None:
+        """Inits FrozenVLCBFormat
+
+        Args:
+            priority: CAN priority
+            can_id: CAN ID
+            data: Remaining data as a hex string
+
+        """
+        object.__setattr__(self, 'priority', priority)
+        object.__setattr__(self, 'can_id', can_id)
+        object.__setattr__(self, 'data', data)
+        object.__setattr__(self, '_decoded', None)
+
+    def __setattr__ (self, name: str, value: Any) -> None:
+        raise AttributeError(f"Cannot set {name} - packet is read only")
+
+    def get_data (self) -> Mapping[str, Any]:
+        """Returns the opcode associated with the data string as a read only dict
+
+        Returns:
+            Mapping: Read only dict from the VLCBOpcode
+
+        Raises:
+            ValueError: If opcode not found
+        """
+        if self._decoded is None:
+            object.__setattr__(self, '_decoded', MappingProxyType(VLCBOpcode.parse_data(self.data)))
+        return self._decoded
+
+    format_data = get_data
+
 # Opcodes are provided to interpret read signals
 # or to allow code to provide user friendly information
 # Format provides a string that an be used to help interpret data portion
@@ -166,6 +226,7 @@ class VLCBOpcode:
         opcodes: Dict of opcodes indexed by opcode number as a hex string
         field_formats: Dict of data type and number of characters for each field
         accessory_codes: Dict of accessory on and off codes
+        sstat_codes: Dict of service mode status (SSTAT) codes
 
     """
     # Dict from opcode to dict of opcode information
@@ -212,6 +273,7 @@ class VLCBOpcode:
         '48':  {'opc': 'DFLG', 'title': 'Set Engine Flags', 'format': 'Session,SpeedFlag', 'minpri': 2, 'comment': 'Bits 0-1: Speed Mode 00 ? 128 speed steps; 01 ? 14 speed steps; 10 ? 28 speed steps with interleave steps; 11 ? 28 speed steps Bit 2: Lights On/OFF; Bit 3: Engine relative direction; Bits 4-5: Engine state (active =0 , consisted =1, consist master=2, inactive=3) Bits 6-7: Reserved.; Sent by a cab to notify the command station of a change in engine flags.'},
         # Fnum = Function number, 0 to 27
         '49':  {'opc': 'DFNON', 'title': 'Set Engine function on', 'format': 'Session,Fnum', 'minpri': 2, 'comment': 'Sent by a cab to turn on a specific loco function. This provides an alternative method to DFUN for controlling loco functions. A command station must implement both methods.'},
+        '4A':  {'opc': 'DFNOF', 'title': 'Set Engine function off', 'format': 'Session,Fnum', 'minpri': 2, 'comment': 'Sent by a cab to turn off a specific loco function. This provides an alternative method to DFUN for controlling loco functions. A command station must implement both methods.'},
         '4C':  {'opc': 'SSTAT', 'title': 'Service mode status', 'format': 'Session,Status', 'minpri': 3, 'comment': 'Status returned by command station/programmer at end of programming operation that does not return data.'},
         '50':  {'opc': 'RQNN', 'title': 'Request node number', 'format': 'NN', 'minpri': 3, 'comment': 'Sent by a node that is in setup/configuration mode and requests assignment of a node number (NN). The node allocating node numbers responds with (SNN) which contains the newly assigned node number. <NN hi> and <NN lo> are the existing node number, if the node has one. If it does not yet have a node number, these bytes should be set to zero.'},
         '51':  {'opc': 'NNREL', 'title': 'Node number release', 'format': 'NN', 'minpri': 3, 'comment': 'Sent by node when taken out of service. e.g. when reverting to SLiM mode.'},
@@ -250,7 +312,7 @@ class VLCBOpcode:
         '84':  {'opc': 'QCVS', 'title': 'Read CV', 'format': 'Session,CVHigh_CVLow,Mode', 'minpri': 2, 'comment': 'This command is used exclusively with service mode.; Sent by the cab to the command station in order to read a CV value. The command station shall respond with a PCVS message containing the value read, or SSTAT if the CV cannot be read.'},
         '85':  {'opc': 'PCVS', 'title': 'Report CV', 'format': 'Session,CVHigh_CVLow,CVVal', 'minpri': 2, 'comment': '<Dat1> is the session number of the cab; <Dat2> is the MSB # of the CV read (supports CVs 1 - 65536); <Dat3> is the LSB # of the CV read; <Dat4> is the read value; This command is used exclusively with service mode.; Sent by the command station to report a read CV.'},
         '87':  {'opc': 'RDGN', 'title': 'Request dianostic data', 'format': 'NN,ServiceIndex,DiagCode', 'minpri': 0, 'comment': 'Request diagnostic data from a module. If DiagCode is 0 then all data returned. If ServiceIndex 0 then send DGN message for each service, otherwise send DGN for service specified'},
-        '8E':  {'opc': 'NVSETRD', 'title': 'Set an NV value with read back', 'format': 'NN,NNIndex,NVVal', 'minpri': 0, 'comment': 'Sets an NV value and responds with the new value, response may not be the value requested. VLCB new feature.'},
+        '8E':  {'opc': 'NVSETRD', 'title': 'Set an NV value with read back', 'format': 'NN,NVIndex,NVVal', 'minpri': 0, 'comment': 'Sets an NV value and responds with the new value, response may not be the value requested. VLCB new feature.'},
         '90':  {'opc': 'ACON', 'title': 'Accessory ON', 'format': 'NN,EnHigh_EnLow', 'minpri': 3, 'comment': '<Dat1> is the high byte of the node number; <Dat2> is the low byte of the node number; <Dat3> is the high byte of the event number; <Dat4> is the low byte of the event number; Indicates an ?ON? event using the full event number of 4 bytes. (long event)'},
         '91':  {'opc': 'ACOF', 'title': 'Accessory OFF', 'format': 'NN,EnHigh_EnLow', 'minpri': 3, 'comment': '<Dat1> is the high byte of the node number; <Dat2> is the low byte of the node number; <Dat3> is the high byte of the event number; <Dat4> is the low byte of the event number; Indicates an ?OFF? event using the full event number of 4 bytes. (long event)'},
         '92':  {'opc': 'AREQ', 'title': 'Accessory Request Event', 'format': 'NN,EnHigh_EnLow', 'minpri': 3, 'comment': '<Dat1> is the high byte of the node number (MS WORD of the full event #); <Dat2> is the low byte of the node number (MS WORD of the full event #); <Dat3> is the high byte of the event number; <Dat4> is the low byte of the event number; Indicates a ?request? event using the full event number of 4 bytes. (long event); A request event is used to elicit a status response from a producer when it is required to know the state of the producer without producing an ON or OFF event and to trigger an event from a combi node'},
@@ -313,6 +375,7 @@ class VLCBOpcode:
         'D4':  {'opc': 'ARON2', 'title': 'Accessory Response Event', 'format': 'NN,EnHigh_EnLow,Byte1,Byte2', 'minpri': 3, 'comment': 'Indicates an ‘ON’ response event with two added data bytes. A response event is a reply to a status request (AREQ) without producing an ON or OFF event.'},
         'D5':  {'opc': 'AROF2', 'title': 'Accessory Response Event', 'format': 'NN,EnHigh_EnLow,Byte1,Byte2', 'minpri': 3, 'comment': 'Indicates an ‘OFF’ response event with two added data bytes. A response event is a reply to a status request (AREQ) without producing an ON or OFF event.'},
         'D8':  {'opc': 'ASON2', 'title': 'Accessory Short ON', 'format': 'NN,DNHigh_DNLow,Byte1,Byte2', 'minpri': 3, 'comment': 'Indicates an ‘ON’ event using the short event number of 2 LS bytes with two added data bytes.'},
+        'D9':  {'opc': 'ASOF2', 'title': 'Accessory Short OFF', 'format': 'NN,DNHigh_DNLow,Byte1,Byte2', 'minpri': 3, 'comment': 'Indicates an ‘OFF’ event using the short event number of 2 LS bytes with two added data bytes.'},
         'DD':  {'opc': 'ARSON2', 'title': 'Accessory Short Response Event with two bytes', 'format': 'NN,DNHigh_DNLow,Byte1,Byte2', 'minpri': 3, 'comment': 'Indicates an ‘ON’ response event with two added data bytes. A response event is a reply to a status request (ASRQ) without producing an ON or OFF event.'},
         'DE':  {'opc': 'ARSOF2', 'title': 'Accessory Short Response Event with two bytes','format': 'NN,DNHigh_DNLow,Byte1,Byte2', 'minpri': 3, 'comment': 'Indicates an ‘OFF’ response event with two added data bytes. A response event is a reply to a status request (ASRQ) without producing an ON or OFF event.'},
         'DF':  {'opc': 'EXTC5', 'title': 'Extended op-code with 5 data bytes', 'format': 'ExtOpc,Byte1,Byte2,Byte3,Byte4,Byte5', 'minpri': 3, 'comment': 'Used if the basic set of 32 OPCs is not enough. Allows an additional 256 OPCs'},
@@ -336,7 +399,7 @@ class VLCBOpcode:
         'F9':  {'opc': 'ASOF3', 'title': 'Accessory Short OFF', 'format': 'NN,DNHigh_DNLow,Byte1,Byte2,Byte3', 'minpri': 3, 'comment': 'Indicates an OFF event using the short event number of 2 LS bytes with three added data bytes.'},
         'FA':  {'opc': 'DDES', 'title': 'Device data event (short mode)', 'format': 'DNHigh_DNLow,Byte1,Byte2,Byte3,Byte4,Byte5', 'minpri': 3, 'comment': 'Function is the same as F6 but uses device addressing so can relate data to a device attached to a node. e.g. one of several RFID readers attached to a single node.'},
         'FB':  {'opc': 'DDRS', 'title': 'Device data response (short mode)', 'format': 'DNHigh_DNLow,Byte1,Byte2,Byte3,Byte4,Byte5', 'minpri': 3, 'comment': 'The response to a request for data from a device. (0x5B)'},
-        'FC':  {'opc': 'DDWS', 'title': 'Write data', 'format': 'DNHigh_DNLow,byte1,byte2,byte3,byte4,byte5', 'minpri': 0, 'comment': 'Used to write data to a device such as an RFID tag. For RC522 byte1 should be 0.'},
+        'FC':  {'opc': 'DDWS', 'title': 'Write data', 'format': 'DNHigh_DNLow,Byte1,Byte2,Byte3,Byte4,Byte5', 'minpri': 0, 'comment': 'Used to write data to a device such as an RFID tag. For RC522 byte1 should be 0.'},
         'FD':  {'opc': 'ARSON3', 'title': 'Accessory Short Response Event', 'format': 'NN,DNHigh_DNLow,Byte1,Byte2,Byte3', 'minpri': 3, 'comment': "Indicates an ON response event with with three added data bytes. A response event is a reply to a status request (ASRQ) without producing an ON or OFF event."},
         'FE':  {'opc': 'ARSOF3', 'title': 'Accessory Short Response Event', 'format': 'NN,DNHigh_DNLow,Byte1,Byte2,Byte3', 'minpri': 3, 'comment': "Indicates an OFF response event with with three added data bytes. A response event is a reply to a status request (ASRQ) without producing an ON or OFF event."},
         'FF':  {'opc': 'EXTC6', 'title': 'Extended op-code with 6 data bytes', 'format': 'ExtOpc,Byte1,Byte2,Byte3,Byte4,Byte5,Byte6', 'minpri': 3, 'comment': 'Used if the basic set of 32 OPCs is not enough. Allows an additional 256 OPCs'}
@@ -369,7 +432,7 @@ class VLCBOpcode:
             "Byte4": [2, "hex"],           # Byte (eg extended)
             "Byte5": [2, "hex"],           # Byte (eg extended)
             "Byte6": [2, "hex"],           # Byte (eg extended)
-            "CVHigh_CVLow": [2, "num"],    # CV number (DCC Configuration variables)
+            "CVHigh_CVLow": [4, "num"],    # CV number (DCC Configuration variables)
             "CVVal": [2, "num"],           # CV value 
             "NVIndex": [2, "num"],         # NV Node variable index
             "NVVal": [2, "hex"],           # NV value
@@ -395,7 +458,7 @@ class VLCBOpcode:
             "En3_0": [8, "hex"],           # 4 bytes of stored event
             "EVSPC": [2, "num"],           # Amount of space available for events
             "ErrCode": [2, "hex"],         # Short 1 byte error code
-            "Error": [4, "hex"],           # Error code
+            "Error": [2, "hex"],           # Error code (CMDERR)
             "ModeCmd": [2, "num"],         # New VLCB mode command
             "ServiceIndex": [2, "hex"],    # New VLCB Index of services
             "DiagCode": [2, "hex"],        # New VLCB Diagnostic data code
@@ -446,6 +509,16 @@ class VLCBOpcode:
         '08': 'Session cancelled'
         }
     
+    # Service mode status codes (SSTAT) as byte string lookup
+    sstat_codes = {
+        '00': 'Reserved',
+        '01': 'No acknowledge',
+        '02': 'Overload on programming track',
+        '03': 'Write acknowledge',
+        '04': 'Busy',
+        '05': 'CV out of range'
+        }
+
     # CMDERR / GRSP error codes as byte string lookup
     grsp_error_codes = {
         '00': 'OK',
@@ -470,6 +543,11 @@ class VLCBOpcode:
         'FF': 'Reserved'
         }
 
+    # Reverse lookup from mnemonic (eg. 'ACON') to opcode hex string (eg. '90')
+    mnemonics = {details['opc']: code for code, details in opcodes.items()}
+
+    # Cache of field layouts created by field_layout
+    _layouts = {}
         
     
     # Shorten op-code (remove extra characters)
@@ -542,6 +620,61 @@ class VLCBOpcode:
         else:
             raise ValueError(f"Opcode {opcode} is not defined.")
     
+    # Convert mnemonic to op-code
+    @staticmethod
+    def opcode_from_mnemonic (mnemonic: str) -> str:
+        """Get opcode from mnemonic
+
+        Returns:
+            String: Opcode as a 2 character hex string
+
+        Raises:
+            ValueError: If mnemonic not found
+        """
+        if mnemonic in VLCBOpcode.mnemonics:
+            return VLCBOpcode.mnemonics[mnemonic]
+        else:
+            raise ValueError(f"Mnemonic {mnemonic} is not defined.")
+    
+    # Position of each field in the data string - calculated once per opcode
+    @staticmethod
+    def field_layout (opcode: str) -> Tuple[Tuple[str, int, int, str], ...]:
+        """Get the position of each field within a data string
+
+        Uses the same format and field_formats as parse_data, so a field at
+        data[start:end] is the value parse_data would return for that field.
+
+        Args:
+            opcode: Opcode as a 2 character hex string
+
+        Returns:
+            Tuple of (field name, start, end, format) for each field, where
+            start and end are character positions in the data string
+            (which includes the 2 character opcode)
+
+        Raises:
+            ValueError: If opcode not found
+        """
+        layout = VLCBOpcode._layouts.get(opcode)
+        if layout is not None:
+            return layout
+        if opcode not in VLCBOpcode.opcodes:
+            raise ValueError(f"Opcode {opcode} is not defined.")
+        fields = []
+        start = 2
+        for this_field in VLCBOpcode.opcodes[opcode]['format'].split(','):
+            if this_field == "":
+                break
+            # Unknown fields are stored as Unknown by parse_data
+            if this_field not in VLCBOpcode.field_formats:
+                this_field = "Unknown"
+            num_chars, field_type = VLCBOpcode.field_formats[this_field]
+            fields.append((this_field, start, start + num_chars, field_type))
+            start += num_chars
+        layout = tuple(fields)
+        VLCBOpcode._layouts[opcode] = layout
+        return layout
+    
     # Parse the data based on the format str and store in a dictionary
     @staticmethod
     def parse_data (data: str) -> OpcodeData: